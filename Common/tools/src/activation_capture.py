@@ -0,0 +1,131 @@
+import hashlib
+from collections import OrderedDict
+
+import torch
+
+
+def image_key( image ):
+    """Return a key that identifies the content of an image tensor.
+    Hashing the bytes is cheap for the image sizes used in the shell and,
+    unlike id() or data_ptr(), does not alias when a tensor is freed and
+    another one is allocated in its place.
+    """
+    if image is None:
+        return None
+    if isinstance( image, torch.Tensor ):
+        data = image.detach().cpu().contiguous().numpy().tobytes()
+        return ( tuple( image.size() ), hashlib.sha1( data ).hexdigest() )
+    return id( image )
+
+
+def reduce_channels( output, reduce=None ):
+    """Reduce a layer output to one value per channel.
+    reduce can be None (keep the full map), "mean" or "max". Outputs with
+    no spatial dimensions are returned as they are.
+    """
+    output = output.detach()
+    if reduce is None or output.dim() < 3:
+        return output.clone()
+
+    flat = output.flatten( 2 )
+    if reduce == "mean":
+        return flat.mean( dim=2 )
+    elif reduce == "max":
+        return flat.max( dim=2 )[ 0 ]
+    raise ValueError( "Unknown reduce mode \"{}\"".format( reduce ) )
+
+
+class ActivationCache( object ):
+    """Bounded LRU store for captured activations.
+    Entries are keyed by ( model, layer, image, reduce, training ), the least
+    recently used entry is dropped once capacity is reached.
+    """
+    def __init__( self, capacity=32 ):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__( self, key ):
+        return key in self.entries
+
+    def __len__( self ):
+        return len( self.entries )
+
+    def get( self, key ):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end( key )
+        return self.entries[ key ]
+
+    def put( self, key, value ):
+        self.entries[ key ] = value
+        self.entries.move_to_end( key )
+        self.evict()
+
+    def resize( self, capacity ):
+        self.capacity = capacity
+        self.evict()
+
+    def evict( self ):
+        while len( self.entries ) > self.capacity:
+            self.entries.popitem( last=False )
+
+    def invalidate( self, model=None ):
+        """Drop all entries, or only the entries belonging to a model
+        """
+        if model is None:
+            self.entries.clear()
+            return
+        for key in [ k for k in self.entries if k[ 0 ] == model ]:
+            del self.entries[ key ]
+
+    def clear( self ):
+        self.invalidate()
+        self.hits = 0
+        self.misses = 0
+
+    def __str__( self ):
+        return "Activation cache: {}/{} entries, {} hits, {} misses".format(
+                    len( self.entries ), self.capacity, self.hits, self.misses )
+
+
+class ActivationCapture( object ):
+    """Context manager that hooks several layers for a single forward pass.
+    Hooks are registered on enter and always removed on exit, so they never
+    pile up between commands.
+
+    Usage:
+        with ActivationCapture( [ ( id, layer ), ... ], reduce="mean" ) as capture:
+            net( image )
+        out = capture[ id ]
+    """
+    def __init__( self, layers, reduce=None ):
+        self.layers = OrderedDict( ( tuple( id ), layer ) for id, layer in layers )
+        self.reduce = reduce
+        self.data = OrderedDict()
+        self.handles = []
+
+    def __enter__( self ):
+        for id, layer in self.layers.items():
+            self.handles.append( layer.register_forward_hook( self._make_hook( id ) ) )
+        return self
+
+    def __exit__( self, *exc_info ):
+        self.remove()
+        return False
+
+    def __getitem__( self, id ):
+        return self.data.get( tuple( id ) )
+
+    def _make_hook( self, id ):
+        def _hook( layer, input, output ):
+            self.data[ id ] = reduce_channels( output, self.reduce )
+        return _hook
+
+    def remove( self ):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
@@ -0,0 +1,178 @@
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import matplotlib.pyplot as plt
+from PIL import Image
+
+
+def normalize_maps( maps ):
+    """Scale every map in a ( ... x h x w ) tensor to [ 0, 1 ] by its own range
+    """
+    flat = maps.flatten( -2 )
+    low = flat.min( dim=-1, keepdim=True )[ 0 ]
+    high = flat.max( dim=-1, keepdim=True )[ 0 ]
+    flat = ( flat - low ) / ( high - low ).clamp( min=1e-8 )
+    return flat.view_as( maps )
+
+
+def upsample_maps( maps, size ):
+    """Resize ( B x K x h x w ) maps to size with bilinear interpolation
+    """
+    return F.interpolate( maps, size=size, mode="bilinear", align_corners=False ).clamp( 0, 1 )
+
+
+def class_activation_maps( features, fc_weight, classes ):
+    """Compute class activation maps for a batch.
+    Inputs:
+        features: ( B x C x h x w ) activations that feed the global pooling layer
+        fc_weight: ( num_classes x C ) weights of the classifier
+        classes: ( B ) or ( B x K ) class indices to compute the maps for
+    Returns:
+        ( B x h x w ) or ( B x K x h x w ) maps, each normalized to [ 0, 1 ]
+    """
+    squeeze = classes.dim() == 1
+    if squeeze:
+        classes = classes.unsqueeze( 1 )
+    cams = torch.einsum( "bkc,bchw->bkhw", fc_weight[ classes ], features )
+    cams = normalize_maps( cams )
+    return cams.squeeze( 1 ) if squeeze else cams
+
+
+def grad_cam_maps( features, scores ):
+    """Compute Grad-CAM maps for a batch.
+    Inputs:
+        features: ( B x C x h x w ) activations, part of the graph that produced scores
+        scores: ( B x K ) class scores
+    Returns:
+        ( B x K x h x w ) maps, each normalized to [ 0, 1 ]
+    """
+    maps = []
+    for k in range( scores.size( 1 ) ):
+        # Samples in a batch are independent, so the gradient of the sum
+        # gives every sample's gradient in one backward pass
+        grads, = torch.autograd.grad( scores[ :, k ].sum(), features, retain_graph=True )
+        weights = grads.mean( dim=( 2, 3 ) )
+        maps.append( F.relu( torch.einsum( "bc,bchw->bhw", weights, features ) ) )
+    return normalize_maps( torch.stack( maps, dim=1 ).detach() )
+
+
+def overlay( image, cam, alpha=0.5, cmap="jet" ):
+    """Blend a [ 0, 1 ] heatmap over an image, both as tensors.
+    Inputs:
+        image: ( 3 x H x W ) image in [ 0, 1 ]
+        cam: ( H x W ) map in [ 0, 1 ]
+    Returns:
+        ( 3 x H x W ) image
+    """
+    colors = torch.from_numpy( plt.get_cmap( cmap )( np.linspace( 0, 1, 256 ) )[ :, :3 ] ).float()
+    heat = colors[ ( cam * 255 ).long().clamp( 0, 255 ) ].permute( 2, 0, 1 )
+    return ( 1 - alpha ) * image + alpha * heat
+
+
+class CamEngine( object ):
+    """Batched CAM/Grad-CAM computation for a model in the shell context.
+    Features are taken from the input of the last global pooling layer, which is
+    what the classifier weights apply to. For models without one, the output of
+    the last Conv2d is used and only Grad-CAM is available.
+    """
+    def __init__( self, model_info ):
+        self.model_info = model_info
+        self.features = None
+        self.hook = None
+        self.fc = None
+        self.gap = True
+        self.find_layers()
+
+    def find_layers( self ):
+        _, self.fc = self.model_info.find_last_instance( layer=nn.Linear )
+        _, pool = self.model_info.find_last_instance( layer=nn.AdaptiveAvgPool2d )
+        if pool is not None:
+            self.layer = pool
+            self.pre_hook = True
+        else:
+            _, self.layer = self.model_info.find_last_instance( layer=nn.Conv2d )
+            self.pre_hook = False
+            self.gap = False
+        if self.layer is None:
+            raise RuntimeError( "No feature layer found for CAM" )
+
+    def _hook_fn( self, layer, input, output=None ):
+        self.features = input[ 0 ] if self.pre_hook else output
+
+    def forward( self, images ):
+        if self.pre_hook:
+            self.hook = self.layer.register_forward_pre_hook( self._hook_fn )
+        else:
+            self.hook = self.layer.register_forward_hook( self._hook_fn )
+        try:
+            out = self.model_info.model( images )
+        finally:
+            self.hook.remove()
+            self.hook = None
+        return out
+
+    def compute( self, images, topk=1, classes=None, method="cam", upsample=True, all_probs=False ):
+        """Compute heatmaps for a batch of images.
+        Inputs:
+            images: ( B x 3 x H x W ) batch
+            topk: number of top classes to compute maps for, if classes is None
+            classes: optional ( B x K ) tensor of classes to compute maps for
+            method: "cam" or "gradcam"
+            upsample: if False, maps are returned at the feature resolution
+            all_probs: if True, probs are those of all classes
+        Returns:
+            maps: ( B x K x H x W ) heatmaps at the input resolution
+            classes: ( B x K ) class indices
+            probs: ( B x K ) softmax probabilities of those classes, ( B x C ) with all_probs
+        """
+        if method == "cam" and not self.gap:
+            raise RuntimeError( "Model has no global pooling layer, use gradcam instead" )
+
+        with torch.set_grad_enabled( method == "gradcam" ):
+            out = self.forward( images )
+            probs = F.softmax( out, dim=1 )
+            if classes is None:
+                _, classes = probs.topk( topk, dim=1 )
+
+            if method == "gradcam":
+                maps = grad_cam_maps( self.features, out.gather( 1, classes ) )
+            else:
+                maps = class_activation_maps( self.features, self.fc.weight, classes )
+        self.features = None
+
+        maps = maps.detach()
+        if upsample:
+            maps = upsample_maps( maps, images.size()[ 2: ] )
+        return maps, classes, ( probs if all_probs else probs.gather( 1, classes ) ).detach()
+
+    def export( self, loader, out_dir, topk=1, method="cam", log=print ):
+        """Compute heatmaps for every batch of a loader yielding ( images, index ) and
+        save one overlay PNG per image and class, plus all maps in heatmaps.npz.
+        Maps are stored at the feature resolution so the archive stays small.
+        """
+        os.makedirs( out_dir, exist_ok=True )
+        files = loader.dataset.files
+        all_maps, all_classes, all_probs = [], [], []
+
+        for images, indices in loader:
+            maps, classes, probs = self.compute( images, topk=topk, method=method, upsample=False )
+            full_maps = upsample_maps( maps, images.size()[ 2: ] )
+            for image, m, c, i in zip( images, full_maps, classes, indices ):
+                name = os.path.splitext( os.path.basename( files[ i ] ) )[ 0 ]
+                for k in range( m.size( 0 ) ):
+                    out = overlay( image, m[ k ] ).permute( 1, 2, 0 ).mul( 255 ).byte().numpy()
+                    Image.fromarray( out ).save( os.path.join( out_dir, "{}_{}.png".format( name, c[ k ].item() ) ) )
+
+            all_maps.append( maps.half() )
+            all_classes.append( classes )
+            all_probs.append( probs )
+            log( "Exported {}/{} images".format( sum( len( c ) for c in all_classes ), len( files ) ) )
+
+        np.savez( os.path.join( out_dir, "heatmaps.npz" ),
+                  files=np.array( files ),
+                  maps=torch.cat( all_maps ).numpy(),
+                  classes=torch.cat( all_classes ).numpy(),
+                  probs=torch.cat( all_probs ).numpy() )
@@ -0,0 +1,202 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def module_macs( module, input, output ):
+    """Multiply-accumulate count of one call of a leaf module.
+    Element-wise ops without weights (activations, residual adds) count as 0.
+    """
+    if isinstance( module, nn.Conv2d ):
+        return output.numel() * ( module.in_channels // module.groups ) * int( np.prod( module.kernel_size ) )
+    if isinstance( module, nn.Linear ):
+        return output.numel() * module.in_features
+    if isinstance( module, ( nn.BatchNorm2d, nn.BatchNorm1d, nn.LayerNorm ) ):
+        return output.numel()
+    if isinstance( module, ( nn.MaxPool2d, nn.AvgPool2d, nn.AdaptiveAvgPool2d, nn.AdaptiveMaxPool2d ) ):
+        return input[ 0 ].numel()
+    return 0
+
+
+class LayerProfiler( object ):
+    """Profile a model with one set of forward hooks.
+    Every module call gets a record with its path id, type, output shape,
+    parameters, MACs, activation memory and CPU latency averaged over repeats.
+    Records of containers hold the totals of everything under them, so the
+    profile can be read at any depth of the module tree.
+    A module that is shared between several places in the model is attributed
+    to the place it is called from.
+    """
+    def __init__( self, model_info, input_size=( 1, 3, 224, 224 ), repeats=10, warmup=2 ):
+        self.model_info = model_info
+        self.input_size = input_size
+        self.repeats = repeats
+        self.warmup = warmup
+        self.records = []
+        self.total_time = 0.0
+
+    def run( self ):
+        model = self.model_info.model
+        index = self.model_info.index
+        paths = OrderedDict()
+        paths[ id( model ) ] = [ [] ]
+        for mid, m in zip( index.ids, index.modules ):
+            paths.setdefault( id( m ), [] ).append( mid )
+
+        stack = []
+        records = []
+        state = { "call": 0, "record": True }
+
+        def _resolve( m ):
+            candidates = paths[ id( m ) ]
+            if len( candidates ) > 1 and stack:
+                parent = stack[ -1 ][ 0 ]
+                for c in candidates:
+                    if c[ :-1 ] == parent:
+                        return c
+            return candidates[ 0 ]
+
+        def _pre_hook( m, input ):
+            stack.append( ( _resolve( m ), state[ "call" ], time.perf_counter() ) )
+            state[ "call" ] += 1
+
+        def _post_hook( m, input, output ):
+            mid, call, t0 = stack.pop()
+            elapsed = time.perf_counter() - t0
+            if state[ "record" ]:
+                leaf = not list( m.children() )
+                out = output if isinstance( output, torch.Tensor ) else None
+                records.append( { "id"      : tuple( mid ),
+                                  "call"    : call,
+                                  "type"    : type( m ).__name__,
+                                  "leaf"    : leaf,
+                                  "shape"   : tuple( out.size() ) if out is not None else None,
+                                  "params"  : sum( p.numel() for p in m.parameters( recurse=False ) ),
+                                  "macs"    : module_macs( m, input, out ) if leaf and out is not None else 0,
+                                  "memory"  : out.numel() * out.element_size() if out is not None else 0,
+                                  "time"    : 0.0 } )
+            else:
+                by_call[ call ][ "time" ] += elapsed
+
+        modules = { id( model ): model }
+        modules.update( ( id( m ), m ) for m in index.modules )
+        handles = []
+        for m in modules.values():
+            handles.append( m.register_forward_pre_hook( _pre_hook ) )
+            handles.append( m.register_forward_hook( _post_hook ) )
+
+        device = next( model.parameters() ).device
+        x = torch.rand( self.input_size, device=device )
+        training = model.training
+        model.eval()
+        try:
+            with torch.no_grad():
+                model( x )
+                by_call = { r[ "call" ]: r for r in records }
+                state[ "record" ] = False
+                for _ in range( self.warmup ):
+                    state[ "call" ] = 0
+                    model( x )
+                for r in records:
+                    r[ "time" ] = 0.0
+                for _ in range( self.repeats ):
+                    state[ "call" ] = 0
+                    model( x )
+        finally:
+            for h in handles:
+                h.remove()
+            model.train( training )
+
+        for r in records:
+            r[ "time" ] /= max( self.repeats, 1 )
+        records.sort( key=lambda r: r[ "call" ] )
+        self.accumulate( records )
+        self.records = records
+        return self
+
+    def accumulate( self, records ):
+        """Add the params, MACs and memory of the leaves to every enclosing container.
+        Records are in call order, so a container's leaves follow it until the
+        next record that is not under its path.
+        """
+        for i, r in enumerate( records ):
+            if r[ "leaf" ]:
+                continue
+            n = len( r[ "id" ] )
+            for key in ( "params", "macs", "memory" ):
+                r[ key ] = r[ key ] if key == "params" else 0
+            for sub in records[ i + 1: ]:
+                if sub[ "id" ][ :n ] != r[ "id" ] or sub[ "call" ] <= r[ "call" ]:
+                    break
+                if sub[ "leaf" ]:
+                    r[ "params" ] += sub[ "params" ]
+                    r[ "macs" ] += sub[ "macs" ]
+                    r[ "memory" ] += sub[ "memory" ]
+
+    def rows( self, depth=None ):
+        """Records to report at a depth of the tree: containers at exactly that
+        depth and leaves above it. With no depth, all leaves.
+        """
+        if depth is None:
+            return [ r for r in self.records if r[ "leaf" ] ]
+        return [ r for r in self.records if len( r[ "id" ] ) == depth or
+                                           ( r[ "leaf" ] and len( r[ "id" ] ) < depth ) ]
+
+    def totals( self ):
+        root = [ r for r in self.records if r[ "id" ] == () ]
+        leaves = self.rows()
+        return { "params"   : sum( p.numel() for p in self.model_info.model.parameters() ),
+                 "macs"     : sum( r[ "macs" ] for r in leaves ),
+                 "memory"   : sum( r[ "memory" ] for r in leaves ),
+                 "time"     : root[ 0 ][ "time" ] if root else sum( r[ "time" ] for r in leaves ) }
+
+    def report( self, depth=None ):
+        lines = [ "{:<20s}{:<20s}{:<24s}{:>12s}{:>12s}{:>12s}{:>10s}{:>7s}".format(
+                    "Layer", "Type", "Output", "Params", "MMACs", "Act KB", "ms", "%" ) ]
+        total = self.totals()
+        for r in self.rows( depth ):
+            lines.append( "{:<20s}{:<20s}{:<24s}{:>12,d}{:>12.2f}{:>12.1f}{:>10.3f}{:>7.1f}".format(
+                            str( list( r[ "id" ] ) ), r[ "type" ], str( list( r[ "shape" ] or [] ) ),
+                            r[ "params" ], r[ "macs" ] / 1e6, r[ "memory" ] / 1024, r[ "time" ] * 1000,
+                            100 * r[ "time" ] / max( total[ "time" ], 1e-12 ) ) )
+        lines.append( "Total: {:,} params, {:.2f} GMACs, {:.1f} MB activations, {:.2f} ms per forward".format(
+                        total[ "params" ], total[ "macs" ] / 1e9, total[ "memory" ] / 2**20, total[ "time" ] * 1000 ) )
+        return "\n".join( lines )
+
+
+def diff_report( a, b, depth=None ):
+    """Compare two profiles row by row. Rows are matched by layer id, rows
+    present in only one of the models are shown with blanks for the other.
+    """
+    rows_a = OrderedDict( ( r[ "id" ], r ) for r in a.rows( depth ) )
+    rows_b = OrderedDict( ( r[ "id" ], r ) for r in b.rows( depth ) )
+    ids = list( rows_a ) + [ i for i in rows_b if i not in rows_a ]
+
+    def _fmt( r, key, scale, fmt ):
+        return fmt.format( r[ key ] * scale ) if r is not None else "-"
+
+    name_a, name_b = a.model_info.name, b.model_info.name
+    lines = [ "{:<20s}{:>14s}{:>14s}{:>12s}{:>12s}{:>10s}{:>10s}".format(
+                "Layer", "MMACs " + name_a[ :6 ], "MMACs " + name_b[ :6 ],
+                "ms " + name_a[ :6 ], "ms " + name_b[ :6 ], "dMACs %", "dms %" ) ]
+    for i in ids:
+        ra, rb = rows_a.get( i ), rows_b.get( i )
+        dmacs = dtime = "-"
+        if ra is not None and rb is not None:
+            dmacs = "{:+.1f}".format( 100 * ( rb[ "macs" ] - ra[ "macs" ] ) / max( ra[ "macs" ], 1 ) )
+            dtime = "{:+.1f}".format( 100 * ( rb[ "time" ] - ra[ "time" ] ) / max( ra[ "time" ], 1e-12 ) )
+        lines.append( "{:<20s}{:>14s}{:>14s}{:>12s}{:>12s}{:>10s}{:>10s}".format(
+                        str( list( i ) ),
+                        _fmt( ra, "macs", 1e-6, "{:.2f}" ), _fmt( rb, "macs", 1e-6, "{:.2f}" ),
+                        _fmt( ra, "time", 1e3, "{:.3f}" ), _fmt( rb, "time", 1e3, "{:.3f}" ),
+                        dmacs, dtime ) )
+
+    ta, tb = a.totals(), b.totals()
+    for key, scale, unit in ( ( "params", 1e-6, "M params" ), ( "macs", 1e-9, "GMACs" ), ( "time", 1e3, "ms" ) ):
+        lines.append( "{:<10s}{:>12.3f} {:<10s}{:>12.3f} {:<10s}{:>+8.1f}%".format(
+                        unit, ta[ key ] * scale, name_a[ :10 ], tb[ key ] * scale, name_b[ :10 ],
+                        100 * ( tb[ key ] - ta[ key ] ) / max( ta[ key ], 1e-12 ) ) )
+    return "\n".join( lines )
@@ -41,8 +41,7 @@ class LayerVisualizer( ShellBase ):
         self.fnum = 0
         self.row = 0
         self.col = 0
-        self.model_info.cur_layer.register_forward_hook()
-        _ = self.model_info.model( self.image )
+        self.capture_activations( self.model_info, [ self.model_info.cur_layer ], self.image )
         self._data = self.model_info.cur_layer.data().squeeze( 0 )
         self._weights = self.model_info.cur_layer.layer.weight.detach().clone()
 
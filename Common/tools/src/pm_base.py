@@ -8,11 +8,12 @@ import torch.nn as nn
 import torchvision
 from torchvision import transforms, datasets
 from PIL import Image
-from pm_helper_classes import GraphWindow, ModelMeta
+from pm_helper_classes import GraphWindow, ModelMeta, compose_grid
+from activation_capture import ActivationCache, ActivationCapture, image_key
 
 
 class ShellBase( object ):
-    def __init__( self ):
+    def __init__( self, headless=None ):
         super().__init__()
         self.stdout = sys.stdout
         self.image_size = 224
@@ -23,7 +24,8 @@ class ShellBase( object ):
         self.quiet = False
         self.stack = []
         self.cur_frame = sys._getframe().f_back
-        self.fig = GraphWindow()
+        self.fig = GraphWindow( headless=headless )
+        self.activations = ActivationCache()
         print( "Init base")
     def set_model( self, name, model ):
         # If model is already in context, we only need to switch the pointer
@@ -44,6 +46,7 @@ class ShellBase( object ):
             set_as_cur_model = True
 
         del self.models[ name ]
+        self.activations.invalidate( name )
         
         new_model = self.load_from_global( name )
         if new_model is not None and isinstance( new_model, nn.Module ):
@@ -107,6 +110,33 @@ class ShellBase( object ):
 
         return model_info, layer_info
 
+    def capture_activations( self, model_info, layer_infos, image, reduce=None ):
+        """Run a single forward pass and capture the outputs of all the given layers.
+        Captured data is stored in the activation cache and in each layer_info.
+        If everything is already cached the forward pass is skipped. Entries are
+        per train/eval mode, since dropout and batch norm depend on it.
+        Returns the model output.
+        """
+        img_key = image_key( image )
+        training = model_info.model.training
+        out_key = ( model_info.name, None, img_key, None, training )
+        keys = [ ( model_info.name, tuple( l.id ), img_key, reduce, training ) for l in layer_infos ]
+
+        if out_key in self.activations and all( k in self.activations for k in keys ):
+            for layer_info, key in zip( layer_infos, keys ):
+                layer_info.out = self.activations.get( key )
+            return self.activations.get( out_key )
+
+        layers = [ ( l.id, l.layer ) for l in layer_infos ]
+        with ActivationCapture( layers, reduce=reduce ) as capture, torch.no_grad():
+            out = model_info.model( image )
+
+        self.activations.put( out_key, out )
+        for layer_info, key in zip( layer_infos, keys ):
+            layer_info.out = capture[ layer_info.id ]
+            self.activations.put( key, layer_info.out )
+        return out
+
     def display_bargraph( self, data, title, reduce_fn=None ):
         if data.size( 0 ) != 1:
             self.error( "Unsupported data dimensions" )
@@ -114,21 +144,16 @@ class ShellBase( object ):
 
         reduce_fn = torch.mean if reduce_fn is None else reduce_fn        
         data = data.squeeze( 0 )
-        index = np.arange( data.size( 0 ) )
         # The following statement is invariant to data of dimension ( 1 ).
         # such as a list of tensors. Along the first dimension, replace 
         # the elements with any remaining dimensions with their mean.
         y_data = torch.tensor( list( map( lambda x: reduce_fn( x ).float().item(), data[ : ] ) ) )
-        
-        val, id = y_data.topk( 5, dim=0, largest=True, sorted=True )
 
-        ax = self.fig.get_or_create_window().ax
-        ax.set_title( title )
-        ax.bar( index, y_data, align="center", width=1 )
-        for i, v in zip( id, val ):
-            ax.text( i, v, "{}".format( i ) )
-        ax.grid()
-        self.fig.show_graph( ax )
+        # In single window mode keep the window, so an existing bar graph of
+        # the same size is updated in place
+        window = self.fig.get_or_create_window( persist=self.fig.num_windows == 1 )
+        window.bargraph( y_data, title )
+        self.fig.show_graph( window.ax )
 
     def compute_grid_size( self, nf ):
         s = int( np.floor( np.sqrt( nf ) ) )
@@ -140,26 +165,32 @@ class ShellBase( object ):
         if not isinstance( weight, torch.Tensor ):
             return False
         nf, nc, h, w = weight.size()
-        # if the number of filters is not a perfect square, we pad 
-        # the tensor so that we can display it in a square grid
+        # if the number of filters is not a perfect square, the grid
+        # is padded so that we can display it in a square grid
         s = self.compute_grid_size( nf )
-        npad = pow( s, 2, nf )
-        if npad:
-            weight = torch.cat( ( weight, torch.ones( ( npad, nc, h, w ) ) ), dim=0 ) #pylint: disable=no-member
-        
-        if zoom is None:
-            grid = torchvision.utils.make_grid( weight, nrow=s, padding=1 )
-        else:
-            grid = weight[ cursor ]
 
         window = self.fig.get_or_create_window()
+        rect = None
         if cursor is not None:
             x, y = ( h + 1 ) * ( cursor % s ), ( w + 1 ) * ( cursor // s )
             rect = ( ( x, y ), w + 1, h + 1 )
-            window.set_cursor( rect )
+
+        # The same grid is already on display, only the cursor moved
+        if rect is not None and zoom is None and window.grid is weight:
+            window.move_cursor( rect )
+            return True
+
+        if zoom is None:
+            grid = compose_grid( weight, nrow=s, padding=1 )
+        else:
+            grid = weight[ cursor ]
+
+        window.set_cursor( rect )
         window.add_title( title )
         window.add_image( grid )
         window.show()
+        window.grid = weight if zoom is None else None
+        return True
 
 
     def error( self, err_msg ):
@@ -1,12 +1,18 @@
 import os, sys
+import bisect
+import hashlib
+import json
 from pathlib import Path
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import logging
 logging.getLogger( "matplotlib" ).setLevel( logging.ERROR )
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib import cm, colors
 from mpl_toolkits.mplot3d import Axes3D  # noqa: F401 unused import
 import numpy as np
@@ -21,14 +27,57 @@ from PIL import Image
 # Disable the top menubar on plots
 matplotlib.rcParams[ "toolbar" ] = "None"
 
+def headless_display():
+    """True if no display is available, or headless mode is forced with PM_HEADLESS=1
+    """
+    if os.environ.get( "PM_HEADLESS" ) is not None:
+        return os.environ[ "PM_HEADLESS" ] == "1"
+    return sys.platform.startswith( "linux" ) and not ( os.environ.get( "DISPLAY" ) or
+                                                       os.environ.get( "WAYLAND_DISPLAY" ) )
+
+
+def compose_grid( weight, nrow, padding=1, pad_value=0 ):
+    """Tile a ( N x C x h x w ) tensor into a ( C x H x W ) grid image with nrow
+    tiles per row, using tensor reshapes only. The layout matches
+    torchvision.utils.make_grid. Missing tiles are filled with ones.
+    """
+    n, c, h, w = weight.size()
+    ncol = ( n + nrow - 1 ) // nrow
+    npad = nrow * ncol - n
+    if npad:
+        weight = torch.cat( ( weight, weight.new_ones( ( npad, c, h, w ) ) ), dim=0 )
+    # Pad every tile on the top and left, and the whole grid on the bottom and right
+    tiles = F.pad( weight, ( padding, 0, padding, 0 ), value=pad_value )
+    th, tw = h + padding, w + padding
+    grid = tiles.view( ncol, nrow, c, th, tw ).permute( 2, 0, 3, 1, 4 ).reshape( c, ncol * th, nrow * tw )
+    return F.pad( grid, ( 0, padding, 0, padding ), value=pad_value )
+
+
+def save_image( image, filename ):
+    """Write a ( C x H x W ) or ( H x W ) tensor to an image file, scaled by its range
+    """
+    image = image.detach().float()
+    if image.dim() == 3:
+        image = image.permute( 1, 2, 0 ).squeeze( 2 )
+    low, high = image.min(), image.max()
+    image = ( image - low ) / ( high - low ).clamp( min=1e-8 )
+    Image.fromarray( image.mul( 255 ).byte().numpy() ).save( filename )
+
+
 class Window( object ):
-    def __init__( self, ax ):
+    def __init__( self, ax, interactive=True, on_show=None ):
         self.ax = ax
+        self.interactive = interactive
+        self.on_show = on_show
         self.cursor = None
         self.background = None
         self.artists = []
+        self.bars = None
+        self.labels = []
+        self.grid = None
         self.ax.figure.canvas.draw()
-        self.ax.figure.show()
+        if self.interactive:
+            self.ax.figure.show()
 
     def set_cursor( self, rect ):
         if rect is not None:
@@ -38,6 +87,22 @@ class Window( object ):
                 self.cursor.remove()
             self.cursor = self.ax.add_patch( cursor )
 
+    def move_cursor( self, rect ):
+        """Move the cursor by restoring the saved background and redrawing only
+        the cursor, instead of redrawing the whole window
+        """
+        if self.background is None:
+            self.set_cursor( rect )
+            self.show()
+            return
+        canvas = self.ax.figure.canvas
+        canvas.restore_region( self.background )
+        self.set_cursor( rect )
+        self.ax.draw_artist( self.cursor )
+        canvas.blit( self.ax.bbox )
+        if self.on_show:
+            self.on_show()
+
     def add_title( self, t ):
         self.ax.set_title( t )
 
@@ -60,38 +125,90 @@ class Window( object ):
             kwargs[ "cmap" ] = "gray"
         self.artists.append( self.ax.imshow( image, **kwargs ) )
 
+    def bargraph( self, y, title=None, topk=5 ):
+        """Draw a bar graph of y, labelling the topk bars.
+        If the window already shows a bar graph of the same length, the bar
+        heights are updated in place instead of adding new bars.
+        """
+        y = torch.as_tensor( y ).float()
+        if self.bars is None or len( self.bars ) != len( y ):
+            self.clear()
+            self.bars = self.ax.bar( np.arange( len( y ) ), y.numpy(), align="center", width=1 )
+            self.ax.grid()
+        else:
+            for bar, h in zip( self.bars, y.tolist() ):
+                bar.set_height( h )
+            self.ax.relim()
+            self.ax.autoscale_view()
+
+        for label in self.labels:
+            label.remove()
+        val, id = y.topk( min( topk, len( y ) ), dim=0, largest=True, sorted=True )
+        self.labels = [ self.ax.text( i, v, "{}".format( i ) ) for i, v in zip( id.tolist(), val.tolist() ) ]
+        if title is not None:
+            self.ax.set_title( title )
+
     def show( self ):
+        canvas = self.ax.figure.canvas
         for a in self.artists:
             self.ax.draw_artist( a )
+        try:
+            self.background = canvas.copy_from_bbox( self.ax.bbox )
+        except AttributeError:
+            self.background = None
         if self.cursor:
             self.ax.draw_artist( self.cursor )
-        self.ax.figure.canvas.blit( self.ax.bbox )
-        self.ax.figure.show()
+        canvas.blit( self.ax.bbox )
+        if self.interactive:
+            self.ax.figure.show()
         self.artists = []
+        if self.on_show:
+            self.on_show()
 
     def clear( self ):
         self.ax.clear()
         self.artists = []
+        self.cursor = None
+        self.background = None
+        self.bars = None
+        self.labels = []
+        self.grid = None
 
 class GraphWindow( object ):
-    def __init__( self ):
-        self.fig = plt.figure()
+    """Figure with one or two windows to draw on.
+    In headless mode the figure is rendered off-screen with Agg, needs no
+    display, and can be written to files with save(). If autosave_dir is set,
+    every update of the figure is also written there as a numbered PNG.
+    """
+    def __init__( self, headless=None ):
+        self.headless = headless_display() if headless is None else headless
+        if self.headless:
+            self.fig = Figure()
+            FigureCanvasAgg( self.fig )
+        else:
+            self.fig = plt.figure()
         self.window_title = "PM Debug"
         self.cur_ax = None
         self.num_windows = 1
         self.windows = []
         self.cur_window = None
         self.mode = None
+        self.autosave_dir = None
+        self.autosave_count = 0
         self.set_window_title()
         self.set_mode( "single" )
-        self.fig.canvas.mpl_connect( "close_event", self.on_window_close )
+        if not self.headless:
+            self.fig.canvas.mpl_connect( "close_event", self.on_window_close )
 
     def set_window_title( self, title=None ):
         if title is None:
             t = self.window_title
         else:
             t = "{} ( {} )".format( self.window_title, title )
-        self.fig.canvas.set_window_title( t )
+        if self.headless:
+            self.fig.suptitle( t )
+        else:
+            self.fig.canvas.set_window_title( t )
 
     def reset_windows( self ):
         for window in self.windows:
@@ -112,7 +229,7 @@ class GraphWindow( object ):
     def init_windows( self ):
         self.fig.subplots( 1, self.num_windows )
         for i in range( self.num_windows ):
-            window = Window( self.fig.axes[ i ] )
+            window = Window( self.fig.axes[ i ], interactive=not self.headless, on_show=self.autosave )
             self.windows.append( window )
         self.cur_window = 0
 
@@ -141,12 +258,15 @@ class GraphWindow( object ):
         self.fig.canvas.stop_event_loop()
 
     def on_event( self, type, func ):
+        if self.headless:
+            return
         cid = self.fig.canvas.mpl_connect( type, func )
         self.fig.canvas.start_event_loop()
         self.fig.canvas.mpl_disconnect( cid )
 
     def stop_event_loop( self ):
-        self.fig.canvas.stop_event_loop()
+        if not self.headless:
+            self.fig.canvas.stop_event_loop()
 
     def imshow( self, image, title=None, rect=None, **kwargs ):
         window = self.get_or_create_window()
@@ -160,76 +280,316 @@ class GraphWindow( object ):
         ax = self.cur_ax if ax is None else ax
         ax.set_aspect( aspect )
         ax.figure.canvas.draw()
-        self.fig.show()
+        if not self.headless:
+            self.fig.show()
+        self.autosave()
+
+    def save( self, filename ):
+        self.fig.savefig( filename )
+
+    def autosave( self ):
+        if self.autosave_dir is None:
+            return
+        self.autosave_count += 1
+        self.save( os.path.join( self.autosave_dir, "fig_{:05d}.png".format( self.autosave_count ) ) )
 
     def close( self ):
-        plt.close()
+        if self.headless:
+            self.fig.clear()
+        else:
+            plt.close()
+
+
+class DatasetIndex( object ):
+    """Class directory to file list index of an image folder dataset.
+    The index is cached in ~/.cache/pm_shell and reused as long as the
+    modification time of the root and of each class directory is unchanged.
+    File lists of a class are read the first time the class is used.
+    """
+    def __init__( self, path, cache_dir=None ):
+        self.path = Path( path )
+        cache_dir = Path( cache_dir or os.path.join( Path.home(), ".cache", "pm_shell" ) )
+        key = hashlib.sha1( str( self.path.resolve() ).encode() ).hexdigest()
+        self.cache_file = cache_dir / "{}.json".format( key )
+        self.classes = []
+        self.files = {}
+        self.dirty = False
+        self.load()
+
+    def load( self ):
+        root_mtime = self.path.stat().st_mtime
+        try:
+            with open( self.cache_file ) as f:
+                cache = json.load( f )
+        except ( OSError, ValueError ):
+            cache = None
+
+        if cache is not None and cache[ "mtime" ] == root_mtime:
+            self.classes = cache[ "classes" ]
+            self.files = cache[ "files" ]
+        else:
+            self.classes = sorted( d.name for d in self.path.iterdir() if d.is_dir() )
+            self.files = {}
+            self.dirty = True
+        self.root_mtime = root_mtime
+
+    def save( self ):
+        if not self.dirty:
+            return
+        try:
+            self.cache_file.parent.mkdir( parents=True, exist_ok=True )
+            tmp = self.cache_file.with_suffix( ".tmp" )
+            with open( tmp, "w" ) as f:
+                json.dump( { "mtime": self.root_mtime, "classes": self.classes, "files": self.files }, f )
+            os.replace( tmp, self.cache_file )
+            self.dirty = False
+        except OSError:
+            pass
+
+    def __len__( self ):
+        return len( self.classes )
+
+    def class_dir( self, label ):
+        return self.path / self.classes[ label ]
+
+    def class_files( self, label ):
+        """Sorted list of file names in a class directory
+        """
+        name = self.classes[ label ]
+        path = self.path / name
+        mtime = path.stat().st_mtime
+        entry = self.files.get( name )
+        if entry is None or entry[ "mtime" ] != mtime:
+            files = sorted( f.name for f in os.scandir( path ) if f.is_file() )
+            self.files[ name ] = entry = { "mtime": mtime, "files": files }
+            self.dirty = True
+            self.save()
+        return entry[ "files" ]
 
 
 class Dataset( object ):
-    def __init__( self, path ):
+    """Image folder dataset browser for the shell.
+    Supports next/prev and random access within a class. The next few
+    images are decoded on a background thread, so stepping is instant.
+    """
+    def __init__( self, path, prefetch=4 ):
         self.data = None
         self.data_path = Path( path )
+        self.index = None
         self.cur_class = 0
         self.cur_dir = self.data_path
         self.cur_image_file = None
-        self.file_iter = None
+        self.cur_files = []
+        self.cur_pos = -1
         self.image_size = 224
         self.my_transforms = [ transforms.Resize( ( self.image_size, self.image_size ) ) ]
-        self.set_class( self.cur_class )
+        self.transform = None
+        self.prefetch = prefetch
+        self.executor = ThreadPoolExecutor( max_workers=1 )
+        self.pending = OrderedDict()
+        self.update_transform()
+        self.reindex()
+
+    def reindex( self ):
+        self.index = DatasetIndex( self.data_path )
+        return self.set_class( self.cur_class )
 
     def reset_class( self ):
-        self.file_iter.close()
-        self.file_iter = None
+        self.clear_prefetch()
+        self.cur_pos = -1
         self.cur_image_file = None
 
     def set_class( self, label ):
-        listdir = [ d for d in self.data_path.iterdir() if d.is_dir() ]
-        listdir.sort()
         label = int( label )
-        try:
-            dir = listdir[ label ]
-        except:
-            return False
-        path = self.data_path / dir
-        if path.is_dir():
-            self.cur_class = label
-            self.cur_dir = path
-            if self.file_iter:
-                self.reset_class()
-            return True
-        else:
+        if label < 0 or label >= len( self.index ):
             return False
+        self.cur_class = label
+        self.cur_dir = self.index.class_dir( label )
+        self.cur_files = self.index.class_files( label )
+        self.reset_class()
+        return True
 
-    def next( self ):
-        if self.file_iter is None:
-            self.file_iter = iter( Path( self.cur_dir ).iterdir() )
+    def files( self ):
+        """Full paths of all files in the current class
+        """
+        return [ self.cur_dir / f for f in self.cur_files ]
 
-        image_file = next( self.file_iter )
-        if image_file.is_file():
-            self.cur_image_file = image_file
-            return str( image_file ), image_file.name
-        else:
+    def __len__( self ):
+        return len( self.cur_files )
+
+    def seek( self, pos ):
+        """Select the image at position pos in the current class.
+        Returns ( path, name ), or ( None, None ) if pos is out of range.
+        """
+        if pos < 0 or pos >= len( self.cur_files ):
             return None, None
+        self.cur_pos = pos
+        self.cur_image_file = self.cur_dir / self.cur_files[ pos ]
+        self.schedule_prefetch()
+        return str( self.cur_image_file ), self.cur_image_file.name
+
+    def next( self ):
+        return self.seek( self.cur_pos + 1 )
+
+    def prev( self ):
+        return self.seek( self.cur_pos - 1 )
+
+    def decode( self, path ):
+        image = Image.open( path ).convert( "RGB" )
+        return transforms.ToTensor()( self.transform( image ) ).unsqueeze( 0 )
+
+    def schedule_prefetch( self ):
+        wanted = [ p for p in range( self.cur_pos, self.cur_pos + self.prefetch + 1 )
+                   if p < len( self.cur_files ) ]
+        for pos in list( self.pending ):
+            if pos not in wanted:
+                self.pending.pop( pos ).cancel()
+        for pos in wanted:
+            if pos not in self.pending:
+                self.pending[ pos ] = self.executor.submit( self.decode, self.cur_dir / self.cur_files[ pos ] )
+
+    def clear_prefetch( self ):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
 
     def load( self ):
-        image = Image.open( self.cur_image_file )
-        transform = transforms.Compose( self.my_transforms )
-        return transforms.ToTensor()( transform( image ) ).unsqueeze( 0 )
+        if self.cur_image_file is None:
+            return None
+        future = self.pending.get( self.cur_pos )
+        if future is not None and not future.cancelled():
+            return future.result()
+        return self.decode( self.cur_image_file )
 
     def suffix( self, suffix ):
         if suffix in ( "train", "val", "validation" ):
             self.data_path = self.data_path.parent / suffix
-            self.set_class( self.cur_class )
+            self.reindex()
             return True
         else:
             return False
 
+    def update_transform( self ):
+        self.transform = transforms.Compose( self.my_transforms )
+        self.clear_prefetch()
+
     def add_transform( self, t, index=1 ):
         self.my_transforms.append( t )
+        self.update_transform()
 
     def del_transform( self, index ):
         self.my_transforms.pop( index )
+        self.update_transform()
+
+    def close( self ):
+        self.clear_prefetch()
+        self.executor.shutdown( wait=False )
+
+
+class ModuleIndex( object ):
+    """Flattened, precomputed index of a model's module tree.
+    Modules are stored in depth first (pre-order) sequence. Each entry keeps
+    its path id, type, parent position and the end of its subtree, and the
+    positions of every type are kept in sorted lists, so first/last/next/prev
+    lookups are a dict access plus a bisect instead of a tree walk.
+    """
+    def __init__( self, model ):
+        self.ids = []
+        self.modules = []
+        self.types = []
+        self.parents = []
+        self.ends = []
+        self.positions = {}
+        self.by_type = {}
+        self.leaves = []
+        self._type_cache = {}
+        self.build( model )
+
+    def build( self, model ):
+        # Iterative DFS, the root itself is not indexed
+        stack = [ ( [ i ], m, -1 ) for i, m in reversed( list( enumerate( model.children() ) ) ) ]
+        open_nodes = []
+        while stack:
+            id, m, parent = stack.pop()
+            pos = len( self.ids )
+            # Close the subtrees that this node is not a part of
+            while open_nodes and open_nodes[ -1 ] != parent:
+                self.ends[ open_nodes.pop() ] = pos
+
+            self.ids.append( id )
+            self.modules.append( m )
+            self.types.append( type( m ) )
+            self.parents.append( parent )
+            self.ends.append( pos + 1 )
+            self.positions[ tuple( id ) ] = pos
+            self.by_type.setdefault( type( m ), [] ).append( pos )
+
+            children = list( m.children() )
+            if children:
+                open_nodes.append( pos )
+                stack.extend( ( id + [ i ], c, pos ) for i, c in reversed( list( enumerate( children ) ) ) )
+            else:
+                self.leaves.append( pos )
+        for pos in open_nodes:
+            self.ends[ pos ] = len( self.ids )
+
+    def __len__( self ):
+        return len( self.ids )
+
+    def positions_of( self, type=None ):
+        """Sorted positions of all modules that are instances of type.
+        If type is None, positions of all leaf modules are returned.
+        """
+        if type is None:
+            return self.leaves
+        if type not in self._type_cache:
+            pos = [ p for t, l in self.by_type.items() if issubclass( t, type ) for p in l ]
+            self._type_cache[ type ] = sorted( pos )
+        return self._type_cache[ type ]
+
+    def entry( self, pos ):
+        return self.ids[ pos ].copy(), self.modules[ pos ]
+
+    def find( self, id ):
+        pos = self.positions.get( tuple( id ) )
+        if pos is None:
+            return [], None
+        return self.entry( pos )
+
+    def parent( self, id ):
+        pos = self.positions.get( tuple( id ) )
+        if pos is None or self.parents[ pos ] < 0:
+            return [], None
+        return self.entry( self.parents[ pos ] )
+
+    def first( self, type=None ):
+        pos = self.positions_of( type )
+        return self.entry( pos[ 0 ] ) if pos else ( [], None )
+
+    def last( self, type=None ):
+        pos = self.positions_of( type )
+        return self.entry( pos[ -1 ] ) if pos else ( [], None )
+
+    def next( self, id, type=None ):
+        """Next module of the given type after id, skipping the subtree under id
+        """
+        cur = self.positions.get( tuple( id ) )
+        if cur is None:
+            return [], None
+        pos = self.positions_of( type )
+        i = bisect.bisect_left( pos, self.ends[ cur ] )
+        return self.entry( pos[ i ] ) if i < len( pos ) else ( [], None )
+
+    def prev( self, id, type=None ):
+        """Previous module of the given type before id
+        """
+        cur = self.positions.get( tuple( id ) )
+        if cur is None:
+            return [], None
+        pos = self.positions_of( type )
+        i = bisect.bisect_left( pos, cur )
+        return self.entry( pos[ i - 1 ] ) if i > 0 else ( [], None )
+
 
 class ModelMeta( object ):
     def __init__( self, model, name ):
@@ -237,8 +597,15 @@ class ModelMeta( object ):
         self.name = name
         self.cur_layer = None
         self.layers = OrderedDict()
+        self.index = None
+        self.reindex()
         self.init_layer()
 
+    def reindex( self ):
+        """Rebuild the module index. Must be called if the module tree changes
+        """
+        self.index = ModuleIndex( self.model )
+
     def init_layer( self ):
         id, layer = self.find_last_instance( layer=nn.ReLU )
         layer_info = LayerMeta( layer, id )
@@ -258,11 +625,11 @@ class ModelMeta( object ):
             self.layers[ tuple( id ) ] = layer_info
         return layer_info
 
-    def up( self ):
-        return self.traverse_updown( dir=-1 )
+    def up( self, type=None ):
+        return self.traverse_updown( dir=-1, type=type )
 
-    def down( self ):
-        return self.traverse_updown( dir=1 )
+    def down( self, type=None ):
+        return self.traverse_updown( dir=1, type=type )
 
     def traverse_updown( self, dir, type=None ):
         id = self.cur_layer.id
@@ -275,95 +642,38 @@ class ModelMeta( object ):
         self.cur_layer = self.get_layer_info( id, layer )
         return True
 
-    def set_first_layer( self ):
-        id, layer = self.find_first_instance( type=nn.Conv2d )
+    def set_first_layer( self, type=nn.Conv2d ):
+        id, layer = self.find_first_instance( type=type )
         if not id:
             return False
         self.cur_layer = self.get_layer_info( id, layer )
         return True
 
-    def find_first_instance( self, key=None, dir=0, type=None, net=None ):
-        """This function implements a depth first search that terminates 
-        as soon as a sufficient condition is met.
-        """
-        net = self.model if net is None else net
-
-        cur_frame = []
-        frame = []
-        leaf = None
-        terminate = False
-        terminate_next = False
-
-        def _recurse_layer( layer ):
-            nonlocal key
-            nonlocal cur_frame
-            nonlocal frame
-            nonlocal leaf
-            nonlocal terminate
-            nonlocal terminate_next
-
-            for i, m in enumerate( layer.children() ):
-                if terminate:
-                    break
-
-                cur_frame.append( i )
-
-                if cur_frame == key:
-                    if dir == -1:
-                        terminate = True
-                    elif dir == 1 and type is None:
-                        terminate_next = True
-                        frame = []
-                    elif dir == 1 and type is not None:
-                            key = None
-                    elif dir == 0:
-                        terminate = True
-                        frame, leaf = cur_frame.copy(), m
-                elif type is not None and isinstance( m, type ):
-                    if key is None:
-                        terminate = True
-                    frame, leaf = cur_frame.copy(), m
-                elif not list( m.children() ):
-                    # We don't have a key match, treat it like a normal iteration
-                    # If this is a leaf node, save it's location
-                    if type is None or isinstance( m, type ):
-                        frame, leaf = cur_frame.copy(), m
-                    terminate = terminate_next
-                else:
-                    # If this is not a leaf node, recurse into it
-                    _recurse_layer( m )
-
-                cur_frame.pop()       
-            return
-
-        _recurse_layer( net )
-        return frame, leaf
-
+    def set_last_layer( self, type=nn.Conv2d ):
+        id, layer = self.find_last_instance( layer=type )
+        if not id:
+            return False
+        self.cur_layer = self.get_layer_info( id, layer )
+        return True
 
-    def find_last_instance( self, layer=nn.Conv2d, net=None, cur_frame=[], found_frame=[] ):
-        """This method does a depth first search and finds the last instance of the
-        specifiied layer in the tree
+    def find_first_instance( self, key=None, dir=0, type=None ):
+        """Look up a layer in the module index.
+        With no key, return the first instance of type (or the first leaf).
+        With a key, dir=-1/1 returns the previous/next instance of type (or leaf)
+        relative to key, and dir=0 returns the layer at key.
         """
-        net = self.model if net is None else net
-        
-        found = None
-        ret_found = None
-
-        for i, l in enumerate( net.children() ):
-            cur_frame.append( i )
-
-            if isinstance( l, layer ):
-                found = l
-                if cur_frame > found_frame:
-                    found_frame = cur_frame.copy()
-
-            found_frame, ret_found = self.find_last_instance( layer=layer, net=l,
-                                                            cur_frame=cur_frame, 
-                                                            found_frame=found_frame )
-            if isinstance( ret_found, layer ):
-                found = ret_found
-            cur_frame.pop()
-        return found_frame, found
+        if key is None:
+            return self.index.first( type )
+        if dir == -1:
+            return self.index.prev( key, type )
+        if dir == 1:
+            return self.index.next( key, type )
+        return self.index.find( key )
+
+    def find_last_instance( self, layer=nn.Conv2d ):
+        """Return the last instance of the specified layer type in the tree
+        """
+        return self.index.last( layer )
 
 
 class LayerMeta( object ):
@@ -371,6 +681,7 @@ class LayerMeta( object ):
         self.layer = layer
         self.id = id
         self.out = None
+        self.fhook = None
         self.post_process_fn = None
         self.cur_filter = 0
         self.num_filters = None
@@ -384,10 +695,20 @@ class LayerMeta( object ):
             self.num_filters = None
 
     def register_forward_hook( self, hook_fn=None ):
+        """Attach a persistent forward hook to the layer.
+        Any hook registered earlier through this method is removed first.
+        Prefer ShellBase.capture_activations for one-off captures.
+        """
         if hook_fn is None:
             hook_fn = self.fhook_fn
+        self.remove_forward_hook()
         self.fhook = self.layer.register_forward_hook( hook_fn )
 
+    def remove_forward_hook( self ):
+        if self.fhook is not None:
+            self.fhook.remove()
+            self.fhook = None
+
     def fhook_fn( self, layer, input, output ):
         self.out = output.clone().detach()
 
@@ -435,4 +756,4 @@ class LayerMeta( object ):
             self.cur_filter = 0
 
     def close( self ):
-        self.fhook.remove()
+        self.remove_forward_hook()
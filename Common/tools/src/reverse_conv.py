@@ -1,114 +1,182 @@
+import argparse
+
 import torch
-import torch.nn as nn
-from torchvision.models import *
-import matplotlib
+import torch.nn.functional as F
 import matplotlib.pyplot as plt
-import numpy as np
-import cv2
-import os
-from collections import OrderedDict
-
-from Affine.Vision.classification.src.darknet53 import darknet
-from train_utils import load_checkpoint
-
-#matplotlib.rcParams[ "toolbar" ] = "None"
 
-#net = resnet101( pretrained=True ).cpu().eval()
-net = darknet().cpu().eval()
+from pm_helper_classes import ModelMeta, compose_grid, save_image
 
-layer = 0
-filter = 402
 
-class SaveParams( object ):
-    def __init__( self, module ):
-        self.hook = module.register_forward_hook( self.hook_fn )
-
-    def hook_fn( self, module, input, output ):
-        self.params = output.clone()
-
-    def remove_hook( self ):
-        self.hook.remove()
+class StopForward( Exception ):
+    """Raised from the forward hook to skip the layers after the target layer
+    """
+    pass
 
 
 class ReverseConv( object ):
-    def __init__( self, size=224 ):
-        global net
+    """Activation maximization for the filters of one layer.
+    All requested filters are optimized together, one input image per filter,
+    so every step is a single forward/backward pass over a batch. Jitter and
+    blur regularizers are plain tensor ops.
+
+    Inputs:
+        model_info: ModelMeta of the model
+        id: path id of the layer in the model's module index
+    """
+    def __init__( self, model_info, id, size=224 ):
+        self.model_info = model_info
+        self.id = list( id )
         self.size = size
-        self.disable_grads( net )
-        self.checkpoint_path = "/home/vipul/Affine/Vision/classification/train/checkpoint"
-        self.checkpoint_name = "checkpoint.pth.tar"
-        load_checkpoint( net, os.path.join( self.checkpoint_path, self.checkpoint_name ) )
-
-    def visualize( self, layer, filter, lr=0.01 ):
-        print( "filter: {}, lr: {}".format( filter, lr ) )
-        module = list( net.children() )[ layer ][28].relu
-        print( module )
-        activations = SaveParams( module )        
-
-
-        upscale_steps = 15
-        steps = 100
-        disp_every = 100
-        upscale_factor = 1.15
-        display_later = True
-        blur = 5
-
-        nplots = 1 if display_later else upscale_steps
-        fig = plt.figure()
-        ax = fig.subplots( 1, nplots )
-
-
-        s = self.size
-        img = np.random.rand( s, s )
-
-        for i in range( upscale_steps ):
-            #img = img.transpose( 2, 0, 1 )
-            img = torch.tensor( [ img ], dtype=torch.float32, requires_grad=True )
-
-            optimizer = torch.optim.Adam( [ img ], lr=lr )
-
-            for j in range( 1, steps + 1 ):
-                #bn_img = nn.BatchNorm2d( 3, track_running_stats=False, momentum=0 )( img )
-                bn_img = nn.BatchNorm2d( 1, track_running_stats=False, momentum=0 )( img )
-                
-                net( bn_img )
-                loss = -activations.params[ 0, filter ].mean()
-
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-
-                if ( i * steps + j ) % disp_every == 0:
-                    print( "Iter: {}\tloss: {}\tinput: {}".format( i, loss.item(), img.detach().mean() ) )
-
-            s = int( s * upscale_factor )
-            img = img.detach().data.numpy()[ 0 ].transpose( 1, 2, 0 )
-            #img = cv2.resize( img, ( s, s ), interpolation = cv2.INTER_CUBIC )
-            if blur:
-                img = cv2.blur( img, ( blur, blur ) )
-
-            if not display_later and nplots > 1:
-                ax[ i ].imshow( img )
-        
-        if display_later:
-            #img = img - np.min( img, keepdims=2 )
-            ax.imshow( img )           
-
-        fig.tight_layout()
-        fig.show()
-
-        activations.remove_hook()
-        torch.save( { "image": img, "optimizer": optimizer.state_dict() }, "reverse.chkpoint.tar" )
-        input( "Press Enter to end..." )
-        
-    def show_img( self, image ):
-        img = image.squeeze( 0 ).permute( 1, 2, 0 )
-        plt.imshow( img.detach() )
-        plt.show( block=False )
-
-    def disable_grads( self, model ):
-        for param in model.parameters():
-            param.requires_grad = False
+        _, self.layer = model_info.index.find( id )
+        if self.layer is None:
+            raise ValueError( "No layer at {}".format( id ) )
+        # A module that is used at several places in the model, like a shared
+        # activation, is called more than once per forward pass. Find which call
+        # is the one at id, the first one while its parent runs, so the forward
+        # pass can be cut short right after it.
+        self.shared = sum( m is self.layer for m in model_info.index.modules ) > 1
+        self.call = 0
+        self.channels = None
+        if self.shared:
+            self.call, self.channels = self._probe()
+        self.out = None
+
+    def _probe( self ):
+        """Call number and output channels of the shared layer at self.id
+        """
+        _, parent = self.model_info.index.parent( self.id )
+        model = self.model_info.model
+        if parent is None:
+            # A child of the model itself
+            parent = model
+        state = { "active": False, "calls": 0, "found": None }
+
+        def enter( module, input ):
+            state[ "active" ] = True
+
+        def leave( module, input, output ):
+            state[ "active" ] = False
+
+        def hook( module, input, output ):
+            if state[ "active" ] and state[ "found" ] is None:
+                state[ "found" ] = ( state[ "calls" ], output.size( 1 ) )
+            state[ "calls" ] += 1
+
+        hooks = [ parent.register_forward_pre_hook( enter ), parent.register_forward_hook( leave ),
+                  self.layer.register_forward_hook( hook ) ]
+        training = model.training
+        model.eval()
+        try:
+            with torch.no_grad():
+                device = next( model.parameters() ).device
+                model( torch.zeros( ( 1, 3, self.size, self.size ), device=device ) )
+        finally:
+            for h in hooks:
+                h.remove()
+            model.train( training )
+        if state[ "found" ] is None:
+            raise ValueError( "Layer at {} is not called in the forward pass".format( self.id ) )
+        return state[ "found" ]
+
+    def _hook_fn( self, layer, input, output ):
+        if self.calls == self.call:
+            if self.channels is not None and output.size( 1 ) != self.channels:
+                raise RuntimeError( "Captured {} channels at call {} of the layer at {}, expected {}".format(
+                                        output.size( 1 ), self.call, self.id, self.channels ) )
+            self.out = output
+            raise StopForward()
+        self.calls += 1
+
+    def forward( self, images ):
+        self.out = None
+        self.calls = 0
+        hook = self.layer.register_forward_hook( self._hook_fn )
+        try:
+            self.model_info.model( images )
+        except StopForward:
+            pass
+        finally:
+            hook.remove()
+        return self.out
+
+    def visualize( self, filters, steps=100, upscale_steps=15, upscale_factor=1.15, lr=0.01,
+                   jitter=8, blur=5, log=print ):
+        """Optimize one input image per filter to maximize the filter's mean activation.
+        Optimization starts at a small size and is upscaled upscale_steps times by
+        upscale_factor, ending at self.size. A box blur of size blur is applied
+        after each upscale. Returns a ( F x 3 x size x size ) tensor.
+        """
+        model = self.model_info.model
+        training = model.training
+        model.eval()
+        requires_grad = [ p.requires_grad for p in model.parameters() ]
+        for p in model.parameters():
+            p.requires_grad = False
+
+        device = next( model.parameters() ).device
+        filters = torch.as_tensor( filters, device=device )
+        n = len( filters )
+        sizes = [ int( self.size / pow( upscale_factor, upscale_steps - i ) ) for i in range( upscale_steps + 1 ) ]
+
+        img = torch.rand( ( n, 3, sizes[ 0 ], sizes[ 0 ] ), device=device )
+        try:
+            for i, s in enumerate( sizes ):
+                if i > 0:
+                    img = F.interpolate( img, size=( s, s ), mode="bicubic", align_corners=False )
+                    if blur:
+                        img = F.avg_pool2d( img, blur, stride=1, padding=blur // 2, count_include_pad=False )
+                img = img.detach().requires_grad_( True )
+                optimizer = torch.optim.Adam( [ img ], lr=lr )
+
+                for j in range( steps ):
+                    x = img
+                    if jitter:
+                        dx, dy = torch.randint( -jitter, jitter + 1, ( 2, ) ).tolist()
+                        x = torch.roll( x, shifts=( dx, dy ), dims=( 2, 3 ) )
+                    # Normalize each image on its own, like a BatchNorm over a single image
+                    x = F.instance_norm( x )
+
+                    out = self.forward( x )
+                    acts = out[ torch.arange( n, device=device ), filters ]
+                    loss = -acts.flatten( 1 ).mean( dim=1 ).sum()
+
+                    optimizer.zero_grad()
+                    loss.backward()
+                    optimizer.step()
+
+                log( "Size {}/{} ({}px)\tloss: {:.4f}".format( i + 1, len( sizes ), s, loss.item() / n ) )
+        finally:
+            for p, r in zip( model.parameters(), requires_grad ):
+                p.requires_grad = r
+            model.train( training )
+
+        return img.detach()
+
+    def save( self, images, filters, filename ):
+        """Save the images to filename.pth and a grid of all of them to filename.png
+        """
+        torch.save( { "layer": self.id, "filters": list( filters ), "images": images.cpu() },
+                    "{}.pth".format( filename ) )
+        # Normalize each image by its own range before tiling
+        flat = images.flatten( 1 )
+        low = flat.min( dim=1 )[ 0 ].view( -1, 1, 1, 1 )
+        high = flat.max( dim=1 )[ 0 ].view( -1, 1, 1, 1 )
+        images = ( images - low ) / ( high - low ).clamp( min=1e-8 )
+        nrow = int( pow( len( images ) - 1, 0.5 ) ) + 1
+        save_image( compose_grid( images.cpu(), nrow=nrow, padding=2 ), "{}.png".format( filename ) )
+
+
+def parse_filters( args ):
+    """Parse a filter list like "0-15" or "3,7,12"
+    """
+    filters = []
+    for part in args.split( "," ):
+        if "-" in part:
+            start, end = part.split( "-" )
+            filters.extend( range( int( start ), int( end ) + 1 ) )
+        elif part:
+            filters.append( int( part ) )
+    return filters
 
 
 def plot_grad( model ):
@@ -124,5 +192,35 @@ def plot_grad( model ):
     plt.grid( True )
     plt.show( block=False )
 
-reverse = ReverseConv()
-reverse.visualize( layer, filter )
\ No newline at end of file
+
+def main():
+    from Affine.Vision.classification.src.darknet53 import darknet
+    from train_utils import load_checkpoint
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument( "--checkpoint", type=str, default="checkpoint/checkpoint.pth.tar",
+                         help="checkpoint to load into the model" )
+    parser.add_argument( "--layer", type=str, default=None,
+                         help="layer path id, e.g. 0,28,4. Defaults to the last ReLU" )
+    parser.add_argument( "--filters", type=str, default="0-15",
+                         help="filters to visualize, e.g. 0-15 or 3,7,12" )
+    parser.add_argument( "--size", type=int, default=224 )
+    parser.add_argument( "--steps", type=int, default=100 )
+    parser.add_argument( "--upscale-steps", type=int, default=15 )
+    parser.add_argument( "--lr", type=float, default=0.01 )
+    parser.add_argument( "--output", type=str, default="reverse" )
+    args = parser.parse_args()
+
+    net = darknet().eval()
+    load_checkpoint( net, args.checkpoint )
+    model_info = ModelMeta( net, "darknet" )
+    id = [ int( i ) for i in args.layer.split( "," ) ] if args.layer else model_info.cur_layer.id
+
+    filters = parse_filters( args.filters )
+    reverse = ReverseConv( model_info, id, size=args.size )
+    images = reverse.visualize( filters, steps=args.steps, upscale_steps=args.upscale_steps, lr=args.lr )
+    reverse.save( images, filters, args.output )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import time
+
+import torch
+from torchvision import transforms
+from PIL import Image
+
+from activation_capture import ActivationCapture
+from cam import CamEngine
+
+
+class ImageFiles( torch.utils.data.Dataset ):
+    """Minimal dataset over a list of image files, used to decode images
+    on background DataLoader workers. transform makes the image tensor, a
+    resize to image_size if not given
+    """
+    def __init__( self, files, image_size=224, transform=None ):
+        self.files = [ str( f ) for f in files ]
+        self.transform = transform or transforms.Compose( [ transforms.Resize( ( image_size, image_size ) ),
+                                                            transforms.ToTensor() ] )
+
+    def __len__( self ):
+        return len( self.files )
+
+    def __getitem__( self, index ):
+        image = Image.open( self.files[ index ] ).convert( "RGB" )
+        return self.transform( image ), index
+
+
+class DatasetSweep( object ):
+    """Run a list of images through a model in batches and record, for every image:
+        the top-k predictions,
+        per-channel mean and max of the activations of one layer,
+        a low resolution class activation map for the top-1 class.
+    Grad-CAM is used for models without a global pooling layer.
+    The results are saved to a single file that can be paged through with SweepResult.
+    Give the transform the shell applies to single images, so that both agree.
+    """
+    def __init__( self, model_info, layer_info, batch_size=32, workers=4, image_size=224, topk=5, transform=None ):
+        self.model_info = model_info
+        self.layer_info = layer_info
+        self.batch_size = batch_size
+        self.workers = workers
+        self.image_size = image_size
+        self.topk = topk
+        self.transform = transform
+
+    def run( self, files, filename, log=print ):
+        model = self.model_info.model
+        device = next( model.parameters() ).device
+
+        engine = CamEngine( self.model_info )
+        method = "cam" if engine.gap else "gradcam"
+
+        loader = torch.utils.data.DataLoader( ImageFiles( files, self.image_size, self.transform ),
+                                              batch_size=self.batch_size,
+                                              shuffle=False,
+                                              num_workers=self.workers )
+
+        layers = [ ( self.layer_info.id, self.layer_info.layer ) ]
+        probs, classes, means, maxs, cams = [], [], [], [], []
+
+        t0 = time.time()
+        for images, _ in loader:
+            with ActivationCapture( layers ) as capture:
+                # Maps only for the top-1 class, Grad-CAM needs a backward pass per class
+                maps, _, p = engine.compute( images.to( device ), topk=1, method=method, upsample=False,
+                                             all_probs=True )
+            p, c = p.topk( self.topk, dim=1 )
+            probs.append( p.cpu() )
+            classes.append( c.cpu() )
+
+            act = capture[ self.layer_info.id ].flatten( 2 )
+            means.append( act.mean( dim=2 ).cpu() )
+            maxs.append( act.max( dim=2 )[ 0 ].cpu() )
+
+            cams.append( maps[ :, 0 ].half().cpu() )
+            log( "{}/{} images".format( sum( len( x ) for x in probs ), len( loader.dataset ) ) )
+
+        result = { "model"      : self.model_info.name,
+                   "layer"      : list( self.layer_info.id ),
+                   "files"      : loader.dataset.files,
+                   "probs"      : torch.cat( probs ),
+                   "classes"    : torch.cat( classes ),
+                   "mean"       : torch.cat( means ),
+                   "max"        : torch.cat( maxs ),
+                   "cam"        : torch.cat( cams ),
+                 }
+        torch.save( result, filename )
+        log( "Sweep of {} images done in {:.1f}s, saved to {}".format( len( files ), time.time() - t0, filename ) )
+        return SweepResult( result )
+
+
+class SweepResult( object ):
+    """Indexed access to a saved sweep
+    """
+    def __init__( self, result ):
+        self.result = result
+        self.cur = -1
+
+    @classmethod
+    def load( cls, filename ):
+        return cls( torch.load( filename, map_location="cpu" ) )
+
+    def __len__( self ):
+        return len( self.result[ "files" ] )
+
+    def __getitem__( self, index ):
+        r = self.result
+        return { "file"     : r[ "files" ][ index ],
+                 "probs"    : r[ "probs" ][ index ],
+                 "classes"  : r[ "classes" ][ index ],
+                 "mean"     : r[ "mean" ][ index ],
+                 "max"      : r[ "max" ][ index ],
+                 "cam"      : r[ "cam" ][ index ].float(),
+               }
+
+    def seek( self, index ):
+        if index < 0 or index >= len( self ):
+            return None
+        self.cur = index
+        return self[ index ]
+
+    def next( self ):
+        return self.seek( self.cur + 1 )
+
+    def prev( self ):
+        return self.seek( self.cur - 1 )
@@ -1,10 +1,20 @@
 from torchvision import transforms, datasets
+import os
+import fcntl
+import hashlib
+import random
 import torch
 import numpy as np
 import matplotlib.pyplot as plt
+from PIL import Image
+import torchvision.transforms.functional as TF
 
 
 class data_prefetcher( object ):
+    """Copy the next batch to the GPU on a side stream while the current one is used.
+    Batches of more than two items, like ( images, targets, index ), are passed
+    through with the extra items left on the CPU.
+    """
     def __init__( self, loader ):
         self.loader = iter( loader )
         self.stream = torch.cuda.Stream()
@@ -12,12 +22,15 @@ class data_prefetcher( object ):
 
     def preload(self):
         try:
-            self.next_input, self.next_target = next( self.loader )
+            batch = next( self.loader )
         except StopIteration:
             self.next_input = None
             self.next_target = None
+            self.next_extra = ()
             return
 
+        self.next_input, self.next_target = batch[ 0 ], batch[ 1 ]
+        self.next_extra = tuple( batch[ 2: ] )
         with torch.cuda.stream( self.stream ):
             self.next_input = self.next_input.cuda( non_blocking=True ).float()
             self.next_target = self.next_target.cuda( non_blocking=True )
@@ -29,6 +42,7 @@ class data_prefetcher( object ):
         torch.cuda.current_stream().wait_stream( self.stream )
         input = self.next_input
         target = self.next_target
+        extra = self.next_extra
         if input is not None:
             input.record_stream( torch.cuda.current_stream() )
         else:
@@ -36,7 +50,273 @@ class data_prefetcher( object ):
         if target is not None:
             target.record_stream( torch.cuda.current_stream() )
         self.preload()
-        return input, target
+        return ( input, target ) + extra
+
+
+def loader_settings( args ):
+    """DataLoader worker and memory arguments from the command line. Memory is
+    pinned only if there is a GPU to copy the batches to
+    """
+    settings = { "num_workers": args.workers, "pin_memory": torch.cuda.is_available() }
+    if args.workers > 0:
+        settings[ "prefetch_factor" ] = getattr( args, "prefetch_factor", 2 )
+        settings[ "persistent_workers" ] = getattr( args, "persistent_workers", False )
+    return settings
+
+
+def seed_worker( worker_id ):
+    """DataLoader worker_init_fn. torch is seeded by the loader with its base
+    seed plus the worker id, numpy and random get the same seed
+    """
+    seed = torch.initial_seed() % 2**32
+    np.random.seed( seed )
+    random.seed( seed )
+
+
+def seed_loader( loader, seed, epoch, rank=0 ):
+    """Makes the next pass over a loader reproducible. The base seed of its
+    workers, and the shuffling of a plain RandomSampler, derive from seed,
+    epoch and rank, each worker adds its id. A DistributedSampler already
+    shuffles from its seed and epoch. Use with worker_init_fn=seed_worker.
+    Persistent workers are seeded once, for the first epoch, and carry their
+    random state over to the next ones.
+    """
+    derived = int( np.random.SeedSequence( [ seed, epoch, rank ] ).generate_state( 1 )[ 0 ] )
+    loader.generator = torch.Generator().manual_seed( derived )
+    if isinstance( loader.sampler, torch.utils.data.RandomSampler ):
+        loader.sampler.generator = loader.generator
+    return loader
+
+
+class SampleDataset( torch.utils.data.Dataset ):
+    """Dataset over a list of ( path, target ) samples, with the same classes,
+    class_to_idx, samples and targets attributes as ImageFolder.
+    With with_index, items are ( image, target, sample index ), so per-sample
+    state like cached teacher logits can be looked up.
+    """
+    def __init__( self, samples, classes, transform=None, with_index=False, loader=None ):
+        self.classes = classes
+        self.class_to_idx = { cls: i for i, cls in enumerate( classes ) }
+        self.samples = samples
+        self.targets = [ t for _, t in samples ]
+        self.transform = transform
+        self.with_index = with_index
+        self.loader = loader or datasets.folder.default_loader
+
+    def __len__( self ):
+        return len( self.samples )
+
+    def __getitem__( self, index ):
+        path, target = self.samples[ index ]
+        image = self.loader( path )
+        if self.transform is not None:
+            image = self.transform( image )
+        if self.with_index:
+            return image, target, index
+        return image, target
+
+
+class ManifestDataset( SampleDataset ):
+    """Images listed in a manifest with one "<path>\t<class>" line per image,
+    paths relative to the manifest. Classes and targets are ordered like in
+    ImageFolder, so the two can be used interchangeably.
+    """
+    def __init__( self, manifest, transform=None, with_index=False, loader=None ):
+        self.root = os.path.dirname( os.path.abspath( manifest ) )
+
+        entries = []
+        with open( manifest ) as f:
+            for line in f:
+                line = line.rstrip( "\n" )
+                if line:
+                    path, cls = line.split( "\t" )
+                    entries.append( ( os.path.join( self.root, path ), cls ) )
+
+        classes = sorted( set( cls for _, cls in entries ) )
+        class_to_idx = { cls: i for i, cls in enumerate( classes ) }
+        samples = [ ( path, class_to_idx[ cls ] ) for path, cls in entries ]
+        super().__init__( samples, classes, transform, with_index, loader )
+
+
+class FolderIndex( object ):
+    """Binary cache of the scan of a class folder tree, so that it is walked
+    once rather than by every process that builds a loader.
+    The cache holds the class names, one label per image, all relative image
+    paths as a single newline separated blob, and the mtime of every directory
+    of the tree. It is rebuilt when any of those directories changed, which
+    happens whenever a file is added, removed or renamed in it.
+    Processes on one machine share the cache. The first one to need a
+    rebuild holds a file lock while scanning and the others wait for it.
+    """
+    version = 1
+
+    def __init__( self, root, cache_dir=None ):
+        self.root = os.path.abspath( os.path.expanduser( root ) )
+        cache_dir = cache_dir or os.path.join( os.path.expanduser( "~" ), ".cache", "affine" )
+        os.makedirs( cache_dir, exist_ok=True )
+        key = hashlib.sha1( self.root.encode() ).hexdigest()[ :16 ]
+        self.filename = os.path.join( cache_dir, "folder_index_{}.npz".format( key ) )
+
+    @staticmethod
+    def _mtime( path ):
+        try:
+            return os.stat( path ).st_mtime_ns
+        except OSError:
+            return -1
+
+    def valid( self, index ):
+        if int( index[ "version" ] ) != self.version or str( index[ "root" ] ) != self.root:
+            return False
+        dirs = index[ "dirs" ]
+        mtimes = index[ "mtimes" ]
+        return all( self._mtime( os.path.join( self.root, d ) ) == m for d, m in zip( dirs, mtimes ) )
+
+    def scan( self ):
+        """Walk the tree like ImageFolder does. Returns the classes, the relative
+        paths, the labels and the mtimes of all directories.
+        """
+        classes = sorted( e.name for e in os.scandir( self.root ) if e.is_dir() )
+        if not classes:
+            raise FileNotFoundError( "No class folders found in {}".format( self.root ) )
+        dirs = [ "." ]
+        mtimes = [ self._mtime( self.root ) ]
+        paths, labels = [], []
+        for label, cls in enumerate( classes ):
+            for dirpath, dirnames, filenames in sorted( os.walk( os.path.join( self.root, cls ), followlinks=True ) ):
+                rel = os.path.relpath( dirpath, self.root )
+                dirs.append( rel )
+                mtimes.append( self._mtime( dirpath ) )
+                for name in sorted( filenames ):
+                    if datasets.folder.has_file_allowed_extension( name, datasets.folder.IMG_EXTENSIONS ):
+                        paths.append( os.path.join( rel, name ) )
+                        labels.append( label )
+        return classes, paths, labels, dirs, mtimes
+
+    def write( self, classes, paths, labels, dirs, mtimes ):
+        tmp = self.filename + ".tmp.npz"
+        np.savez( tmp,
+                  version=np.array( self.version ),
+                  root=np.array( self.root ),
+                  classes=np.array( classes ),
+                  paths=np.frombuffer( "\n".join( paths ).encode(), dtype=np.uint8 ),
+                  labels=np.array( labels, dtype=np.int32 ),
+                  dirs=np.array( dirs ),
+                  mtimes=np.array( mtimes, dtype=np.int64 ) )
+        os.replace( tmp, self.filename )
+
+    def read( self ):
+        try:
+            with np.load( self.filename ) as index:
+                index = { key: index[ key ] for key in index.files }
+        except ( OSError, ValueError, KeyError ):
+            return None
+        return index if self.valid( index ) else None
+
+    def load( self ):
+        """Returns the classes and the ( path, label ) samples of the tree
+        """
+        index = self.read()
+        if index is None:
+            with open( self.filename + ".lock", "w" ) as lock:
+                fcntl.flock( lock, fcntl.LOCK_EX )
+                # Another process may have rebuilt it while we waited for the lock
+                index = self.read()
+                if index is None:
+                    print( "Indexing {}".format( self.root ) )
+                    self.write( *self.scan() )
+                    index = self.read()
+                fcntl.flock( lock, fcntl.LOCK_UN )
+
+        classes = index[ "classes" ].tolist()
+        blob = index[ "paths" ].tobytes().decode()
+        paths = blob.split( "\n" ) if blob else []
+        samples = [ ( os.path.join( self.root, p ), l ) for p, l in zip( paths, index[ "labels" ].tolist() ) ]
+        return classes, samples
+
+
+class CachedImageFolder( SampleDataset ):
+    """Drop-in replacement for ImageFolder that reads its file list from a FolderIndex
+    """
+    def __init__( self, root, transform=None, with_index=False, loader=None, cache_dir=None ):
+        self.root = root
+        classes, samples = FolderIndex( root, cache_dir ).load()
+        super().__init__( samples, classes, transform, with_index, loader )
+
+
+def image_dataset( path, transform, with_index=False, loader=None ):
+    """ManifestDataset if path is a manifest file, CachedImageFolder if it is a folder
+    """
+    if os.path.isfile( path ):
+        return ManifestDataset( path, transform=transform, with_index=with_index, loader=loader )
+    return CachedImageFolder( path, transform=transform, with_index=with_index, loader=loader )
+
+
+###################################
+#  Reduced size JPEG decoding
+###################################
+def open_image( path ):
+    """Open an image without decoding it. Only the header is read, so a draft
+    transform can still pick a reduced decode size. The draft transforms
+    below must come first in the pipeline, they decode and convert to RGB.
+    """
+    return Image.open( path )
+
+
+def _pil_interpolation( interpolation ):
+    return TF.pil_modes_mapping.get( interpolation, interpolation ) \
+                if hasattr( TF, "pil_modes_mapping" ) else interpolation
+
+
+def decode_draft( image, size ):
+    """Decode image at the smallest JPEG DCT scale ( 1/2, 1/4 or 1/8 ) that is
+    still at least size = ( w, h ). Other formats are decoded at full size.
+    Returns the RGB image and its x and y scale relative to the original.
+    """
+    width, height = image.size
+    # draft() does nothing for other formats or an image that is already decoded
+    image.draft( "RGB", ( max( int( size[ 0 ] ), 1 ), max( int( size[ 1 ] ), 1 ) ) )
+    image = image.convert( "RGB" )
+    return image, image.size[ 0 ] / width, image.size[ 1 ] / height
+
+
+class DraftRandomResizedCrop( transforms.RandomResizedCrop ):
+    """RandomResizedCrop that decodes JPEGs at a reduced size.
+    The crop is sampled on the full resolution image exactly like
+    RandomResizedCrop does, then the image is decoded at the smallest DCT scale
+    at which the crop still has at least the output resolution, and the crop
+    box is mapped to that scale. The augmentation distribution is unchanged;
+    only the source pixels of the final resize come from a smaller decode.
+    """
+    def forward( self, image ):
+        if not isinstance( image, Image.Image ):
+            return super().forward( image )
+
+        top, left, height, width = self.get_params( image, self.scale, self.ratio )
+        out_h, out_w = self.size
+        # Largest reduction at which the crop still covers the output size
+        reduce = max( 1.0, min( width / out_w, height / out_h ) )
+        image, sx, sy = decode_draft( image, ( image.size[ 0 ] / reduce, image.size[ 1 ] / reduce ) )
+
+        box = ( left * sx, top * sy, ( left + width ) * sx, ( top + height ) * sy )
+        return image.resize( ( out_w, out_h ), resample=_pil_interpolation( self.interpolation ), box=box )
+
+
+class DraftResize( transforms.Resize ):
+    """Resize that decodes JPEGs at the smallest DCT scale that is still at
+    least the target size, then resizes as usual
+    """
+    def forward( self, image ):
+        if not isinstance( image, Image.Image ):
+            return super().forward( image )
+
+        width, height = image.size
+        if isinstance( self.size, int ) or len( self.size ) == 1:
+            short = self.size if isinstance( self.size, int ) else self.size[ 0 ]
+            target = ( width * short / min( width, height ), height * short / min( width, height ) )
+        else:
+            target = ( self.size[ 1 ], self.size[ 0 ] )
+        image, _, _ = decode_draft( image, target )
+        return super().forward( image )
 
 
 ###################################
@@ -46,79 +326,204 @@ class data_prefetcher( object ):
 #                                    [ 0.225, 0.225, 0.225 ] )
 normalize = transforms.Normalize( [ 0.485, 0.456, 0.406 ],
                                  [ 0.229, 0.224, 0.225 ] )
-def load_imagenet_data( path, args, hyper, distributed ):
+def load_imagenet_data( path, args, hyper, distributed, with_index=False, image_size=224 ):
     """Training set preprocessing and loader
+    With with_index, batches are ( images, targets, sample indices )
     """
-    transform = transforms.Compose( [ transforms.RandomResizedCrop( 224 ),
+    transform = transforms.Compose( [ DraftRandomResizedCrop( image_size ),
                                       transforms.RandomHorizontalFlip(),
                                       #transforms.Grayscale( num_output_channels=3 ),
                                       transforms.ToTensor(),
                                       normalize 
                                     ] )
 
-    dataset = datasets.ImageFolder( path, transform=transform )
+    dataset = image_dataset( path, transform, with_index, loader=open_image )
 
     if distributed:
-        train_sampler = torch.utils.data.distributed.DistributedSampler( dataset )
+        train_sampler = torch.utils.data.distributed.DistributedSampler( dataset, seed=getattr( args, "seed", 0 ) )
     else:
         train_sampler = None
 
     return torch.utils.data.DataLoader( dataset, 
                                         batch_size=hyper.batch_size, 
                                         shuffle=( train_sampler is None ),
-                                        num_workers=args.workers,
-                                        pin_memory=True,
-                                        sampler=train_sampler
+                                        sampler=train_sampler,
+                                        worker_init_fn=seed_worker,
+                                        **loader_settings( args )
                                         )
 
-def load_imagenet_val( path, args, hyper, distributed ):
+def load_imagenet_val( path, args, hyper, distributed, image_size=224 ):
     """Validation set preprocessing and loader
+    path is a class folder tree or a manifest from process_valset_util.py
     """
-    transform = transforms.Compose( [ transforms.Resize( 224 ),
-                                      transforms.CenterCrop( 224 ),
+    transform = transforms.Compose( [ DraftResize( image_size ),
+                                      transforms.CenterCrop( image_size ),
                                       transforms.ToTensor(),
                                       normalize
                                     ] )
     
-    valset = datasets.ImageFolder( path, transform=transform )
+    valset = image_dataset( path, transform, loader=open_image )
 
     return torch.utils.data.DataLoader( valset, 
                                         batch_size=hyper.batch_size, 
                                         shuffle=False, 
-                                        num_workers=args.workers, 
-                                        pin_memory=True
+                                        **loader_settings( args )
+                                        )
+
+def resize_loader( loader, image_size, batch_size ):
+    """Change the image size of a loader from load_imagenet_data or load_imagenet_val
+    and return a loader with the new batch size. The dataset, with its file
+    list, and the sampler are reused, so this is cheap. Workers are started
+    for every epoch and pick up the new transforms then, persistent workers
+    keep a copy of the old ones so their loader is replaced.
+    """
+    for t in loader.dataset.transform.transforms:
+        if isinstance( t, transforms.RandomResizedCrop ):
+            t.size = ( image_size, image_size )
+        elif isinstance( t, transforms.Resize ):
+            t.size = [ image_size ] if isinstance( t.size, ( list, tuple ) ) else image_size
+        elif isinstance( t, transforms.CenterCrop ):
+            t.size = ( image_size, image_size )
+
+    if batch_size == loader.batch_size and not loader.persistent_workers:
+        return loader
+    return replace_sampler( loader, batch_size=batch_size )
+
+def replace_sampler( loader, sampler=None, batch_size=None, **settings ):
+    """Loader over the same dataset with another sampler and/or batch size.
+    Without a sampler, the loader's own is kept unless it's a default one.
+    settings override the other DataLoader arguments, e.g. num_workers.
+    """
+    if sampler is None and not isinstance( loader.sampler, ( torch.utils.data.RandomSampler,
+                                                             torch.utils.data.SequentialSampler ) ):
+        sampler = loader.sampler
+    shuffle = sampler is None and isinstance( loader.sampler, torch.utils.data.RandomSampler )
+    kwargs = { "num_workers"        : loader.num_workers,
+               "pin_memory"         : loader.pin_memory,
+               "collate_fn"         : loader.collate_fn,
+               "worker_init_fn"     : loader.worker_init_fn,
+               "prefetch_factor"    : loader.prefetch_factor,
+               "persistent_workers" : loader.persistent_workers }
+    kwargs.update( settings )
+    if kwargs[ "num_workers" ] == 0:
+        kwargs[ "prefetch_factor" ] = None
+        kwargs[ "persistent_workers" ] = False
+    elif kwargs[ "prefetch_factor" ] is None:
+        kwargs[ "prefetch_factor" ] = 2
+    return torch.utils.data.DataLoader( loader.dataset,
+                                        batch_size=batch_size or loader.batch_size,
+                                        shuffle=shuffle,
+                                        sampler=sampler,
+                                        **kwargs
                                         )
 
 #######################################
 # COCO
 #######################################
-def load_coco_data( config, args, hyper, distributed ):
+class CocoBoxes( datasets.CocoDetection ):
+    """COCO detection set with letterboxed images and box tensors.
+    Every image is scaled so its longer side is image_size and placed at the
+    top left of an image_size x image_size canvas. Its boxes are returned as an
+    ( n x 5 ) tensor of class, cx, cy, w, h, with the class in 0..79 and the
+    coordinates relative to the canvas. Crowd annotations and boxes of 1 pixel
+    or less are skipped. Items are ( image, boxes, index ). With eval_targets
+    they are ( image, boxes, index, all boxes ), the last with all annotations,
+    as pycocotools evaluates them, and an iscrowd column: class, cx, cy, w, h,
+    iscrowd. Use collate_boxes to batch them.
+    """
+    def __init__( self, root, annFile, image_size=416, flip=False, eval_targets=False ):
+        super().__init__( root, annFile )
+        self.image_size = image_size
+        self.flip = flip
+        self.eval_targets = eval_targets
+        self.cat_ids = sorted( self.coco.getCatIds() )
+        self.cat_to_label = { c: i for i, c in enumerate( self.cat_ids ) }
+        self.to_tensor = transforms.ToTensor()
+
+    def __getitem__( self, index ):
+        image_id = self.ids[ index ]
+        info = self.coco.loadImgs( image_id )[ 0 ]
+        anns = self.coco.loadAnns( self.coco.getAnnIds( imgIds=image_id ) )
+
+        image = open_image( os.path.join( self.root, info[ "file_name" ] ) )
+        width, height = image.size
+        scale = self.image_size / max( width, height )
+        size = ( max( int( round( width * scale ) ), 1 ), max( int( round( height * scale ) ), 1 ) )
+        image, _, _ = decode_draft( image, size )
+        image = image.resize( size, resample=Image.BILINEAR )
+
+        all_boxes = torch.tensor( [ [ self.cat_to_label[ a[ "category_id" ] ] ] + a[ "bbox" ] + [ a[ "iscrowd" ] ]
+                                    for a in anns ], dtype=torch.float32 ).view( -1, 6 )
+        # x, y, w, h in pixels to cx, cy, w, h relative to the canvas
+        all_boxes[ :, 1:3 ] += all_boxes[ :, 3:5 ] / 2
+        all_boxes[ :, 1:5 ] *= scale / self.image_size
+
+        if self.flip and torch.rand( 1 ).item() < 0.5:
+            image = image.transpose( Image.FLIP_LEFT_RIGHT )
+            all_boxes[ :, 1 ] = size[ 0 ] / self.image_size - all_boxes[ :, 1 ]
+
+        pixels = all_boxes[ :, 3:5 ] * self.image_size / scale
+        keep = ( all_boxes[ :, 5 ] == 0 ) & ( pixels > 1 ).all( dim=1 )
+        boxes = all_boxes[ keep, :5 ]
+
+        canvas = Image.new( "RGB", ( self.image_size, self.image_size ), ( 114, 114, 114 ) )
+        canvas.paste( image, ( 0, 0 ) )
+        if self.eval_targets:
+            return self.to_tensor( canvas ), boxes, index, all_boxes
+        return self.to_tensor( canvas ), boxes, index
+
+
+def pack_boxes( boxes ):
+    """Concatenate per image box tensors with the batch index as first column
+    """
+    return torch.cat( [ torch.cat( [ torch.full( ( len( b ), 1 ), i, dtype=b.dtype ), b ], dim=1 )
+                        for i, b in enumerate( boxes ) ] )
+
+def collate_boxes( batch ):
+    """Batch CocoBoxes items into images, the boxes of all images packed into one
+    ( N x 6 ) tensor of batch index, class, cx, cy, w, h, and the sample indices.
+    Evaluation targets are packed the same way, as a fourth ( N x 7 ) tensor.
+    """
+    images, boxes, indices = list( zip( *batch ) )[ :3 ]
+    collated = ( torch.stack( images ), pack_boxes( boxes ), torch.tensor( indices ) )
+    if len( batch[ 0 ] ) > 3:
+        collated += ( pack_boxes( [ item[ 3 ] for item in batch ] ), )
+    return collated
+
+
+def load_coco_data( config, args, hyper, distributed, image_size=416 ):
     """Training set preprocessing and loader
     """    
-    transform = transforms.Compose( [ transforms.ToTensor() ] )
-
-    dataset = datasets.CocoDetection( root=config.train_path, annFile=config.annFile, transform=transform )
+    dataset = CocoBoxes( config.train_path, os.path.join( config.ann_path, config.train_ann ),
+                         image_size=image_size, flip=True )
 
     if distributed:
-        train_sampler = torch.utils.data.distributed.DistributedSampler( dataset )
+        train_sampler = torch.utils.data.distributed.DistributedSampler( dataset, seed=getattr( args, "seed", 0 ) )
     else:
         train_sampler = None
 
     return torch.utils.data.DataLoader( dataset, 
                                         batch_size=hyper.batch_size, 
                                         shuffle=( train_sampler is None ),
-                                        num_workers=args.workers,
-                                        pin_memory=True,
-                                        sampler=train_sampler )
+                                        sampler=train_sampler,
+                                        collate_fn=collate_boxes,
+                                        worker_init_fn=seed_worker,
+                                        **loader_settings( args ) )
 
-def load_coco_val( config, args, hyper, distributed ):
+def load_coco_val( config, args, hyper, distributed, image_size=416 ):
     """Validation set preprocessing and loader
     """
-    transform = transforms.Compose( [ transforms.ToTensor() ] )
-    
-    valset = datasets.CocoDetection( config.val_path, annFile=config.annFile, transform=transform )
+    valset = CocoBoxes( config.val_path, os.path.join( config.ann_path, config.val_ann ), image_size=image_size,
+                        eval_targets=True )
+
+    if distributed:
+        val_sampler = torch.utils.data.distributed.DistributedSampler( valset, shuffle=False )
+    else:
+        val_sampler = None
+
     return torch.utils.data.DataLoader( valset, 
                                         batch_size=hyper.batch_size, 
                                         shuffle=False, 
-                                        num_workers=args.workers, 
-                                        pin_memory=True )
\ No newline at end of file
+                                        sampler=val_sampler,
+                                        collate_fn=collate_boxes,
+                                        **loader_settings( args ) )
@@ -0,0 +1,140 @@
+import os
+import hashlib
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def cache_key( teacher, checkpoint, dataset ):
+    """Identifies the teacher logits of a dataset: the teacher architecture, the
+    path, size and modification time of its checkpoint, and the dataset's
+    list of files and labels
+    """
+    h = hashlib.sha1()
+    stat = os.stat( checkpoint )
+    h.update( "{} {} {} {}".format( teacher, os.path.abspath( checkpoint ), stat.st_size, stat.st_mtime_ns ).encode() )
+    for path, target in getattr( dataset, "samples", [] ):
+        h.update( "{} {}\n".format( path, target ).encode() )
+    h.update( str( len( dataset ) ).encode() )
+    return h.hexdigest()
+
+
+class LogitCache( object ):
+    """Top-k teacher logits for every sample of a dataset, stored in memory-mapped
+    .npy files indexed by sample id:
+        <path>.classes.npy  N x k int16 class indices
+        <path>.logits.npy   N x k float16 logits
+        <path>.filled.npy   N uint8, set once a sample's logits are written
+        <path>.key          the cache_key the logits were computed for
+    The files are opened shared, so rows written by one process are seen by
+    all the others. Only one process should create the files. A cache with
+    another key, from another teacher or dataset, is recreated.
+    """
+    def __init__( self, path, num_samples, topk=10, create=True, key=None ):
+        self.path = path
+        self.num_samples = num_samples
+        self.topk = topk
+        key_file = "{}.key".format( path )
+
+        files = [ "{}.{}.npy".format( path, name ) for name in ( "classes", "logits", "filled" ) ]
+        shapes = [ ( num_samples, topk ), ( num_samples, topk ), ( num_samples, ) ]
+        dtypes = [ np.int16, np.float16, np.uint8 ]
+
+        valid = all( os.path.isfile( f ) for f in files )
+        if valid:
+            maps = [ np.load( f, mmap_mode="r+" ) for f in files ]
+            valid = all( m.shape == s for m, s in zip( maps, shapes ) )
+        if valid and key is not None:
+            valid = os.path.isfile( key_file ) and open( key_file ).read().strip() == key
+        if not valid:
+            if not create:
+                raise RuntimeError( "No logit cache for {} samples{} at {}".format(
+                                        num_samples, "" if key is None else " and key " + key, path ) )
+            os.makedirs( os.path.dirname( path ) or ".", exist_ok=True )
+            maps = [ np.lib.format.open_memmap( f, mode="w+", dtype=d, shape=s )
+                     for f, d, s in zip( files, dtypes, shapes ) ]
+            if key is not None:
+                with open( key_file, "w" ) as f:
+                    f.write( key + "\n" )
+        self.classes, self.logits, self.filled = maps
+
+    def complete( self ):
+        return bool( self.filled.all() )
+
+    def has( self, index ):
+        return bool( self.filled[ index ].all() )
+
+    def get( self, index ):
+        """Returns the logits and classes of the samples as ( B x k ) tensors
+        """
+        return torch.from_numpy( self.logits[ index ].astype( np.float32 ) ), \
+               torch.from_numpy( self.classes[ index ].astype( np.int64 ) )
+
+    def put( self, index, logits, classes ):
+        self.logits[ index ] = logits.detach().cpu().half().numpy()
+        self.classes[ index ] = classes.detach().cpu().short().numpy()
+        self.filled[ index ] = 1
+
+    def flush( self ):
+        for m in ( self.classes, self.logits, self.filled ):
+            m.flush()
+
+    def __str__( self ):
+        return "Logit cache {}: top-{} of {} samples, {} filled".format(
+                    self.path, self.topk, self.num_samples, int( self.filled.sum() ) )
+
+
+class Distiller( object ):
+    """Knowledge distillation from a frozen teacher.
+    Teacher logits are computed the first time a sample is seen and kept in a
+    LogitCache, after which the teacher is not run for it again. The cached
+    logits are those of the augmented view seen in that first pass.
+
+    The loss is alpha * T^2 * KL( teacher || student ) + ( 1 - alpha ) * CE, with
+    both distributions at temperature T and the KL taken over the teacher's
+    top-k classes.
+    """
+    def __init__( self, teacher, cache, temperature=4.0, alpha=0.5 ):
+        self.teacher = teacher
+        self.cache = cache
+        self.temperature = temperature
+        self.alpha = alpha
+        self.criterion = nn.CrossEntropyLoss()
+
+        if self.teacher is not None:
+            self.teacher.eval()
+            for p in self.teacher.parameters():
+                p.requires_grad = False
+
+    def release_teacher( self ):
+        """Drop the teacher once every sample is cached
+        """
+        if self.teacher is not None and self.cache.complete():
+            print( "Teacher logits cached for all samples, releasing the teacher" )
+            self.teacher = None
+            torch.cuda.empty_cache()
+
+    def soft_targets( self, images, index ):
+        """Teacher top-k ( logits, classes ) for a batch, from the cache when all
+        samples of the batch are in it
+        """
+        index = index.numpy()
+        if self.cache.has( index ):
+            logits, classes = self.cache.get( index )
+            return logits.to( images.device, non_blocking=True ), classes.to( images.device, non_blocking=True )
+        if self.teacher is None:
+            raise RuntimeError( "Samples missing from the logit cache and no teacher to compute them" )
+
+        with torch.no_grad():
+            logits, classes = self.teacher( images ).float().topk( self.cache.topk, dim=1 )
+        self.cache.put( index, logits, classes )
+        return logits, classes
+
+    def loss( self, output, target, soft ):
+        logits, classes = soft
+        T = self.temperature
+        teacher = F.softmax( logits / T, dim=1 )
+        student = F.log_softmax( output.float() / T, dim=1 ).gather( 1, classes )
+        kl = ( teacher * ( teacher.clamp( min=1e-8 ).log() - student ) ).sum( dim=1 ).mean()
+        return self.alpha * T * T * kl + ( 1 - self.alpha ) * self.criterion( output, target )
@@ -0,0 +1,157 @@
+import math
+import os
+import numpy as np
+import torch
+import torch.distributed as dist
+
+
+class SampleStats( object ):
+    """Per-sample training statistics of a dataset, stored in memory-mapped
+    .npy files indexed by sample id:
+        <path>.loss.npy     N float16 moving average of the sample's loss
+        <path>.streak.npy   N uint8 epochs in a row the sample was classified correctly
+        <path>.epoch.npy    N int16 last epoch the sample was seen, -1 if never
+    The files are opened shared, as for LogitCache, and survive restarts.
+    Updates are kept on the device and written every commit_every batches, so
+    training doesn't wait on a copy to the host each iteration.
+    """
+    def __init__( self, path, num_samples, momentum=0.5, commit_every=50, create=True ):
+        self.path = path
+        self.num_samples = num_samples
+        self.momentum = momentum
+        self.commit_every = commit_every
+        self.pending = []
+
+        files = [ "{}.{}.npy".format( path, name ) for name in ( "loss", "streak", "epoch" ) ]
+        dtypes = [ np.float16, np.uint8, np.int16 ]
+
+        valid = all( os.path.isfile( f ) for f in files )
+        if valid:
+            maps = [ np.load( f, mmap_mode="r+" ) for f in files ]
+            valid = all( m.shape == ( num_samples, ) for m in maps )
+        if not valid:
+            if not create:
+                raise RuntimeError( "No sample stats for {} samples at {}".format( num_samples, path ) )
+            os.makedirs( os.path.dirname( path ) or ".", exist_ok=True )
+            maps = [ np.lib.format.open_memmap( f, mode="w+", dtype=d, shape=( num_samples, ) )
+                     for f, d in zip( files, dtypes ) ]
+            maps[ 2 ][ : ] = -1
+        self.loss, self.streak, self.epoch = maps
+
+    def update( self, index, losses, correct, epoch ):
+        """Records the per-sample losses and correctness of a batch
+        """
+        self.pending.append( ( index, losses.detach().float(), correct.detach(), epoch ) )
+        if len( self.pending ) >= self.commit_every:
+            self.commit()
+
+    def commit( self ):
+        for index, losses, correct, epoch in self.pending:
+            index = index.cpu().numpy()
+            losses = losses.cpu().numpy()
+            correct = correct.cpu().numpy()
+
+            last = self.epoch[ index ]
+            old = self.loss[ index ].astype( np.float32 )
+            self.loss[ index ] = np.where( last >= 0, self.momentum * old + ( 1 - self.momentum ) * losses, losses )
+            # Oversampled samples are seen more than once an epoch, the streak counts epochs
+            streak = self.streak[ index ].astype( np.int32 )
+            streak = np.where( last == epoch, np.maximum( streak, 1 ), np.minimum( streak + 1, 255 ) )
+            self.streak[ index ] = np.where( correct, streak, 0 )
+            self.epoch[ index ] = epoch
+        self.pending = []
+
+    def flush( self ):
+        self.commit()
+        for m in ( self.loss, self.streak, self.epoch ):
+            m.flush()
+
+    def hardest( self, k=10 ):
+        """Indices and average losses of the k samples with the highest loss
+        """
+        loss = np.where( self.epoch >= 0, self.loss.astype( np.float32 ), -np.inf )
+        index = np.argsort( -loss )[ :k ]
+        return index, loss[ index ]
+
+    def __str__( self ):
+        seen = self.epoch >= 0
+        loss = self.loss[ seen ].astype( np.float32 )
+        return "Sample stats {}: {} of {} samples seen, mean loss {:.4f}, {} correct for 3+ epochs".format(
+                    self.path, int( seen.sum() ), self.num_samples, float( loss.mean() ) if len( loss ) else 0.0,
+                    int( ( self.streak >= 3 ).sum() ) )
+
+
+class HardExampleSampler( torch.utils.data.Sampler ):
+    """Distributed sampler driven by SampleStats. Every epoch:
+      - samples classified correctly for easy_after epochs in a row are
+        skipped, except a random easy_keep fraction of them, at least one,
+        that is checked again. A skipped sample that comes back and is missed
+        loses its streak.
+      - every other sample is drawn once, plus oversample times their number
+        of extra draws, picked with probability proportional to loss^power.
+    So epochs get shorter as more samples become easy, and harder samples are
+    seen more often. Samples never seen count with the mean loss. Every rank
+    computes the same order from the same stats, then takes its own share as
+    DistributedSampler does, so the stats must be flushed on all ranks before
+    set_epoch.
+    """
+    def __init__( self, stats, num_replicas=None, rank=None, oversample=0.0, power=1.0,
+                  easy_after=0, easy_keep=0.25, seed=0 ):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        if easy_after > 0 and not 0 < easy_keep <= 1:
+            raise ValueError( "easy_keep must be in ( 0, 1 ] when skipping easy samples, got {}".format( easy_keep ) )
+        self.stats = stats
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.oversample = oversample
+        self.power = power
+        self.easy_after = easy_after
+        self.easy_keep = easy_keep
+        self.seed = seed
+        self.set_epoch( 0 )
+
+    def set_epoch( self, epoch ):
+        generator = torch.Generator()
+        generator.manual_seed( self.seed + epoch )
+        N = self.stats.num_samples
+
+        seen = torch.from_numpy( self.stats.epoch >= 0 )
+        loss = torch.from_numpy( self.stats.loss.astype( np.float32 ) )
+        loss[ ~seen ] = loss[ seen ].mean() if seen.any() else 1.0
+
+        keep = torch.ones( N, dtype=torch.bool )
+        if self.easy_after > 0:
+            easy = seen & ( torch.from_numpy( self.stats.streak.astype( np.int32 ) ) >= self.easy_after )
+            easy_index = easy.nonzero( as_tuple=True )[ 0 ]
+            # An exact share, so an epoch never runs out of samples
+            checked = int( math.ceil( len( easy_index ) * self.easy_keep ) )
+            keep = ~easy
+            keep[ easy_index[ torch.randperm( len( easy_index ), generator=generator )[ :checked ] ] ] = True
+        indices = keep.nonzero( as_tuple=True )[ 0 ]
+
+        extra = int( len( indices ) * self.oversample )
+        if extra > 0:
+            weights = loss[ indices ].clamp( min=1e-6 ) ** self.power
+            indices = torch.cat( [ indices, indices[ torch.multinomial( weights, extra, replacement=True,
+                                                                        generator=generator ) ] ] )
+        indices = indices[ torch.randperm( len( indices ), generator=generator ) ]
+
+        # Same number of samples on every rank, repeating as often as needed
+        total = int( math.ceil( len( indices ) / self.num_replicas ) ) * self.num_replicas
+        indices = indices.repeat( int( math.ceil( total / len( indices ) ) ) )[ :total ]
+        self.indices = indices[ self.rank:total:self.num_replicas ].tolist()
+        self.skipped = N - int( keep.sum() )
+        self.extra = extra
+
+    def __iter__( self ):
+        return iter( self.indices )
+
+    def __len__( self ):
+        return len( self.indices )
+
+    def __str__( self ):
+        return "Hard example sampler: {} samples per rank, {} easy ones skipped, {} extra draws".format(
+                    len( self.indices ), self.skipped, self.extra )
@@ -1,5 +1,6 @@
 import os
 import argparse
+import hashlib
 import random
 import scipy.io
 import shutil
@@ -56,16 +57,65 @@ def parse_args():
                          help="start epoch number if different from 0" )
     parser.add_argument( "--epochs", default=1, type=int,
                          help="total number of epochs to run" )
+    parser.add_argument( "--resize-schedule", type=str, default=None,
+                         help="progressive resizing, comma separated epoch:size:batch[:val size] phases, "
+                              "e.g. 0:128:512,8:192:256,14:224:256,16:288:128:288" )
     parser.add_argument( "--use-cpu", type=int, default=True,
                          help="set True to train on CPU")
     parser.add_argument( "--pretrained", dest="pretrained", action="store_true",
                          help="start from a pretrained model")
 
+    # distillation
+    parser.add_argument( "--teacher", type=str, default=None,
+                         help="teacher model, e.g. resnet50 or darknet. Enables distillation" )
+    parser.add_argument( "--teacher-checkpoint", type=str, default=None,
+                         help="checkpoint to load into the teacher, required with --teacher" )
+    parser.add_argument( "--distill-cache", type=str, default=None,
+                         help="path prefix of the teacher logit cache" )
+    parser.add_argument( "--distill-topk", default=10, type=int,
+                         help="number of teacher logits to cache per sample" )
+    parser.add_argument( "--distill-temperature", default=4.0, type=float,
+                         help="softmax temperature of the distillation loss" )
+    parser.add_argument( "--distill-alpha", default=0.5, type=float,
+                         help="weight of the distillation loss against the cross entropy" )
+
+    # hard example mining
+    parser.add_argument( "--sample-stats", type=str, default=None,
+                         help="path prefix of the per-sample loss and correctness files. Enables tracking" )
+    parser.add_argument( "--hard-oversample", default=0.0, type=float,
+                         help="extra draws per epoch, as a fraction of the samples, weighted by loss" )
+    parser.add_argument( "--hard-power", default=1.0, type=float,
+                         help="extra draws are proportional to loss to this power" )
+    parser.add_argument( "--easy-after", default=0, type=int,
+                         help="skip samples classified correctly this many epochs in a row, 0 never skips" )
+    parser.add_argument( "--easy-keep", default=0.25, type=float,
+                         help="fraction of the easy samples still trained on every epoch" )
+
+    # reproducibility
+    parser.add_argument( "--seed", default=42, type=int,
+                         help="seed of the model init, the samplers and the data loading workers" )
+    parser.add_argument( "--deterministic", action="store_true",
+                         help="deterministic cudnn and torch algorithms, slower" )
+    parser.add_argument( "--fingerprint", default=0, type=int,
+                         help="print a hash of the first N training batches and their losses every epoch" )
+
+    # test-time augmentation
+    parser.add_argument( "--tta", type=str, nargs="+", default=None,
+                         help="view sets for validate.py to compare, e.g. center center+flip five+flip "
+                              "full+flip@224,288. See TTA in tta.py" )
+
     # distributed processing
     parser.add_argument( "--gpu", default=None, type=int, 
                          help="Train in single GPU mode on given GPU" )
     parser.add_argument( "--workers", default=8, type=int,
                          help="number of data loading processes" )
+    parser.add_argument( "--prefetch-factor", default=2, type=int,
+                         help="batches loaded ahead by every data loading process" )
+    parser.add_argument( "--persistent-workers", action="store_true",
+                         help="keep the data loading processes between epochs" )
+    parser.add_argument( "--tune-loader", action="store_true",
+                         help="benchmark the training loader at startup and use the fewest workers, "
+                              "up to --workers, that keep up with the model" )
     parser.add_argument( "--nnodes", default=1, type=int, 
                          help="number of nodes for distributed training" )
     parser.add_argument( "--rank", default=0, type=int, 
@@ -80,7 +130,11 @@ def parse_args():
                          help="enable debug mode" )
     parser.add_argument( "--prof", default=0, type=int,
                          help="enable profiling" )
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.tune_loader and args.deterministic:
+        # The number of workers decides which random stream augments each sample
+        parser.error( "--tune-loader picks the loader settings from timings, it can't be used with --deterministic" )
+    return args
 
 def parse_config( filename ):
     config = Config()
@@ -121,9 +175,7 @@ def setup_and_launch( worker_fn=None, config=None ):
     print( "Found {} GPUs".format( gpus_per_node ) )
     args.gpus_per_node = gpus_per_node
 
-    np.random.seed( 42 )
-    torch.manual_seed( 42 )
-    torch.cuda.manual_seed( 42 )
+    set_determinism( args.seed, args.deterministic )
 
     if config is None:
         config = parse_config( args.config )
@@ -170,6 +222,51 @@ def setup_and_launch( worker_fn=None, config=None ):
 
     print( "All Done.")
 
+def set_determinism( seed, deterministic=False ):
+    """Seeds python, numpy and torch. With deterministic, also restricts cudnn
+    and torch to deterministic algorithms. These are per process settings, so
+    every spawned worker has to call this again
+    """
+    random.seed( seed )
+    np.random.seed( seed )
+    torch.manual_seed( seed )
+    torch.cuda.manual_seed_all( seed )
+    if deterministic:
+        os.environ.setdefault( "CUBLAS_WORKSPACE_CONFIG", ":4096:8" )
+        torch.backends.cudnn.benchmark = False
+        torch.backends.cudnn.deterministic = True
+        torch.use_deterministic_algorithms( True, warn_only=True )
+
+class BatchFingerprint( object ):
+    """Hashes of the first num_batches batches of an epoch: one of the images
+    and targets, showing the data pipeline produced the same batches, and one
+    of the losses, showing the numerics are unchanged. Two runs with the same
+    seed in deterministic mode should print the same digests.
+    """
+    def __init__( self, num_batches ):
+        self.num_batches = num_batches
+        self.reset()
+
+    def reset( self ):
+        self.data = hashlib.sha1()
+        self.loss = hashlib.sha1()
+        self.count = 0
+
+    def update( self, images, targets, loss ):
+        if self.count >= self.num_batches:
+            return
+        self.data.update( images.detach().cpu().numpy().tobytes() )
+        self.data.update( targets.detach().cpu().numpy().tobytes() )
+        self.loss.update( loss.detach().float().cpu().numpy().tobytes() )
+        self.count += 1
+
+    def done( self ):
+        return self.count >= self.num_batches
+
+    def __str__( self ):
+        return "Fingerprint of the first {} batches: data {} loss {}".format(
+                    self.count, self.data.hexdigest()[ :16 ], self.loss.hexdigest()[ :16 ] )
+
 def load_checkpoint( model, checkpoint_path ):
     """Loads the model state from a checkpoint file
     Inputs:
@@ -198,11 +295,13 @@ def load_checkpoint( model, checkpoint_path ):
             return True
     return False
 
-def adjust_learning_rate( optimizer, i, hyper, num_batches ):
+def adjust_learning_rate( optimizer, i, hyper, num_batches, scale=1.0 ):
     """learning rate schedule
+    i / num_batches is the position in epochs, so num_batches may change between epochs.
+    The learning rate is multiplied by scale, e.g. to follow a change of batch size.
     """
     if hyper.lr_policy == "constant":
-        return hyper.base_lr
+        return hyper.base_lr * scale
         
     stepsize = hyper.stepsize * num_batches
     cycle = math.floor( 1 + i / ( 2 * stepsize ) )
@@ -212,12 +311,54 @@ def adjust_learning_rate( optimizer, i, hyper, num_batches ):
         range = ( hyper.max_lr - hyper.base_lr )
 
     x = abs( i / stepsize - 2 * cycle + 1 )
-    lr = hyper.base_lr + range * max( 0.0, ( 1.0 - x ) )
+    lr = ( hyper.base_lr + range * max( 0.0, ( 1.0 - x ) ) ) * scale
 
     for param_group in optimizer.param_groups:
         param_group[ 'lr' ] = lr
     return lr
 
+class ResizePhase( object ):
+    def __init__( self, epoch, size, batch_size, val_size=224 ):
+        self.epoch = epoch
+        self.size = size
+        self.batch_size = batch_size
+        self.val_size = val_size
+
+    def __eq__( self, other ):
+        return isinstance( other, ResizePhase ) and self.__dict__ == other.__dict__
+
+    def __str__( self ):
+        return "epoch {}: size {}, batch {}, val size {}".format(
+                    self.epoch + 1, self.size, self.batch_size, self.val_size )
+
+
+class ResizeSchedule( object ):
+    """Per-epoch training resolution and batch size for progressive resizing.
+    Parsed from comma separated epoch:size:batch[:val size] phases. Each phase
+    runs from its 0-based start epoch to the start of the next one. Batch sizes
+    are for all processes together, like --batch-size.
+    """
+    def __init__( self, spec ):
+        self.phases = []
+        for part in spec.split( "," ):
+            fields = [ int( f ) for f in part.split( ":" ) ]
+            if len( fields ) not in ( 3, 4 ):
+                raise ValueError( "Bad resize phase '{}', expected epoch:size:batch[:val size]".format( part ) )
+            self.phases.append( ResizePhase( *fields ) )
+        self.phases.sort( key=lambda p: p.epoch )
+        if self.phases[ 0 ].epoch != 0:
+            raise ValueError( "The resize schedule must start at epoch 0" )
+
+    def phase( self, epoch ):
+        return [ p for p in self.phases if p.epoch <= epoch ][ -1 ]
+
+    def __str__( self ):
+        s = "Resize schedule:\n================\n"
+        for p in self.phases:
+            s = s + str( p ) + "\n"
+        return s
+
+
 class HyperParams( object ):
     def __init__( self, namespace=None ):
         self.base_lr = None
@@ -0,0 +1,110 @@
+import os
+import time
+import torch
+
+
+def loader_candidates( max_workers, prefetch_factors=( 2, 4 ) ):
+    """DataLoader settings to try, cheapest first: fewer workers, a smaller
+    prefetch queue, then workers that are restarted every epoch before
+    persistent ones, which keep their memory between epochs
+    """
+    workers = { 0, max_workers }
+    w = 1
+    while w < max_workers:
+        workers.add( w )
+        w *= 2
+    candidates = []
+    for w in sorted( workers ):
+        for p in ( prefetch_factors if w > 0 else ( None, ) ):
+            for persistent in ( ( False, True ) if w > 0 else ( False, ) ):
+                candidates.append( { "num_workers": w, "prefetch_factor": p, "persistent_workers": persistent } )
+    return candidates
+
+
+def benchmark_loader( loader, num_batches=20, warmup=5 ):
+    """Seconds until the first batch, which includes starting the workers, and
+    seconds per batch after warmup batches. The batches prefetched while
+    waiting for the first one don't count either
+    """
+    warmup = max( warmup, loader.num_workers * ( loader.prefetch_factor or 0 ) )
+    t0 = time.perf_counter()
+    it = iter( loader )
+    times = []
+    for i in range( warmup + num_batches ):
+        try:
+            next( it )
+        except StopIteration:
+            break
+        times.append( time.perf_counter() )
+    del it
+    if not times:
+        raise RuntimeError( "Empty loader" )
+    startup = times[ 0 ] - t0
+    steady = times[ min( warmup, len( times ) - 1 ): ]
+    per_batch = ( steady[ -1 ] - steady[ 0 ] ) / ( len( steady ) - 1 ) if len( steady ) > 1 else startup
+    return startup, per_batch
+
+
+def measure_step_time( step, warmup=3, repeat=10 ):
+    """Median seconds of one call of step, a training iteration on a batch
+    already on the device
+    """
+    times = []
+    for i in range( warmup + repeat ):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t0 = time.perf_counter()
+        step()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        if i >= warmup:
+            times.append( time.perf_counter() - t0 )
+    times.sort()
+    return times[ len( times ) // 2 ]
+
+
+def tune_loader( loader, rebuild, step_time, max_workers=None, prefetch_factors=( 2, 4 ), num_batches=20,
+                 margin=0.1 ):
+    """Picks the cheapest DataLoader settings of loader_candidates that keeps up
+    with a model taking step_time seconds per batch, by loading num_batches
+    batches of the actual dataset with each worker count and prefetch factor.
+    A setting keeps up when an epoch of loading, plus starting the workers
+    again for workers that aren't persistent, takes at most 1 / ( 1 + margin )
+    of an epoch of steps. Settings are tried cheapest first and the search
+    stops at the first one that keeps up, if none does the fastest is used.
+    Memory is pinned only when there is a GPU to copy to. rebuild( loader,
+    **settings ) makes the loader with other settings, e.g. replace_sampler of
+    dataset_utils. Returns the settings and a report of the measurements for
+    the run log.
+    """
+    if max_workers is None:
+        max_workers = len( os.sched_getaffinity( 0 ) )
+    pin_memory = torch.cuda.is_available()
+    epoch_steps = len( loader ) * step_time
+    budget = epoch_steps / ( 1 + margin )
+
+    lines = [ "Loader tuning, model step {:.1f} ms, {} batches per epoch".format( step_time * 1000, len( loader ) ),
+              "{:>8s}{:>10s}{:>12s}{:>12s}{:>12s}".format( "Workers", "Prefetch", "Persistent", "Startup s", "Batch ms" ) ]
+    measured = {}
+    best, fastest = None, None
+    for candidate in loader_candidates( max_workers, prefetch_factors ):
+        w, p = candidate[ "num_workers" ], candidate[ "prefetch_factor" ]
+        # Persistence doesn't change the throughput, only whether startup is paid every epoch
+        if ( w, p ) not in measured:
+            measured[ w, p ] = benchmark_loader( rebuild( loader, pin_memory=pin_memory, **candidate ), num_batches )
+        startup, per_batch = measured[ w, p ]
+        lines.append( "{:>8d}{:>10s}{:>12s}{:>12.2f}{:>12.1f}".format(
+                        w, str( p ), str( candidate[ "persistent_workers" ] ), startup, per_batch * 1000 ) )
+        epoch_loading = len( loader ) * per_batch + ( 0 if candidate[ "persistent_workers" ] else startup )
+        if fastest is None or epoch_loading < fastest[ 0 ]:
+            fastest = ( epoch_loading, candidate )
+        if epoch_loading <= budget:
+            best = candidate
+            break
+
+    if best is None:
+        lines.append( "No setting keeps up with the model, using the fastest" )
+        best = fastest[ 1 ]
+    settings = dict( best, pin_memory=pin_memory )
+    lines.append( "Chosen: {}".format( ", ".join( "{}={}".format( k, v ) for k, v in settings.items() ) ) )
+    return settings, "\n".join( lines )
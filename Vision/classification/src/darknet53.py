@@ -1,11 +1,20 @@
-from Affine.Vision.classification.src.resnet_blocks import ResnetBottleneck, ResnetBasic, conv_unit
+from Affine.Vision.classification.src.resnet_blocks import ResnetBottleneck, ResnetBasic, conv_unit, is_conv_unit
 import torch.nn as nn
 import torch
 
 
 class Darknet53( nn.Module ):
-    def __init__( self ):
+    """Darknet53 classifier.
+    head="pool" averages the last feature map before the classifier, so any
+    input size works. head="flatten" is the original head, a linear layer over
+    the flattened 7 x 7 map of a 224 x 224 input, kept to load old checkpoints.
+    Those can be converted to the pool head with convert_flatten_head.
+    """
+    def __init__( self, head="pool", num_classes=1000 ):
         super().__init__()
+        if head not in ( "pool", "flatten" ):
+            raise ValueError( "Unknown head {}".format( head ) )
+        self.head = head
 
         self.layers = nn.ModuleList()
         self.layers.append( conv_unit( 3, 32, 7 ) )
@@ -23,16 +32,40 @@ class Darknet53( nn.Module ):
         self.layers.append( conv_unit( 512, 1024, 3, stride=2 ) )
         for _ in range( 4 ):
             self.layers.append( ResnetBottleneck( 1024, 1024, 512, 1024 ) )
-        self.fc = nn.Linear( 7 * 7 * 1024, 1000 )
+        if head == "pool":
+            self.pool = nn.AdaptiveAvgPool2d( ( 1, 1 ) )
+            self.fc = nn.Linear( 1024, num_classes )
+        else:
+            self.fc = nn.Linear( 7 * 7 * 1024, num_classes )
 
     def forward( self, x ):
         for layer in self.layers:
             x = layer( x )
+        if self.head == "pool":
+            x = self.pool( x )
         x = torch.flatten( x, 1 )
         x = self.fc( x )
         return x
 
 
+def convert_flatten_head( state_dict, channels=1024 ):
+    """Convert a Darknet53 state dict with the flatten head to the pool head.
+    The flatten head applies a weight to every position of the 7 x 7 map. With
+    the average over the map as input, the pool head reproduces it exactly
+    for spatially constant features when its weight is the sum of those
+    weights over the positions. The conversion is a starting point for a
+    short fine-tune rather than an exact equivalent.
+    """
+    state_dict = dict( state_dict )
+    prefix = "module." if "module.fc.weight" in state_dict else ""
+    weight = state_dict[ prefix + "fc.weight" ]
+    if weight.size( 1 ) == channels:
+        return state_dict
+    spatial = weight.size( 1 ) // channels
+    state_dict[ prefix + "fc.weight" ] = weight.view( weight.size( 0 ), channels, spatial ).sum( dim=2 )
+    return state_dict
+
+
 class darknet( nn.Module ):
     def __init__( self ):
         super().__init__()
@@ -58,3 +91,64 @@ class darknet( nn.Module ):
         x = torch.flatten( x, 1 )
         x = self.fc( x )
         return x
+
+
+def stage_ends( layers, strides=( 8, 16, 32 ) ):
+    """Returns ( index, channels ) of the last layer at each output stride.
+    A stage starts with a conv_unit, strided or not, and runs through the
+    residual blocks after it. Layers that are neither, like the pooling of
+    the classifier, end the search.
+    """
+    stride = 1
+    ends = {}
+    for i, m in enumerate( layers ):
+        if is_conv_unit( m ):
+            stride *= m[ 0 ].stride[ 0 ]
+            channels = m[ 0 ].out_channels
+        elif not isinstance( m, ( ResnetBasic, ResnetBottleneck ) ):
+            break
+        if stride in strides:
+            ends[ stride ] = ( i, channels )
+    missing = [ s for s in strides if s not in ends ]
+    if missing:
+        raise ValueError( "Model has no stage at stride {}".format( missing ) )
+    return [ ends[ s ] for s in strides ]
+
+
+class Backbone( nn.Module ):
+    """Feature pyramid view of darknet or Darknet53 for detection.
+    Shares the stage modules of the classifier and returns the outputs of the
+    stages at the given strides, the stride 8, 16 and 32 maps by default. The
+    returned tensors are the stage outputs themselves, nothing is copied. The
+    classifier head is not part of the backbone.
+    """
+    def __init__( self, model, strides=( 8, 16, 32 ) ):
+        super().__init__()
+        layers = model.blocks if hasattr( model, "blocks" ) else model.layers
+        ends = stage_ends( layers, strides )
+        self.strides = list( strides )
+        self.ends = [ i for i, _ in ends ]
+        self.channels = [ c for _, c in ends ]
+        self.layers = nn.ModuleList( layers[ i ] for i in range( self.ends[ -1 ] + 1 ) )
+
+    def forward( self, x ):
+        features = []
+        for i, layer in enumerate( self.layers ):
+            x = layer( x )
+            if i in self.ends:
+                features.append( x )
+        return features
+
+    def load_classifier_state( self, state_dict ):
+        """Load the stage weights from a darknet or Darknet53 classifier state dict
+        """
+        state = {}
+        for key, value in state_dict.items():
+            if key.startswith( "module." ):
+                key = key[ 7: ]
+            name, _, rest = key.partition( "." )
+            if name in ( "blocks", "layers" ):
+                index, _, rest = rest.partition( "." )
+                if int( index ) < len( self.layers ):
+                    state[ "layers.{}.{}".format( index, rest ) ] = value
+        self.load_state_dict( state )
@@ -0,0 +1,100 @@
+import statistics
+import time
+import torch
+
+
+def export_torchscript( model, example, path ):
+    """Scripts the model, or traces it with example if it can't be scripted,
+    and saves it. Returns the loaded artifact
+    """
+    model = model.eval()
+    try:
+        scripted = torch.jit.script( model )
+    except Exception as e:
+        print( "Scripting failed, tracing instead: {}".format( str( e ).splitlines()[ 0 ] ) )
+        with torch.no_grad():
+            scripted = torch.jit.trace( model, example )
+    scripted = torch.jit.freeze( scripted.eval() )
+    torch.jit.save( scripted, path )
+    return torch.jit.load( path )
+
+
+def export_onnx( model, example, path, opset=18 ):
+    """Exports to ONNX with a dynamic batch dimension and checks the graph.
+    Returns an OnnxModel for the file
+    """
+    import onnx
+
+    batch = torch.export.Dim( "batch", min=1, max=1024 )
+    with torch.no_grad():
+        torch.onnx.export( model.eval(), ( example, ), path, input_names=[ "images" ], output_names=[ "logits" ],
+                           opset_version=opset, dynamic_shapes=( { 0: batch }, ), external_data=False )
+    onnx.checker.check_model( onnx.load( path ) )
+    return OnnxModel( path )
+
+
+class OnnxModel( object ):
+    """onnxruntime CPU session called like the torch model, tensor in and out
+    """
+    def __init__( self, path, threads=None ):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession( path, options, providers=[ "CPUExecutionProvider" ] )
+        self.input = self.session.get_inputs()[ 0 ].name
+
+    def __call__( self, images ):
+        return torch.from_numpy( self.session.run( None, { self.input: images.numpy() } )[ 0 ] )
+
+
+def parity( runtimes, batches ):
+    """Compares the outputs of every runtime with the first one, the eager
+    model, on the given batches. Returns name -> max absolute logit difference
+    and top-1 agreement in %
+    """
+    names = list( runtimes )
+    diff = { n: 0.0 for n in names[ 1: ] }
+    agree = { n: 0 for n in names[ 1: ] }
+    count = 0
+    with torch.no_grad():
+        for images in batches:
+            reference = runtimes[ names[ 0 ] ]( images )
+            for n in names[ 1: ]:
+                output = runtimes[ n ]( images )
+                diff[ n ] = max( diff[ n ], ( output - reference ).abs().max().item() )
+                agree[ n ] += ( output.argmax( dim=1 ) == reference.argmax( dim=1 ) ).sum().item()
+            count += images.size( 0 )
+    return { n: { "max_diff": diff[ n ], "top1_agree": 100.0 * agree[ n ] / max( count, 1 ) } for n in names[ 1: ] }
+
+
+def benchmark( runtime, images, warmup=3, repeat=20 ):
+    """Median and p90 latency in ms of runtime on one batch, and images/s
+    """
+    times = []
+    with torch.no_grad():
+        for i in range( warmup + repeat ):
+            t0 = time.perf_counter()
+            runtime( images )
+            if i >= warmup:
+                times.append( ( time.perf_counter() - t0 ) * 1000 )
+    times.sort()
+    median = statistics.median( times )
+    return { "median": median,
+             "p90": times[ min( int( len( times ) * 0.9 ), len( times ) - 1 ) ],
+             "throughput": images.size( 0 ) * 1000 / median }
+
+
+def benchmark_report( results ):
+    """Format a table from a dict of ( runtime, batch size ) -> benchmark() result
+    """
+    lines = [ "{:<14s}{:>8s}{:>14s}{:>12s}{:>12s}".format( "Runtime", "Batch", "median ms", "p90 ms", "Images/s" ) ]
+    for ( name, batch_size ), r in results.items():
+        lines.append( "{:<14s}{:>8d}{:>14.2f}{:>12.2f}{:>12.1f}".format(
+                        name, batch_size, r[ "median" ], r[ "p90" ], r[ "throughput" ] ) )
+    for batch_size in sorted( set( b for _, b in results ) ):
+        best = min( ( r[ "median" ], n ) for ( n, b ), r in results.items() if b == batch_size )
+        lines.append( "fastest at batch {}: {}".format( batch_size, best[ 1 ] ) )
+    return "\n".join( lines )
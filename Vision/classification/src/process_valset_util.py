@@ -1,11 +1,28 @@
+"""Organize the ImageNet validation set by class.
+
+Writes a manifest with one "<image path>\\t<wnid>" line per image, with paths
+relative to the manifest. The loaders in dataset_utils accept it in place of
+a class folder tree. Optionally, the class folder tree is also materialized
+with hard links.
+
+Both steps are idempotent. Re-running after an interruption only does the
+work that is left. Images moved into <val>/<wnid>/ by earlier versions of this
+script are found as well.
+
+    python process_valset_util.py --root ~/Downloads/ImageNet
+    python process_valset_util.py --root ~/Downloads/ImageNet --link-dir ~/Downloads/ImageNet/val_by_class
+"""
 import os
-import random
-import scipy.io
+import re
+import argparse
+import errno
 import shutil
+import scipy.io
+from concurrent.futures import ThreadPoolExecutor
 
 
-def parse_mat( rootpath ):
-    mat_file = os.path.join( rootpath, "data", "meta_clsloc.mat" )
+def parse_mat( rootpath, filename="meta_clsloc.mat" ):
+    mat_file = os.path.join( rootpath, "data", filename )
     mat = scipy.io.loadmat( mat_file, squeeze_me=True )[ 'synsets']
     nums_children = list( zip( *mat ) )[ 4 ]
     mat = [ mat[ i ] for i, num_children in enumerate( nums_children )
@@ -17,9 +34,10 @@ def parse_mat( rootpath ):
     return idx_to_wnid, wnid_to_classes
 
 
-def process_val_set( rootpath ):
-    idx_to_wnid, wnid_to_classes = parse_mat( rootpath )
-    val_idcs = parse_validation_ground_truth( rootpath )
+def process_val_set( rootpath, mat_filename="meta_clsloc.mat",
+                     gt_filename="ILSVRC2014_clsloc_validation_ground_truth.txt" ):
+    idx_to_wnid, wnid_to_classes = parse_mat( rootpath, mat_filename )
+    val_idcs = parse_validation_ground_truth( rootpath, filename=gt_filename )
     val_wnids = [ idx_to_wnid[ idx ] for idx in val_idcs ]
     return wnid_to_classes, val_wnids
 
@@ -31,15 +49,111 @@ def parse_validation_ground_truth( rootpath, path='data',
     return [ int( val_idx ) for val_idx in val_idcs ]
 
 
-def prepare_val_folder( folder, wnids ):
-    img_files = sorted( [ os.path.join( folder, file ) \
-                                for file in os.listdir( folder ) ] )
+def find_val_images( folder ):
+    """Map the image number to the path of every ILSVRC20XX_val_XXXXXXXX.JPEG file
+    in folder or in a class subfolder of it
+    """
+    pattern = re.compile( r"_val_(\d+)\.JPEG$", re.IGNORECASE )
+    images = {}
+    for entry in os.scandir( folder ):
+        entries = os.scandir( entry.path ) if entry.is_dir() else [ entry ]
+        for e in entries:
+            match = pattern.search( e.name )
+            if match and e.is_file():
+                images[ int( match.group( 1 ) ) ] = os.path.relpath( e.path, folder )
+    return images
+
+
+def build_manifest( folder, wnids ):
+    """Returns a list of ( path relative to folder, wnid ), in the order ImageFolder
+    would list the class folder tree. The n-th line of the ground truth is the
+    label of image number n.
+    """
+    images = find_val_images( folder )
+    missing = [ n for n in range( 1, len( wnids ) + 1 ) if n not in images ]
+    if missing:
+        raise RuntimeError( "{} validation images missing from {}, e.g. number {}".format(
+                                len( missing ), folder, missing[ 0 ] ) )
+    entries = [ ( images[ n ], wnid ) for n, wnid in enumerate( wnids, 1 ) ]
+    return sorted( entries, key=lambda e: ( e[ 1 ], os.path.basename( e[ 0 ] ) ) )
+
+
+def write_manifest( entries, folder, filename ):
+    """Write the manifest through a temporary file, so it is either complete or absent.
+    Paths are written relative to the directory of the manifest.
+    """
+    base = os.path.dirname( os.path.abspath( filename ) )
+    tmp = filename + ".tmp"
+    with open( tmp, "w" ) as f:
+        for path, wnid in entries:
+            path = os.path.relpath( os.path.join( os.path.abspath( folder ), path ), base )
+            f.write( "{}\t{}\n".format( path, wnid ) )
+    os.replace( tmp, filename )
+
+
+def link_file( src, dst ):
+    """Hard link src to dst, falling back to a copy across file systems.
+    Returns False if dst already is src.
+    """
+    if os.path.exists( dst ):
+        if os.path.samefile( src, dst ):
+            return False
+        os.remove( dst )
+    try:
+        os.link( src, dst )
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2( src, dst + ".tmp" )
+        os.replace( dst + ".tmp", dst )
+    return True
+
+
+def materialize( folder, entries, link_dir, workers=16 ):
+    """Create link_dir/<wnid>/<image> for every manifest entry
+    """
+    for wnid in set( wnid for _, wnid in entries ):
+        os.makedirs( os.path.join( link_dir, wnid ), exist_ok=True )
+
+    def _link( entry ):
+        path, wnid = entry
+        return link_file( os.path.join( folder, path ),
+                          os.path.join( link_dir, wnid, os.path.basename( path ) ) )
+
+    with ThreadPoolExecutor( max_workers=workers ) as pool:
+        created = sum( pool.map( _link, entries, chunksize=256 ) )
+    return created
+
+
+def main():
+    parser = argparse.ArgumentParser( description="Organize the ImageNet validation set by class" )
+    parser.add_argument( "--root", type=str, required=True,
+                         help="ImageNet root with the devkit data folder" )
+    parser.add_argument( "--val-dir", type=str, default=None,
+                         help="validation images, defaults to <root>/val" )
+    parser.add_argument( "--manifest", type=str, default=None,
+                         help="manifest to write, defaults to <val-dir>/manifest.tsv" )
+    parser.add_argument( "--link-dir", type=str, default=None,
+                         help="also create a class folder tree of hard links here" )
+    parser.add_argument( "--workers", type=int, default=16 )
+    parser.add_argument( "--mat", type=str, default="meta_clsloc.mat" )
+    parser.add_argument( "--ground-truth", type=str, default="ILSVRC2014_clsloc_validation_ground_truth.txt" )
+    args = parser.parse_args()
+
+    root = os.path.expanduser( args.root )
+    folder = os.path.expanduser( args.val_dir ) if args.val_dir else os.path.join( root, "val" )
+    manifest = os.path.expanduser( args.manifest ) if args.manifest else os.path.join( folder, "manifest.tsv" )
+
+    _, wnids = process_val_set( root, args.mat, args.ground_truth )
+    entries = build_manifest( folder, wnids )
+    write_manifest( entries, folder, manifest )
+    print( "Wrote {} images of {} classes to {}".format( len( entries ), len( set( wnids ) ), manifest ) )
 
-    for wnid in set( wnids ):
-        os.mkdir( os.path.join( folder, wnid ) )
+    if args.link_dir:
+        created = materialize( folder, entries, os.path.expanduser( args.link_dir ), args.workers )
+        print( "Linked {} images into {}, {} were already there".format(
+                    created, args.link_dir, len( entries ) - created ) )
 
-    for wnid, img_file in zip( wnids, img_files ):
-        shutil.move( img_file, os.path.join( folder, wnid, os.path.basename( img_file ) ) )
 
-_, wnids = process_val_set( "/home/vipul/Downloads/ImageNet/" )
-prepare_val_folder( "/home/vipul/Downloads/ImageNet/val/", wnids )
+if __name__ == "__main__":
+    main()
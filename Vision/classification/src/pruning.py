@@ -0,0 +1,278 @@
+from Affine.Vision.classification.src.resnet_blocks import ResnetBasic, ResnetBottleneck, is_conv_unit
+import copy
+import torch
+import torch.nn as nn
+
+
+#######################################
+# Slicing conv, BN and linear layers
+#######################################
+def conv_keep_out( conv, keep ):
+    new = nn.Conv2d( conv.in_channels, len( keep ), conv.kernel_size, stride=conv.stride,
+                     padding=conv.padding, dilation=conv.dilation, groups=conv.groups,
+                     bias=conv.bias is not None )
+    new.weight.data.copy_( conv.weight.data[ keep ] )
+    if conv.bias is not None:
+        new.bias.data.copy_( conv.bias.data[ keep ] )
+    return new
+
+
+def conv_keep_in( conv, keep ):
+    new = nn.Conv2d( len( keep ), conv.out_channels, conv.kernel_size, stride=conv.stride,
+                     padding=conv.padding, dilation=conv.dilation, groups=conv.groups,
+                     bias=conv.bias is not None )
+    new.weight.data.copy_( conv.weight.data[ :, keep ] )
+    if conv.bias is not None:
+        new.bias.data.copy_( conv.bias.data )
+    return new
+
+
+def bn_keep( bn, keep ):
+    new = nn.BatchNorm2d( len( keep ), eps=bn.eps, momentum=bn.momentum,
+                          affine=bn.affine, track_running_stats=bn.track_running_stats )
+    if bn.affine:
+        new.weight.data.copy_( bn.weight.data[ keep ] )
+        new.bias.data.copy_( bn.bias.data[ keep ] )
+    if bn.track_running_stats:
+        new.running_mean.copy_( bn.running_mean[ keep ] )
+        new.running_var.copy_( bn.running_var[ keep ] )
+        new.num_batches_tracked.copy_( bn.num_batches_tracked )
+    return new
+
+
+def linear_keep_in( fc, keep, channels ):
+    """Keep input channels of a linear layer. A layer after a flatten of a
+    C x h x w map has C * h * w inputs, channel major.
+    """
+    spatial = fc.in_features // channels
+    weight = fc.weight.data.view( fc.out_features, channels, spatial )[ :, keep ]
+    new = nn.Linear( len( keep ) * spatial, fc.out_features, bias=fc.bias is not None )
+    new.weight.data.copy_( weight.reshape( fc.out_features, -1 ) )
+    if fc.bias is not None:
+        new.bias.data.copy_( fc.bias.data )
+    return new
+
+
+#######################################
+# Channel groups
+#######################################
+class ChannelGroup( object ):
+    """A set of channels that must be pruned together.
+    producers: ( parent, conv name, bn name ) whose output channels are pruned
+    consumers: ( parent, name ) of convs or linears whose input channels are pruned
+    """
+    def __init__( self, name, channels ):
+        self.name = name
+        self.channels = channels
+        self.producers = []
+        self.consumers = []
+        self.keep = None
+
+    def bns( self ):
+        return [ getattr( parent, bn ) if isinstance( bn, str ) else parent[ bn ]
+                 for parent, _, bn in self.producers ]
+
+    def __str__( self ):
+        kept = self.channels if self.keep is None else len( self.keep )
+        return "{:<30s}{:>6d} -> {:<6d}".format( self.name, self.channels, kept )
+
+
+def _get( parent, name ):
+    return parent[ name ] if isinstance( name, int ) else getattr( parent, name )
+
+
+def _set( parent, name, module ):
+    if isinstance( name, int ):
+        parent[ name ] = module
+    else:
+        setattr( parent, name, module )
+
+
+def channel_groups( model, stream=True ):
+    """Find the prunable channel groups of a darknet or Darknet53 model.
+    The channels inside a residual block only feed the next conv of the block
+    and can be pruned freely. The channels of the residual stream of a stage,
+    written by the downsampling conv_unit and added to by every block of the
+    stage, must be pruned together, and only if stream is True.
+    """
+    if hasattr( model, "blocks" ):
+        layers = model.blocks
+    elif hasattr( model, "layers" ):
+        layers = model.layers
+    else:
+        raise TypeError( "Unsupported model {}".format( type( model ).__name__ ) )
+
+    groups = []
+    stage = None
+    for i, m in enumerate( layers ):
+        if is_conv_unit( m ):
+            if stage is not None:
+                stage.consumers.append( ( m, 0 ) )
+            stage = ChannelGroup( "stage.{}".format( i ), m[ 0 ].out_channels )
+            stage.producers.append( ( m, 0, 1 ) )
+            groups.append( stage )
+
+        elif isinstance( m, ResnetBasic ):
+            inner = ChannelGroup( "{}.conv1".format( i ), m.conv1.out_channels )
+            inner.producers.append( ( m, "conv1", "bn1" ) )
+            inner.consumers.append( ( m, "conv2" ) )
+            groups.append( inner )
+            if stage is not None:
+                stage.consumers.append( ( m, "conv1" ) )
+                stage.producers.append( ( m, "conv2", "bn2" ) )
+
+        elif isinstance( m, ResnetBottleneck ):
+            if m.in_channels != m.out_channels:
+                raise ValueError( "Only identity skip connections are supported" )
+            for j in range( len( m.layers ) - 1 ):
+                inner = ChannelGroup( "{}.layers.{}".format( i, j ), m.layers[ j ][ 0 ].out_channels )
+                inner.producers.append( ( m.layers[ j ], 0, 1 ) )
+                inner.consumers.append( ( m.layers[ j + 1 ], 0 ) )
+                groups.append( inner )
+            if stage is not None:
+                stage.consumers.append( ( m.layers[ 0 ], 0 ) )
+                stage.producers.append( ( m.layers[ -1 ], 0, 1 ) )
+
+    if stage is not None:
+        stage.consumers.append( ( model, "fc" ) )
+
+    if not stream:
+        groups = [ g for g in groups if not g.name.startswith( "stage" ) ]
+    return groups
+
+
+#######################################
+# Channel scores
+#######################################
+def gamma_scores( groups ):
+    """Score channels by the |gamma| of their BatchNorms, summed over the group
+    """
+    for g in groups:
+        g.scores = sum( bn.weight.data.abs() for bn in g.bns() )
+    return groups
+
+
+def activation_scores( model, groups, loader, num_batches=10 ):
+    """Score channels by the mean absolute BatchNorm output over a few batches,
+    summed over the group
+    """
+    sums = {}
+
+    def _hook_fn( bn, input, output ):
+        s = output.detach().abs().mean( dim=( 0, 2, 3 ) )
+        sums[ id( bn ) ] = sums.get( id( bn ), 0 ) + s
+
+    handles = [ bn.register_forward_hook( _hook_fn ) for g in groups for bn in g.bns() ]
+    device = next( model.parameters() ).device
+    training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            for i, ( images, _ ) in enumerate( loader ):
+                if i >= num_batches:
+                    break
+                model( images.to( device ) )
+    finally:
+        for h in handles:
+            h.remove()
+        model.train( training )
+
+    for g in groups:
+        g.scores = sum( sums[ id( bn ) ] for bn in g.bns() ).cpu()
+    return groups
+
+
+#######################################
+# Pruning
+#######################################
+def select_channels( groups, ratio, min_channels=8, divisor=8 ):
+    """Keep the highest scoring channels of every group, removing about ratio of
+    them. The number kept is rounded up to a multiple of divisor.
+    """
+    for g in groups:
+        n = max( int( round( g.channels * ( 1 - ratio ) ) ), min_channels )
+        n = min( g.channels, ( ( n + divisor - 1 ) // divisor ) * divisor )
+        g.keep = g.scores.topk( n )[ 1 ].sort()[ 0 ]
+    return groups
+
+
+def apply_pruning( groups ):
+    """Replace the convs, BNs and linears of every group by their pruned versions, in place
+    """
+    for g in groups:
+        keep = g.keep
+        if len( keep ) == g.channels:
+            continue
+        for parent, conv, bn in g.producers:
+            _set( parent, conv, conv_keep_out( _get( parent, conv ), keep ) )
+            _set( parent, bn, bn_keep( _get( parent, bn ), keep ) )
+        for parent, name in g.consumers:
+            layer = _get( parent, name )
+            if isinstance( layer, nn.Linear ):
+                _set( parent, name, linear_keep_in( layer, keep, g.channels ) )
+            else:
+                _set( parent, name, conv_keep_in( layer, keep ) )
+
+
+def prune_model( model, ratio=0.3, method="gamma", loader=None, num_batches=10, stream=True,
+                 min_channels=8, divisor=8 ):
+    """Structured channel pruning.
+    Inputs:
+        model: darknet or Darknet53
+        ratio: fraction of channels to remove from every group
+        method: "gamma" to rank channels by |BN gamma|, "activation" to rank them
+                by mean activation over num_batches batches of loader
+        stream: also prune the residual stream channels of each stage
+    Returns:
+        a pruned copy of the model and the list of channel groups
+    """
+    model = copy.deepcopy( model )
+    groups = channel_groups( model, stream=stream )
+    if method == "gamma":
+        gamma_scores( groups )
+    elif method == "activation":
+        if loader is None:
+            raise ValueError( "Activation ranking needs a loader" )
+        activation_scores( model, groups, loader, num_batches )
+    else:
+        raise ValueError( "Unknown ranking method {}".format( method ) )
+    select_channels( groups, ratio, min_channels=min_channels, divisor=divisor )
+    apply_pruning( groups )
+    return model, groups
+
+
+def restore_pruned( model, state_dict ):
+    """Reshape the convs, BNs and linears of a freshly built model to the shapes
+    in a pruned state dict, so that it can be loaded
+    """
+    modules = dict( model.named_modules() )
+    for name, m in list( modules.items() ):
+        key = name + ".weight"
+        if key not in state_dict:
+            continue
+        shape = state_dict[ key ].shape
+        if isinstance( m, nn.Conv2d ) and shape != m.weight.shape:
+            new = nn.Conv2d( shape[ 1 ] * m.groups, shape[ 0 ], m.kernel_size, stride=m.stride,
+                             padding=m.padding, dilation=m.dilation, groups=m.groups,
+                             bias=m.bias is not None )
+        elif isinstance( m, nn.BatchNorm2d ) and shape != m.weight.shape:
+            new = nn.BatchNorm2d( shape[ 0 ], eps=m.eps, momentum=m.momentum )
+        elif isinstance( m, nn.Linear ) and shape != m.weight.shape:
+            new = nn.Linear( shape[ 1 ], shape[ 0 ], bias=m.bias is not None )
+        else:
+            continue
+        parent_name, _, child = name.rpartition( "." )
+        parent = modules[ parent_name ]
+        _set( parent, int( child ) if child.isdigit() else child, new )
+    model.load_state_dict( state_dict )
+    return model
+
+
+def save_pruned( model, groups, filename ):
+    """Save a pruned model as { "model": state dict, "pruned": the kept channels
+    of every group }. load_checkpoint can't load it into a freshly built model,
+    the shapes differ; reshape the model with restore_pruned first
+    """
+    torch.save( { "model"   : model.state_dict(),
+                  "pruned"  : { g.name: g.keep.tolist() for g in groups } },
+                filename )
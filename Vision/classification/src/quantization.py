@@ -0,0 +1,211 @@
+from Affine.Vision.classification.src.resnet_blocks import ResnetBasic, ResnetBottleneck, activations, is_conv_unit
+import copy
+import io
+import time
+import torch
+import torch.nn as nn
+import torch.quantization as tq
+from torchvision.models.resnet import ResNet, Bottleneck
+from torchvision.models.quantization.resnet import QuantizableResNet, QuantizableBasicBlock, QuantizableBottleneck
+
+
+def default_backend():
+    engines = torch.backends.quantized.supported_engines
+    return "x86" if "x86" in engines else "fbgemm"
+
+
+def fuse_conv_unit( m ):
+    names = [ "0", "1", "2" ] if type( m[ 2 ] ) is nn.ReLU else [ "0", "1" ]
+    tq.fuse_modules( m, [ names ], inplace=True )
+
+
+class QuantResnetBasic( nn.Module ):
+    """ResnetBasic with its own activation instances and a quantizable residual add.
+    resnet_blocks shares one activation module between all blocks, and
+    ResnetBasic calls it twice, so it can not be fused as it is.
+    """
+    def __init__( self, block ):
+        super().__init__()
+        self.conv1 = block.conv1
+        self.bn1 = block.bn1
+        self.relu1 = copy.deepcopy( block.relu )
+        self.conv2 = block.conv2
+        self.bn2 = block.bn2
+        self.relu2 = copy.deepcopy( block.relu )
+        self.skip_add = nn.quantized.FloatFunctional()
+        self.add_relu = False
+
+    def forward( self, x ):
+        residual = x
+        x = self.relu1( self.bn1( self.conv1( x ) ) )
+        x = self.bn2( self.conv2( x ) )
+        if self.add_relu:
+            return self.skip_add.add_relu( x, residual )
+        return self.relu2( self.skip_add.add( x, residual ) )
+
+    def fuse( self ):
+        if type( self.relu1 ) is nn.ReLU:
+            tq.fuse_modules( self, [ [ "conv1", "bn1", "relu1" ], [ "conv2", "bn2" ] ], inplace=True )
+            self.add_relu = True
+        else:
+            tq.fuse_modules( self, [ [ "conv1", "bn1" ], [ "conv2", "bn2" ] ], inplace=True )
+
+
+class QuantResnetBottleneck( nn.Module ):
+    """ResnetBottleneck with its own activation instances and a quantizable residual add
+    """
+    def __init__( self, block ):
+        super().__init__()
+        if block.in_channels != block.out_channels:
+            raise ValueError( "Only identity skip connections are supported" )
+        self.layers = block.layers
+        for layer in self.layers:
+            layer[ 2 ] = copy.deepcopy( layer[ 2 ] )
+        self.act = copy.deepcopy( activations[ block.activation_type ] )
+        self.skip_add = nn.quantized.FloatFunctional()
+        self.add_relu = False
+
+    def forward( self, x ):
+        residual = x
+        for layer in self.layers:
+            x = layer( x )
+        if self.add_relu:
+            return self.skip_add.add_relu( x, residual )
+        return self.act( self.skip_add.add( x, residual ) )
+
+    def fuse( self ):
+        for layer in self.layers:
+            fuse_conv_unit( layer )
+        self.add_relu = type( self.act ) is nn.ReLU
+
+
+def quantizable_torchvision_resnet( model ):
+    """Rebuild a torchvision ResNet as its quantizable counterpart with the same weights
+    """
+    bottleneck = isinstance( model.layer1[ 0 ], Bottleneck )
+    block = QuantizableBottleneck if bottleneck else QuantizableBasicBlock
+    layers = [ len( l ) for l in ( model.layer1, model.layer2, model.layer3, model.layer4 ) ]
+    qmodel = QuantizableResNet( block, layers, num_classes=model.fc.out_features )
+    qmodel.load_state_dict( model.state_dict() )
+    return qmodel
+
+
+def make_quantizable( model ):
+    """Return a copy of the model in which every block can be fused and quantized.
+    Residual blocks are replaced by their quantizable versions and the shared
+    activation in each conv_unit is replaced by its own instance.
+    """
+    if isinstance( model, ResNet ):
+        return quantizable_torchvision_resnet( model )
+
+    model = copy.deepcopy( model )
+
+    def _replace( parent ):
+        for name, m in parent.named_children():
+            if isinstance( m, ResnetBasic ):
+                setattr( parent, name, QuantResnetBasic( m ) )
+            elif isinstance( m, ResnetBottleneck ):
+                setattr( parent, name, QuantResnetBottleneck( m ) )
+            elif is_conv_unit( m ):
+                m[ 2 ] = copy.deepcopy( m[ 2 ] )
+            else:
+                _replace( m )
+
+    _replace( model )
+    return tq.QuantWrapper( model )
+
+
+def fuse_model( model ):
+    """Fold BatchNorm into the preceding conv and fuse Conv+BN+ReLU, in place.
+    The model must be in eval mode. The result is still a float model.
+    """
+    if isinstance( model, QuantizableResNet ):
+        model.fuse_model()
+        return model
+    for m in list( model.modules() ):
+        if isinstance( m, ( QuantResnetBasic, QuantResnetBottleneck ) ):
+            m.fuse()
+        elif is_conv_unit( m ):
+            fuse_conv_unit( m )
+    return model
+
+
+def calibrate( model, loader, num_batches, log=print ):
+    with torch.no_grad():
+        for i, ( images, _ ) in enumerate( loader ):
+            if i >= num_batches:
+                break
+            model( images )
+            log( "Calibration batch {}/{}".format( i + 1, num_batches ) )
+
+
+def quantize_model( model, loader, num_batches=10, backend=None, log=print ):
+    """Post-training static int8 quantization.
+    Inputs:
+        model: float model, darknet, Darknet53 or a torchvision ResNet
+        loader: calibration loader, e.g. from load_imagenet_val
+        num_batches: number of batches to calibrate the observers with
+        backend: quantized engine, x86 or fbgemm by default
+    Returns:
+        the converted int8 model, on the CPU
+    """
+    backend = backend or default_backend()
+    torch.backends.quantized.engine = backend
+
+    qmodel = make_quantizable( model.cpu().eval() ).eval()
+    fuse_model( qmodel )
+    qmodel.qconfig = tq.get_default_qconfig( backend )
+    tq.prepare( qmodel, inplace=True )
+    calibrate( qmodel, loader, num_batches, log=log )
+    tq.convert( qmodel, inplace=True )
+    return qmodel
+
+
+def model_size( model ):
+    """Size of the serialized state dict in bytes
+    """
+    buffer = io.BytesIO()
+    torch.save( model.state_dict(), buffer )
+    return buffer.tell()
+
+
+def evaluate( model, loader, num_batches ):
+    """Top-1/top-5 accuracy and CPU throughput over num_batches batches
+    """
+    correct1 = correct5 = n = 0
+    elapsed = 0.0
+    with torch.no_grad():
+        for i, ( images, targets ) in enumerate( loader ):
+            if i >= num_batches:
+                break
+            t0 = time.perf_counter()
+            output = model( images )
+            elapsed += time.perf_counter() - t0
+
+            _, top5 = output.topk( 5, dim=1 )
+            hits = top5.eq( targets.unsqueeze( 1 ) )
+            correct1 += hits[ :, 0 ].sum().item()
+            correct5 += hits.any( dim=1 ).sum().item()
+            n += images.size( 0 )
+    return { "top1"         : 100.0 * correct1 / max( n, 1 ),
+             "top5"         : 100.0 * correct5 / max( n, 1 ),
+             "images"       : n,
+             "throughput"   : n / max( elapsed, 1e-12 ),
+             "latency"      : 1000 * elapsed / max( num_batches, 1 ),
+             "size"         : model_size( model ) / 2**20 }
+
+
+def compare_report( results ):
+    """Format a table from a dict of name -> evaluate() result
+    """
+    lines = [ "{:<10s}{:>10s}{:>10s}{:>14s}{:>16s}{:>10s}".format(
+                "Model", "Top1", "Top5", "Images/s", "ms/batch", "MB" ) ]
+    for name, r in results.items():
+        lines.append( "{:<10s}{:>10.2f}{:>10.2f}{:>14.1f}{:>16.1f}{:>10.1f}".format(
+                        name, r[ "top1" ], r[ "top5" ], r[ "throughput" ], r[ "latency" ], r[ "size" ] ) )
+    if "fp32" in results and "int8" in results:
+        fp32, int8 = results[ "fp32" ], results[ "int8" ]
+        lines.append( "int8 vs fp32: top1 {:+.2f}, speedup {:.2f}x, size {:.2f}x smaller".format(
+                        int8[ "top1" ] - fp32[ "top1" ], int8[ "throughput" ] / max( fp32[ "throughput" ], 1e-12 ),
+                        fp32[ "size" ] / max( int8[ "size" ], 1e-12 ) ) )
+    return "\n".join( lines )
@@ -20,6 +20,12 @@ def conv_unit( in_channels, out_channels, kernel, stride=1, padding="same", acti
                             nn.BatchNorm2d( num_features=out_channels ),
                             activations[ activation_type ] )
 
+def is_conv_unit( m ):
+    """True for the Sequential( Conv2d, BatchNorm2d, activation ) built by conv_unit
+    """
+    return isinstance( m, nn.Sequential ) and len( m ) == 3 and \
+           isinstance( m[ 0 ], nn.Conv2d ) and isinstance( m[ 1 ], nn.BatchNorm2d )
+
 class ResnetBottleneck( nn.Module ):
     def __init__( self, in_channels, F1, F2, F3, kernel=3, activation_type="relu" ):
         super().__init__()
@@ -0,0 +1,64 @@
+import torch
+import torch.nn.functional as F
+
+
+class TTA( object ):
+    """Test-time augmentation over batches of square images of load_size,
+    e.g. from load_imagenet_val( ..., image_size=load_size ). A view set is
+    given as a spec "crops[+flip][@size,size,...]":
+        crops   center: the center crop_size crop, as without TTA
+                five:   the center and the four corner crops
+                full:   the whole image
+        +flip   adds the horizontal mirror of every crop
+        @sizes  network input sizes, crop_size if not given. For another size
+                the image is first scaled by size / crop_size.
+    e.g. "center", "center+flip", "five+flip", "full+flip@224,288".
+    All views of one size go through the model as a single batch, softmax
+    probabilities are averaged over all views on the device.
+    """
+    def __init__( self, spec, crop_size=224, load_size=256 ):
+        self.spec = spec
+        self.crop_size = crop_size
+        self.load_size = load_size
+
+        crops, _, sizes = spec.partition( "@" )
+        crops = crops.split( "+" )
+        self.crops = crops[ 0 ]
+        self.flip = "flip" in crops[ 1: ]
+        if self.crops not in ( "center", "five", "full" ) or any( c != "flip" for c in crops[ 1: ] ):
+            raise ValueError( "Unknown TTA spec {}".format( spec ) )
+        self.sizes = [ int( s ) for s in sizes.split( "," ) ] if sizes else [ crop_size ]
+
+    @property
+    def num_views( self ):
+        return len( self.sizes ) * ( 5 if self.crops == "five" else 1 ) * ( 2 if self.flip else 1 )
+
+    def views( self, images, size ):
+        """All views at one input size, stacked as ( V*B x 3 x size x size )
+        """
+        if self.crops == "full":
+            views = [ F.interpolate( images, size=( size, size ), mode="bilinear", align_corners=False, antialias=True ) ]
+        else:
+            scaled = round( self.load_size * size / self.crop_size )
+            if scaled != images.size( 2 ):
+                images = F.interpolate( images, size=( scaled, scaled ), mode="bilinear", align_corners=False,
+                                        antialias=True )
+            c, e = ( scaled - size ) // 2, scaled - size
+            corners = [ ( c, c ) ] if self.crops == "center" else [ ( c, c ), ( 0, 0 ), ( 0, e ), ( e, 0 ), ( e, e ) ]
+            views = [ images[ :, :, y:y + size, x:x + size ] for y, x in corners ]
+        if self.flip:
+            views += [ v.flip( 3 ) for v in views ]
+        return torch.cat( views )
+
+    def __call__( self, model, images ):
+        """Averaged class probabilities ( B x C ), one forward per input size
+        """
+        B = images.size( 0 )
+        probs = 0
+        for size in self.sizes:
+            output = model( self.views( images, size ) )
+            probs = probs + output.softmax( dim=1 ).view( -1, B, output.size( 1 ) ).sum( dim=0 )
+        return probs / self.num_views
+
+    def __str__( self ):
+        return self.spec
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+from Affine.Vision.classification.src.darknet53 import Darknet53, convert_flatten_head
+import torch
+
+def head_test():
+    torch.manual_seed( 1 )
+    old = Darknet53( head="flatten" ).eval()
+    new = Darknet53( head="pool" ).eval()
+    new.load_state_dict( convert_flatten_head( old.state_dict() ) )
+
+    # The converted head matches the old one on spatially constant features
+    x = torch.rand( ( 2, 1024, 1, 1 ) ).expand( 2, 1024, 7, 7 )
+    y_old = old.fc( torch.flatten( x, 1 ) )
+    y_new = new.fc( torch.flatten( new.pool( x ), 1 ) )
+    print( "max difference", ( y_old - y_new ).abs().max().item() )
+
+    # Any input size works with the pool head
+    with torch.no_grad():
+        for size in ( 224, 256, 320 ):
+            print( size, new( torch.rand( ( 1, 3, size, size ) ) ).size() )
+
+    print( "parameters flatten: {:,} pool: {:,}".format( sum( p.numel() for p in old.parameters() ),
+                                                         sum( p.numel() for p in new.parameters() ) ) )
+
+if __name__ == "__main__":
+    head_test()
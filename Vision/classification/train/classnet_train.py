@@ -2,14 +2,20 @@
 
 from Affine.Vision.classification.src.darknet53 import darknet
 from dataset_utils import load_imagenet_data as load_data, load_imagenet_val as load_val
-from dataset_utils import data_prefetcher
+from dataset_utils import data_prefetcher, resize_loader, replace_sampler, seed_loader
 from train_utils import parse_args, AverageMeter, ProgressMeter, setup_and_launch, adjust_learning_rate
+from train_utils import load_checkpoint, ResizeSchedule, set_determinism, BatchFingerprint
+from distill_utils import LogitCache, Distiller, cache_key
+from mining_utils import SampleStats, HardExampleSampler
+from tuning_utils import measure_step_time, tune_loader
 
 import os, time, datetime
+import copy
 import warnings
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 import torch.multiprocessing as mp
 from torch.multiprocessing import Process
@@ -17,6 +23,7 @@ import torch.distributed as dist
 from torchvision import transforms, datasets
 from torch.utils.tensorboard import SummaryWriter
 from torchvision.models import resnet18
+import torchvision
 
 try:
     import apex
@@ -28,12 +35,92 @@ except:
 HTIME = lambda t: time.strftime( "%H:%M:%S", time.gmtime( t ) )
 
 
+def build_model( name ):
+    if name == "darknet":
+        return darknet()
+    return torchvision.models.__dict__[ name ]()
+
+
+def setup_distiller( gpu, args, config, dataset, distributed ):
+    """Load the frozen teacher and open its logit cache, creating it on rank 0
+    """
+    if not args.teacher_checkpoint:
+        raise RuntimeError( "--teacher needs a --teacher-checkpoint" )
+    teacher = build_model( args.teacher )
+    if not load_checkpoint( teacher, args.teacher_checkpoint ):
+        raise RuntimeError( "Could not load the teacher checkpoint {}".format( args.teacher_checkpoint ) )
+    teacher.cuda( gpu )
+    key = cache_key( args.teacher, args.teacher_checkpoint, dataset )
+
+    path = args.distill_cache or os.path.join( config.checkpoint_path, "logits_{}_top{}".format(
+                                                    args.teacher, args.distill_topk ) )
+    rank = dist.get_rank() if distributed else 0
+    if rank == 0:
+        cache = LogitCache( path, len( dataset ), topk=args.distill_topk, key=key )
+    if distributed:
+        dist.barrier()
+    if rank != 0:
+        cache = LogitCache( path, len( dataset ), topk=args.distill_topk, create=False, key=key )
+    print( cache )
+
+    distiller = Distiller( teacher, cache, temperature=args.distill_temperature, alpha=args.distill_alpha )
+    distiller.release_teacher()
+    return distiller
+
+
+def setup_sample_stats( args, dataset, distributed ):
+    """Open the per-sample stats, creating them on rank 0, and the hard example
+    sampler if oversampling or skipping is asked for
+    """
+    rank = dist.get_rank() if distributed else 0
+    if rank == 0:
+        stats = SampleStats( args.sample_stats, len( dataset ) )
+    if distributed:
+        dist.barrier()
+    if rank != 0:
+        stats = SampleStats( args.sample_stats, len( dataset ), create=False )
+    print( stats )
+
+    sampler = None
+    if args.hard_oversample > 0 or args.easy_after > 0:
+        sampler = HardExampleSampler( stats, oversample=args.hard_oversample, power=args.hard_power,
+                                      easy_after=args.easy_after, easy_keep=args.easy_keep, seed=args.seed )
+    return stats, sampler
+
+
+def tune_train_loader( train_loader, model, criterion, optimizer, gpu ):
+    """Times a training step of the model on a real batch and picks the
+    cheapest loader settings that keep up with it. The step leaves out the
+    optimizer update so the weights are untouched, the batch norm statistics
+    are restored afterwards
+    """
+    batch = next( iter( train_loader ) )
+    images, target = batch[ 0 ].cuda( gpu ), batch[ 1 ].cuda( gpu )
+    state = copy.deepcopy( model.state_dict() )
+    model.train()
+
+    def step():
+        optimizer.zero_grad()
+        loss = criterion( model( images ), target )
+        with amp.scale_loss( loss, optimizer ) as scaled_loss:
+            scaled_loss.backward()
+
+    step_time = measure_step_time( step )
+    optimizer.zero_grad()
+    model.load_state_dict( state )
+    return tune_loader( train_loader, replace_sampler, step_time, max_workers=train_loader.num_workers )
+
+
 def main_worker( gpu, args, config, hyper ):
-    torch.backends.cudnn.benchmark = True
+    # Spawned processes don't inherit the seeds and flags of the launcher
+    set_determinism( args.seed, args.deterministic )
+    torch.backends.cudnn.benchmark = not args.deterministic
     torch.backends.cudnn.enabled = True
+    args.fingerprint_meter = BatchFingerprint( args.fingerprint ) if args.fingerprint else None
     
     best_acc1 = 0    
     args.writer = None
+    args.lr_scale = 1.0
     start_epoch = 0
     distributed = args.gpu is None
 
@@ -47,14 +134,28 @@ def main_worker( gpu, args, config, hyper ):
     # Set the default device, any tensors created by cuda by 'default' will use this device
     torch.cuda.set_device( gpu )
 
-    train_loader = load_data( config.train_path, args, hyper, distributed )
+    schedule = ResizeSchedule( args.resize_schedule ) if args.resize_schedule else None
+    if schedule:
+        print( schedule )
+
+    with_index = args.teacher is not None or args.sample_stats is not None
+    train_loader = load_data( config.train_path, args, hyper, distributed, with_index=with_index )
     val_loader = load_val( config.val_path, args, hyper, distributed )
     assert train_loader.dataset.classes == val_loader.dataset.classes
 
+    args.stats = None
+    if args.sample_stats:
+        args.stats, sampler = setup_sample_stats( args, train_loader.dataset, distributed )
+        if sampler is not None:
+            train_loader = replace_sampler( train_loader, sampler )
+
     model = resnet18()
     model.cuda( gpu )
 
     criterion = nn.CrossEntropyLoss().cuda( gpu )
+    args.distiller = None
+    if args.teacher:
+        args.distiller = setup_distiller( gpu, args, config, train_loader.dataset, distributed )
     optimizer = optim.SGD( model.parameters(), 
                            lr=hyper.base_lr,
                            momentum=hyper.momentum,
@@ -85,16 +186,60 @@ def main_worker( gpu, args, config, hyper ):
         train_or_eval( False, gpu, val_loader, model, criterion, None, args, hyper, 0 )
         return
 
+    loader_report = None
+    if args.tune_loader:
+        # Every rank measures while the others load too, as in training. The
+        # settings are rank 0's on all of them, the number of workers decides
+        # which random stream augments each sample
+        settings, loader_report = tune_train_loader( train_loader, model, criterion, optimizer, gpu )
+        if distributed:
+            choice = [ settings ]
+            dist.broadcast_object_list( choice, src=0 )
+            settings = choice[ 0 ]
+        train_loader = replace_sampler( train_loader, **settings )
+        val_loader = replace_sampler( val_loader, **settings )
+        if not distributed or gpu == 0:
+            print( loader_report )
+
     if not distributed or gpu == 0:
         args.writer = SummaryWriter( filename_suffix="{}".format( gpu ) )
+        if loader_report:
+            args.writer.add_text( "Loader tuning", "\n".join( "    " + l for l in loader_report.splitlines() ) )
 
     end_epoch = start_epoch + args.epochs
+    phase = None
     for epoch in range( start_epoch, end_epoch ):
-        if distributed:
+        if schedule and schedule.phase( epoch ) != phase:
+            phase = schedule.phase( epoch )
+            print( "Resize phase, {}".format( phase ) )
+            batch_size = phase.batch_size // args.world_size
+            train_loader = resize_loader( train_loader, phase.size, batch_size )
+            val_loader = resize_loader( val_loader, phase.val_size, batch_size )
+            # Linear scaling of the learning rate with the batch size
+            args.lr_scale = batch_size / hyper.batch_size
+
+        if distributed or isinstance( train_loader.sampler, HardExampleSampler ):
             train_loader.sampler.set_epoch( epoch )
+        if isinstance( train_loader.sampler, HardExampleSampler ):
+            print( train_loader.sampler )
+        seed_loader( train_loader, args.seed, epoch, dist.get_rank() if distributed else 0 )
         
         train_or_eval( True, gpu, train_loader, model, criterion, optimizer, args, hyper, epoch )
 
+        if args.distiller:
+            # Every rank fills its own part of the logit cache
+            args.distiller.cache.flush()
+            if distributed:
+                dist.barrier()
+            args.distiller.release_teacher()
+
+        if args.stats:
+            # All ranks must see the whole epoch's stats before the next set_epoch
+            args.stats.flush()
+            if distributed:
+                dist.barrier()
+            print( args.stats )
+
         if not args.prof and ( not distributed or gpu == 0 ):
             acc1 = train_or_eval( False, gpu, val_loader, model, criterion, None, args, hyper, 0 )
 
@@ -133,10 +278,14 @@ def train_or_eval( train, gpu, loader, model, criterion, optimizer, args, hyper,
         torch.cuda.cudart().cudaProfilerStart()
 
     t_init = time.time()
+    if train and args.fingerprint_meter is not None:
+        args.fingerprint_meter.reset()
     prefetcher = data_prefetcher( loader )
     with torch.set_grad_enabled( mode=train ):
-        for i, ( images, target ) in enumerate( prefetcher ):
+        for i, batch in enumerate( prefetcher ):
+            images, target = batch[ 0 ], batch[ 1 ]
             niter = epoch * len( loader ) + i
+            distill = train and args.distiller is not None
 
             if args.prof: torch.cuda.nvtx.range_push( "Prof start iteration {}".format( i ) )
 
@@ -144,10 +293,22 @@ def train_or_eval( train, gpu, loader, model, criterion, optimizer, args, hyper,
             output = model( images )
             if args.prof: torch.cuda.nvtx.range_pop()
 
-            loss = criterion( output, target )
+            if distill:
+                loss = args.distiller.loss( output, target, args.distiller.soft_targets( images, batch[ 2 ] ) )
+            else:
+                loss = criterion( output, target )
+
+            if train and args.fingerprint_meter is not None and not args.fingerprint_meter.done():
+                args.fingerprint_meter.update( images, target, loss )
+                if args.fingerprint_meter.done():
+                    print( args.fingerprint_meter )
+
+            if train and args.stats is not None:
+                per_sample = F.cross_entropy( output.detach(), target, reduction="none" )
+                args.stats.update( batch[ 2 ], per_sample, output.detach().argmax( dim=1 ) == target, epoch )
             
             if train:
-                lr = adjust_learning_rate( optimizer, niter, hyper, len( loader ) )
+                lr = adjust_learning_rate( optimizer, niter, hyper, len( loader ), scale=args.lr_scale )
 
                 optimizer.zero_grad()
                 
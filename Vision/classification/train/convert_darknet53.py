@@ -0,0 +1,28 @@
+from Affine.Vision.classification.src.darknet53 import Darknet53, convert_flatten_head
+
+import argparse
+import torch
+
+
+def main():
+    parser = argparse.ArgumentParser( description="Convert a Darknet53 checkpoint from the flatten head to the pool head" )
+    parser.add_argument( "input", type=str, help="checkpoint with the 7*7*1024 flatten head" )
+    parser.add_argument( "output", type=str, help="checkpoint to write" )
+    args = parser.parse_args()
+
+    checkpoint = torch.load( args.input, map_location="cpu" )
+    checkpoint[ "model" ] = convert_flatten_head( checkpoint[ "model" ] )
+    # The optimizer state holds buffers shaped like the old fc layer
+    for key in ( "optimizer", "amp" ):
+        checkpoint.pop( key, None )
+
+    # Check that the result loads into the new model
+    state_dict = { k[ 7: ] if k.startswith( "module." ) else k: v for k, v in checkpoint[ "model" ].items() }
+    Darknet53( head="pool" ).load_state_dict( state_dict )
+
+    torch.save( checkpoint, args.output )
+    print( "Saved {}".format( args.output ) )
+
+
+if __name__ == "__main__":
+    main()
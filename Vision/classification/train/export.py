@@ -0,0 +1,91 @@
+from Affine.Vision.classification.src.darknet53 import darknet, Darknet53
+from Affine.Vision.classification.src.model_export import export_torchscript, export_onnx, OnnxModel
+from Affine.Vision.classification.src.model_export import parity, benchmark, benchmark_report
+from dataset_utils import load_imagenet_val as load_val
+from train_utils import HyperParams, load_checkpoint
+
+import argparse
+import os
+import torch
+import torchvision
+
+
+models = { "darknet"    : darknet,
+           "darknet53"  : Darknet53,
+           "resnet18"   : torchvision.models.resnet18,
+           "resnet50"   : torchvision.models.resnet50 }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser( description="Export a checkpoint to TorchScript and ONNX, check and benchmark them" )
+    parser.add_argument( "--model", type=str, default="darknet", choices=list( models ) )
+    parser.add_argument( "--checkpoint", type=str, default="checkpoint/checkpoint.pth.tar" )
+    parser.add_argument( "--output-dir", type=str, default="checkpoint/export" )
+    parser.add_argument( "--formats", type=str, nargs="+", default=[ "torchscript", "onnx" ],
+                         choices=[ "torchscript", "onnx" ] )
+    parser.add_argument( "--opset", type=int, default=18 )
+    parser.add_argument( "--image-size", type=int, default=224 )
+    parser.add_argument( "--val-path", type=str, default=None,
+                         help="validation set for the parity check, random images if not given" )
+    parser.add_argument( "--parity-batches", type=int, default=10 )
+    parser.add_argument( "--batch-size", type=int, default=32 )
+    parser.add_argument( "--bench-batch", type=int, nargs="+", default=[ 1, 32 ],
+                         help="batch sizes to measure CPU latency at" )
+    parser.add_argument( "--repeat", type=int, default=20 )
+    parser.add_argument( "--workers", type=int, default=4 )
+    parser.add_argument( "--threads", type=int, default=None, help="CPU threads for all runtimes" )
+    return parser.parse_args()
+
+
+def parity_batches( args ):
+    if args.val_path is None:
+        generator = torch.Generator().manual_seed( 0 )
+        return [ torch.randn( ( args.batch_size, 3, args.image_size, args.image_size ), generator=generator )
+                 for _ in range( args.parity_batches ) ]
+    loader = load_val( args.val_path, args, HyperParams( { "batch_size": args.batch_size } ), distributed=False,
+                       image_size=args.image_size )
+    batches = []
+    for images, _ in loader:
+        batches.append( images )
+        if len( batches ) == args.parity_batches:
+            break
+    return batches
+
+
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads( args.threads )
+    os.makedirs( args.output_dir, exist_ok=True )
+
+    model = models[ args.model ]().eval()
+    if not load_checkpoint( model, args.checkpoint ):
+        raise RuntimeError( "Could not load the checkpoint {}".format( args.checkpoint ) )
+
+    example = torch.randn( ( 2, 3, args.image_size, args.image_size ) )
+    runtimes = { "eager": model }
+    if "torchscript" in args.formats:
+        path = os.path.join( args.output_dir, "{}.pt".format( args.model ) )
+        runtimes[ "torchscript" ] = export_torchscript( model, example, path )
+        print( "Saved {}".format( path ) )
+    if "onnx" in args.formats:
+        path = os.path.join( args.output_dir, "{}.onnx".format( args.model ) )
+        export_onnx( model, example, path, args.opset )
+        runtimes[ "onnxruntime" ] = OnnxModel( path, threads=args.threads )
+        print( "Saved {}".format( path ) )
+
+    print( "\nParity with eager on {} batches{}:".format( args.parity_batches, "" if args.val_path else " of random images" ) )
+    for name, r in parity( runtimes, parity_batches( args ) ).items():
+        print( "{:<14s}max |diff| {:.2e}, top-1 agrees on {:.2f}%".format( name, r[ "max_diff" ], r[ "top1_agree" ] ) )
+
+    results = {}
+    for batch_size in args.bench_batch:
+        images = torch.randn( ( batch_size, 3, args.image_size, args.image_size ) )
+        for name, runtime in runtimes.items():
+            results[ ( name, batch_size ) ] = benchmark( runtime, images, repeat=args.repeat )
+    print( "\nCPU latency, {} threads:".format( torch.get_num_threads() ) )
+    print( benchmark_report( results ) )
+
+
+if __name__ == "__main__":
+    main()
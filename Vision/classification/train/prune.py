@@ -0,0 +1,66 @@
+from Affine.Vision.classification.src.darknet53 import darknet, Darknet53
+from Affine.Vision.classification.src.pruning import prune_model, save_pruned
+from dataset_utils import load_imagenet_val as load_val
+from train_utils import HyperParams, load_checkpoint
+from pm_helper_classes import ModelMeta
+from layer_profiler import LayerProfiler, diff_report
+
+import argparse
+import torch
+
+
+models = { "darknet"    : darknet,
+           "darknet53"  : Darknet53 }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( "--model", type=str, default="darknet", choices=list( models ) )
+    parser.add_argument( "--checkpoint", type=str, default="checkpoint/checkpoint.pth.tar",
+                         help="checkpoint to load into the model" )
+    parser.add_argument( "--ratio", type=float, default=0.3,
+                         help="fraction of channels to remove from every group" )
+    parser.add_argument( "--method", type=str, default="gamma", choices=[ "gamma", "activation" ],
+                         help="rank channels by |BN gamma| or by mean activation" )
+    parser.add_argument( "--no-stream", dest="stream", action="store_false",
+                         help="only prune channels inside residual blocks" )
+    parser.add_argument( "--divisor", type=int, default=8,
+                         help="round the channels kept to a multiple of this" )
+    parser.add_argument( "--val-path", type=str, default="/home/vipul/Datasets/ImageNet/val",
+                         help="images to collect activation statistics on" )
+    parser.add_argument( "--batches", type=int, default=10 )
+    parser.add_argument( "--batch-size", type=int, default=32 )
+    parser.add_argument( "--workers", type=int, default=4 )
+    parser.add_argument( "--repeats", type=int, default=10,
+                         help="forward passes to average the latency over" )
+    parser.add_argument( "--output", type=str, default="checkpoint/pruned.pth.tar" )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    model = models[ args.model ]().eval()
+    if not load_checkpoint( model, args.checkpoint ):
+        raise RuntimeError( "Could not load the checkpoint {}".format( args.checkpoint ) )
+
+    loader = None
+    if args.method == "activation":
+        loader = load_val( args.val_path, args, HyperParams( { "batch_size": args.batch_size } ), distributed=False )
+
+    pruned, groups = prune_model( model, ratio=args.ratio, method=args.method, loader=loader,
+                                  num_batches=args.batches, stream=args.stream, divisor=args.divisor )
+    for g in groups:
+        print( g )
+
+    size = ( 1, 3, 224, 224 )
+    before = LayerProfiler( ModelMeta( model, args.model ), size, repeats=args.repeats ).run()
+    after = LayerProfiler( ModelMeta( pruned, args.model + "-pruned" ), size, repeats=args.repeats ).run()
+    print( diff_report( before, after, depth=2 ) )
+
+    save_pruned( pruned, groups, args.output )
+    print( "Saved pruned model to {}, load it with restore_pruned".format( args.output ) )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+from Affine.Vision.classification.src.darknet53 import darknet, Darknet53
+from Affine.Vision.classification.src.quantization import quantize_model, evaluate, compare_report, default_backend
+from dataset_utils import load_imagenet_val as load_val
+from train_utils import HyperParams, load_checkpoint
+
+import argparse
+import torch
+import torchvision
+
+
+models = { "darknet"    : darknet,
+           "darknet53"  : Darknet53,
+           "resnet18"   : torchvision.models.resnet18,
+           "resnet50"   : torchvision.models.resnet50 }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument( "--model", type=str, default="darknet", choices=list( models ) )
+    parser.add_argument( "--checkpoint", type=str, default="checkpoint/checkpoint.pth.tar",
+                         help="checkpoint to load into the fp32 model" )
+    parser.add_argument( "--val-path", type=str, default="/home/vipul/Datasets/ImageNet/val" )
+    parser.add_argument( "--calib-batches", type=int, default=10,
+                         help="number of batches to calibrate the observers with" )
+    parser.add_argument( "--eval-batches", type=int, default=50,
+                         help="number of batches to compare fp32 and int8 on" )
+    parser.add_argument( "--batch-size", type=int, default=32 )
+    parser.add_argument( "--workers", type=int, default=4 )
+    parser.add_argument( "--threads", type=int, default=None,
+                         help="CPU threads for inference" )
+    parser.add_argument( "--backend", type=str, default=default_backend(), choices=[ "x86", "fbgemm", "qnnpack" ] )
+    parser.add_argument( "--output", type=str, default="checkpoint/int8.pt",
+                         help="TorchScript file to save the int8 model to" )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads( args.threads )
+
+    loader = load_val( args.val_path, args, HyperParams( { "batch_size": args.batch_size } ), distributed=False )
+
+    model = models[ args.model ]().eval()
+    if not load_checkpoint( model, args.checkpoint ):
+        raise RuntimeError( "Could not load the checkpoint {}".format( args.checkpoint ) )
+
+    qmodel = quantize_model( model, loader, num_batches=args.calib_batches, backend=args.backend )
+
+    results = { "fp32": evaluate( model, loader, args.eval_batches ),
+                "int8": evaluate( qmodel, loader, args.eval_batches ) }
+    print( compare_report( results ) )
+
+    torch.jit.save( torch.jit.script( qmodel ), args.output )
+    print( "Saved int8 model to {}".format( args.output ) )
+
+
+if __name__ == "__main__":
+    main()
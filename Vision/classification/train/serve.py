@@ -0,0 +1,245 @@
+from Affine.Vision.classification.src.darknet53 import darknet, Darknet53
+from Affine.Vision.classification.src.model_export import OnnxModel
+from dataset_utils import DraftResize, normalize
+from train_utils import load_checkpoint
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import io
+import json
+import signal
+import time
+import numpy as np
+import torch
+import torchvision
+from torchvision import transforms
+from PIL import Image
+
+
+models = { "darknet"    : darknet,
+           "darknet53"  : Darknet53,
+           "resnet18"   : torchvision.models.resnet18,
+           "resnet50"   : torchvision.models.resnet50 }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser( description="Batched HTTP inference server for a trained classifier" )
+    parser.add_argument( "--model", type=str, default="darknet", choices=list( models ) )
+    parser.add_argument( "--checkpoint", type=str, default="checkpoint/checkpoint.pth.tar" )
+    parser.add_argument( "--export", type=str, default=None,
+                         help="serve a TorchScript .pt or an .onnx file from export.py instead, ONNX runs on the CPU" )
+    parser.add_argument( "--host", type=str, default="127.0.0.1" )
+    parser.add_argument( "--port", type=int, default=8080 )
+    parser.add_argument( "--unix", type=str, default=None,
+                         help="listen on this Unix socket instead of host:port" )
+    parser.add_argument( "--gpu", type=int, default=None, help="GPU to run on, CPU if not given" )
+    parser.add_argument( "--image-size", type=int, default=224 )
+    parser.add_argument( "--max-batch", type=int, default=32 )
+    parser.add_argument( "--max-latency", type=float, default=10.0,
+                         help="ms the first request of a batch waits for more to arrive" )
+    parser.add_argument( "--workers", type=int, default=4, help="preprocessing processes" )
+    parser.add_argument( "--threads", type=int, default=None, help="CPU threads for inference" )
+    parser.add_argument( "--topk", type=int, default=5 )
+    return parser.parse_args()
+
+
+def preprocess( data, image_size ):
+    """Decode and crop one image as load_imagenet_val does. Returns uint8 HWC,
+    four times less to send back from the worker than float, normalization
+    happens on the device for the whole batch
+    """
+    image = Image.open( io.BytesIO( data ) )
+    image = transforms.CenterCrop( image_size )( DraftResize( image_size )( image ) ).convert( "RGB" )
+    return np.asarray( image )
+
+
+class LatencyStats( object ):
+    """Latencies and throughput of the last window requests, and the mean
+    batch size since start. Throughput is measured from the arrival of the
+    oldest request in the window to the last answer, so idle time before
+    them doesn't count
+    """
+    def __init__( self, window=10000 ):
+        self.latencies = collections.deque( maxlen=window )
+        self.arrivals = collections.deque( maxlen=window )
+        self.requests = 0
+        self.batches = 0
+        self.last = None
+
+    def add_batch( self, latencies ):
+        self.last = time.perf_counter()
+        self.latencies.extend( latencies )
+        self.arrivals.extend( self.last - l for l in latencies )
+        self.requests += len( latencies )
+        self.batches += 1
+
+    def summary( self ):
+        elapsed = self.last - min( self.arrivals ) if self.arrivals else 0.0
+        latencies = np.array( self.latencies ) * 1000 if self.latencies else np.zeros( 1 )
+        return { "requests"     : self.requests,
+                 "throughput"   : len( self.latencies ) / elapsed if elapsed > 0 else 0.0,
+                 "mean_batch"   : self.requests / max( self.batches, 1 ),
+                 "p50_ms"       : float( np.percentile( latencies, 50 ) ),
+                 "p99_ms"       : float( np.percentile( latencies, 99 ) ) }
+
+    def __str__( self ):
+        return "{requests} requests, {throughput:.1f} img/s, batch {mean_batch:.1f}, " \
+               "p50 {p50_ms:.1f} ms, p99 {p99_ms:.1f} ms".format( **self.summary() )
+
+
+class InferenceServer( object ):
+    """Requests are preprocessed in a process pool and queued. A single batcher
+    takes the first queued image, then waits at most max_latency for more, up
+    to max_batch, and runs them through the model together. The model runs in
+    its own thread, so requests keep arriving and queueing meanwhile.
+    """
+    def __init__( self, model, device, image_size=224, max_batch=32, max_latency=0.01, workers=4, topk=5 ):
+        # Workers are forked before anything touches CUDA. Ctrl-C is left to
+        # the server, which shuts them down
+        self.pool = concurrent.futures.ProcessPoolExecutor( workers, initializer=signal.signal,
+                                                            initargs=( signal.SIGINT, signal.SIG_IGN ) )
+        self.pool.submit( int ).result()
+        self.model = model.to( device ).eval() if isinstance( model, torch.nn.Module ) else model
+        self.device = device
+        self.image_size = image_size
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.topk = topk
+        self.mean = torch.tensor( normalize.mean, device=device ).view( 1, 3, 1, 1 ) * 255
+        self.std = torch.tensor( normalize.std, device=device ).view( 1, 3, 1, 1 ) * 255
+        self.runner = concurrent.futures.ThreadPoolExecutor( 1 )
+        self.stats = LatencyStats()
+        self.queue = None
+
+    def infer( self, arrays ):
+        with torch.no_grad():
+            images = torch.from_numpy( np.stack( arrays ) ).to( self.device, non_blocking=True )
+            images = ( images.permute( 0, 3, 1, 2 ).float() - self.mean ) / self.std
+            probs, idxs = torch.softmax( self.model( images ), dim=1 ).topk( self.topk, dim=1 )
+        return probs.cpu().tolist(), idxs.cpu().tolist()
+
+    async def batcher( self ):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [ await self.queue.get() ]
+            deadline = time.perf_counter() + self.max_latency
+            while len( batch ) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append( await asyncio.wait_for( self.queue.get(), timeout ) )
+                except asyncio.TimeoutError:
+                    break
+
+            arrays, arrivals, futures = zip( *batch )
+            try:
+                probs, idxs = await loop.run_in_executor( self.runner, self.infer, arrays )
+            except Exception as e:
+                for future in futures:
+                    future.set_exception( e )
+                continue
+            now = time.perf_counter()
+            self.stats.add_batch( [ now - t for t in arrivals ] )
+            for future, p, i in zip( futures, probs, idxs ):
+                future.set_result( { "classes": i, "probs": p } )
+
+    async def predict( self, data ):
+        arrival = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        array = await loop.run_in_executor( self.pool, preprocess, data, self.image_size )
+        future = loop.create_future()
+        await self.queue.put( ( array, arrival, future ) )
+        return await future
+
+    async def handle( self, reader, writer ):
+        """Minimal HTTP/1.1 with keep-alive. POST /predict with the image file as
+        the body returns the top-k classes and probabilities, GET /stats the
+        latency and throughput figures
+        """
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path, _ = line.decode( "latin-1" ).split( " ", 2 )
+                headers = {}
+                while True:
+                    header = await reader.readline()
+                    if header in ( b"\r\n", b"\n", b"" ):
+                        break
+                    key, value = header.decode( "latin-1" ).split( ":", 1 )
+                    headers[ key.strip().lower() ] = value.strip()
+                body = await reader.readexactly( int( headers.get( "content-length", 0 ) ) )
+
+                status = "200 OK"
+                if method == "POST" and path == "/predict":
+                    try:
+                        result = await self.predict( body )
+                    except Exception as e:
+                        status, result = "400 Bad Request", { "error": str( e ) }
+                elif method == "GET" and path == "/stats":
+                    result = self.stats.summary()
+                else:
+                    status, result = "404 Not Found", { "error": "unknown path {}".format( path ) }
+
+                payload = json.dumps( result ).encode()
+                writer.write( "HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(
+                                  status, len( payload ) ).encode() + payload )
+                await writer.drain()
+                if headers.get( "connection", "" ).lower() == "close":
+                    break
+        except ( ConnectionError, asyncio.IncompleteReadError, ValueError ):
+            pass
+        finally:
+            writer.close()
+
+    async def serve( self, host="127.0.0.1", port=8080, unix=None ):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.ensure_future( self.batcher() )
+        if unix:
+            server = await asyncio.start_unix_server( self.handle, path=unix )
+        else:
+            server = await asyncio.start_server( self.handle, host, port )
+        print( "Serving on {}".format( unix or "http://{}:{}".format( host, port ) ) )
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+def main():
+    args = parse_args()
+    if args.threads is not None:
+        torch.set_num_threads( args.threads )
+
+    device = torch.device( "cpu" if args.gpu is None else "cuda:{}".format( args.gpu ) )
+    if args.export is None:
+        model = models[ args.model ]()
+        if not load_checkpoint( model, args.checkpoint ):
+            raise RuntimeError( "Could not load the checkpoint {}".format( args.checkpoint ) )
+    elif args.export.endswith( ".onnx" ):
+        model = OnnxModel( args.export, threads=args.threads )
+        device = torch.device( "cpu" )
+    else:
+        model = torch.jit.load( args.export, map_location="cpu" )
+    print( "Serving {}".format( args.export or args.checkpoint ) )
+
+    server = InferenceServer( model, device, args.image_size, args.max_batch, args.max_latency / 1000,
+                              args.workers, args.topk )
+    if device.type == "cuda":
+        torch.backends.cudnn.benchmark = True
+
+    try:
+        asyncio.run( server.serve( args.host, args.port, args.unix ) )
+    except KeyboardInterrupt:
+        pass
+    print( server.stats )
+    server.pool.shutdown()
+
+
+if __name__ == "__main__":
+    main()
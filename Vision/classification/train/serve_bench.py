@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+import numpy as np
+
+
+def parse_args():
+    parser = argparse.ArgumentParser( description="Load generator for serve.py" )
+    parser.add_argument( "images", type=str, nargs="+", help="image files or folders to send, cycled through" )
+    parser.add_argument( "--host", type=str, default="127.0.0.1" )
+    parser.add_argument( "--port", type=int, default=8080 )
+    parser.add_argument( "--unix", type=str, default=None, help="connect to this Unix socket instead" )
+    parser.add_argument( "--concurrency", type=int, default=32, help="connections sending requests at once" )
+    parser.add_argument( "--requests", type=int, default=2000 )
+    parser.add_argument( "--warmup", type=int, default=100, help="requests sent first and not measured" )
+    return parser.parse_args()
+
+
+def load_images( paths ):
+    files = []
+    for path in paths:
+        if os.path.isdir( path ):
+            for root, _, names in sorted( os.walk( path ) ):
+                files += [ os.path.join( root, n ) for n in sorted( names ) ]
+        else:
+            files.append( path )
+    images = []
+    for f in files:
+        with open( f, "rb" ) as fp:
+            images.append( fp.read() )
+    return images
+
+
+class Client( object ):
+    """One keep-alive connection to the server
+    """
+    def __init__( self, host, port, unix=None ):
+        self.address = ( host, port, unix )
+        self.reader = self.writer = None
+
+    async def connect( self ):
+        host, port, unix = self.address
+        if unix:
+            self.reader, self.writer = await asyncio.open_unix_connection( unix )
+        else:
+            self.reader, self.writer = await asyncio.open_connection( host, port )
+
+    async def request( self, method, path, body=b"" ):
+        self.writer.write( "{} {} HTTP/1.1\r\nHost: affine\r\nContent-Length: {}\r\n\r\n".format(
+                               method, path, len( body ) ).encode() + body )
+        await self.writer.drain()
+        status = int( ( await self.reader.readline() ).split()[ 1 ] )
+        length = 0
+        while True:
+            header = await self.reader.readline()
+            if header in ( b"\r\n", b"\n", b"" ):
+                break
+            key, value = header.decode( "latin-1" ).split( ":", 1 )
+            if key.strip().lower() == "content-length":
+                length = int( value )
+        return status, json.loads( await self.reader.readexactly( length ) )
+
+    def close( self ):
+        self.writer.close()
+
+
+async def run( args ):
+    images = load_images( args.images )
+    print( "Sending {} images, {} requests over {} connections".format( len( images ), args.requests, args.concurrency ) )
+
+    latencies, errors = [], 0
+    total = args.warmup + args.requests
+    sent = 0
+    start = None
+
+    async def worker():
+        nonlocal sent, errors, start
+        client = Client( args.host, args.port, args.unix )
+        await client.connect()
+        while sent < total:
+            n = sent
+            sent += 1
+            if n == args.warmup:
+                start = time.perf_counter()
+            t = time.perf_counter()
+            status, _ = await client.request( "POST", "/predict", images[ n % len( images ) ] )
+            if n >= args.warmup:
+                latencies.append( time.perf_counter() - t )
+                errors += status != 200
+        client.close()
+
+    await asyncio.gather( *[ worker() for _ in range( args.concurrency ) ] )
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array( latencies ) * 1000
+    print( "{} requests, {} errors in {:.2f} s, {:.1f} img/s".format( len( latencies ), errors, elapsed,
+                                                                     len( latencies ) / elapsed ) )
+    print( "latency ms p50 {:.1f} p90 {:.1f} p99 {:.1f} max {:.1f}".format(
+                *np.percentile( latencies, [ 50, 90, 99 ] ), latencies.max() ) )
+
+    client = Client( args.host, args.port, args.unix )
+    await client.connect()
+    _, stats = await client.request( "GET", "/stats" )
+    client.close()
+    print( "server: {requests} requests, {throughput:.1f} img/s, batch {mean_batch:.1f}, "
+           "p50 {p50_ms:.1f} ms, p99 {p99_ms:.1f} ms".format( **stats ) )
+
+
+def main():
+    asyncio.run( run( parse_args() ) )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 from Affine.Vision.classification.src.darknet53 import darknet
+from Affine.Vision.classification.src.tta import TTA
 from dataset_utils import load_imagenet_data as load_data, load_imagenet_val as load_val
 from dataset_utils import data_prefetcher
-from train_utils import parse_args, AverageMeter, ProgressMeter, Config, load_checkpoint
+from train_utils import parse_args, AverageMeter, ProgressMeter, Config, HyperParams, load_checkpoint
 
 import os, time, datetime
 import warnings
@@ -68,6 +69,44 @@ def validate( loader, model, args ):
         print( "{:<10d}\t{:4.1f}".format( i.data, p.data ) )
 
 
+def validate_tta( loader, model, ttas, args ):
+    """Accuracy and model throughput of every TTA view set, from one pass over
+    the data. Views are made and reduced on the device, the time is that of
+    the forward passes and the reduction.
+    """
+    device = torch.device( "cpu" if args.gpu is None else "cuda:{}".format( args.gpu ) )
+    model.to( device )
+    correct1 = { t.spec: 0 for t in ttas }
+    correct5 = { t.spec: 0 for t in ttas }
+    elapsed = { t.spec: 0.0 for t in ttas }
+    n = 0
+
+    with torch.no_grad():
+        for i, ( images, targets ) in enumerate( loader ):
+            images = images.to( device, non_blocking=True )
+            targets = targets.to( device, non_blocking=True )
+            for tta in ttas:
+                if device.type == "cuda":
+                    torch.cuda.synchronize()
+                t0 = time.perf_counter()
+                _, top5 = tta( model, images ).topk( 5, dim=1 )
+                hits = top5.eq( targets.unsqueeze( 1 ) )
+                correct1[ tta.spec ] += hits[ :, 0 ].sum().item()
+                correct5[ tta.spec ] += hits.any( dim=1 ).sum().item()
+                elapsed[ tta.spec ] += time.perf_counter() - t0
+            n += images.size( 0 )
+
+            if i % 50 == 0:
+                print( "[{}/{}] ".format( i, len( loader ) ) + ", ".join( "{} {:.2f}".format(
+                    t.spec, 100.0 * correct1[ t.spec ] / n ) for t in ttas ) )
+
+    print( "\n{:<24s}{:>8s}{:>10s}{:>10s}{:>12s}".format( "TTA", "Views", "Top1", "Top5", "Images/s" ) )
+    for tta in ttas:
+        print( "{:<24s}{:>8d}{:>10.2f}{:>10.2f}{:>12.1f}".format(
+                tta.spec, tta.num_views, 100.0 * correct1[ tta.spec ] / max( n, 1 ),
+                100.0 * correct5[ tta.spec ] / max( n, 1 ), n / max( elapsed[ tta.spec ], 1e-12 ) ) )
+
+
 def accuracy_with_score( outputs, targets ):
     global present, score
     with torch.no_grad():
@@ -85,14 +124,22 @@ def accuracy_with_score( outputs, targets ):
 
 def main():
     args = parse_args()
-    loader = load_val( config.val_path, args, distributed=False )
+    hyper = HyperParams( args.__dict__ )
 
     model = darknet().eval()
     #model = torchvision.models.resnet101( pretrained=True ).eval()
 
     checkpoint_path = os.path.join( config.checkpoint_path, config.checkpoint_name )
     load_checkpoint( model, checkpoint_path )
-    validate( loader, model, args )
+
+    if args.tta:
+        # Views are cut from 256 x 256 images, as after the usual Resize( 256 )
+        ttas = [ TTA( spec, crop_size=224, load_size=256 ) for spec in args.tta ]
+        loader = load_val( config.val_path, args, hyper, distributed=False, image_size=256 )
+        validate_tta( loader, model, ttas, args )
+    else:
+        loader = load_val( config.val_path, args, hyper, distributed=False )
+        validate( loader, model, args )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,164 @@
+import torch
+import torch.distributed as dist
+
+
+def box_iou( a, b ):
+    """Pairwise IoU of ( N x 4 ) and ( M x 4 ) boxes given as x1, y1, x2, y2
+    """
+    inter = ( torch.min( a[ :, None, 2: ], b[ None, :, 2: ] ) -
+              torch.max( a[ :, None, :2 ], b[ None, :, :2 ] ) ).clamp( min=0 ).prod( dim=2 )
+    area_a = ( a[ :, 2: ] - a[ :, :2 ] ).prod( dim=1 )
+    area_b = ( b[ :, 2: ] - b[ :, :2 ] ).prod( dim=1 )
+    return inter / ( area_a[ :, None ] + area_b[ None, : ] - inter ).clamp( min=1e-9 )
+
+
+def box_ioa( a, b ):
+    """Pairwise intersection of ( N x 4 ) and ( M x 4 ) boxes over the area of
+    the first ones, the overlap of detections with crowd regions
+    """
+    inter = ( torch.min( a[ :, None, 2: ], b[ None, :, 2: ] ) -
+              torch.max( a[ :, None, :2 ], b[ None, :, :2 ] ) ).clamp( min=0 ).prod( dim=2 )
+    return inter / ( a[ :, 2: ] - a[ :, :2 ] ).prod( dim=1 )[ :, None ].clamp( min=1e-9 )
+
+
+class CocoMAP( object ):
+    """COCO style mean average precision, computed as batches arrive.
+    Detections are matched to the targets of their image and class in
+    decreasing score order at every IoU threshold from 0.5 to 0.95, as
+    pycocotools does. Crowd targets are ignore regions: a detection that
+    matches no other target but covers a crowd box by the threshold, as
+    intersection over its own area, counts neither as a true nor as a false
+    positive. Only per class and threshold histograms of detection scores and
+    of true positives over score bins are kept, so memory doesn't grow with
+    the number of images, and merging DDP ranks is a single all_reduce.
+    Scores falling into the same of the bins count as ties. Only the "all"
+    area range of pycocotools is computed.
+
+    With a DistributedSampler, give the dataset size as num_samples: the
+    duplicates it pads the last batches with are then skipped. This expects
+    the loader to go through the sampler's indices in order, i.e. without
+    shuffling.
+    """
+    def __init__( self, num_classes=80, num_samples=None, bins=1000, device="cpu" ):
+        self.num_classes = num_classes
+        self.num_samples = num_samples
+        self.bins = bins
+        self.iou_thresholds = torch.linspace( 0.5, 0.95, 10, device=device )
+        self.device = device
+        self.reset()
+
+    def reset( self ):
+        T = len( self.iou_thresholds )
+        self.detections = torch.zeros( self.num_classes, T, self.bins, dtype=torch.int32, device=self.device )
+        self.true_positives = torch.zeros( self.num_classes, T, self.bins, dtype=torch.int32, device=self.device )
+        self.targets = torch.zeros( self.num_classes, dtype=torch.int32, device=self.device )
+        self.seen = 0
+
+    def _valid_images( self, batch_size ):
+        # Position of every image of the batch in the sampler's padded order
+        rank, world_size = 0, 1
+        if dist.is_available() and dist.is_initialized():
+            rank, world_size = dist.get_rank(), dist.get_world_size()
+        position = rank + ( self.seen + torch.arange( batch_size, device=self.device ) ) * world_size
+        self.seen += batch_size
+        if self.num_samples is None:
+            return torch.ones( batch_size, dtype=torch.bool, device=self.device )
+        return position < self.num_samples
+
+    def update( self, detections, targets, batch_size, image_size ):
+        """Adds a batch. Detections are the ( M x 7 ) batch index, class, score,
+        x1, y1, x2, y2 tensor of postprocess, in pixels, targets the ( N x 6 )
+        batch index, class, cx, cy, w, h tensor of collate_boxes, relative to
+        image_size. With a seventh iscrowd column, as in the evaluation targets
+        of CocoBoxes, crowd targets are ignore regions.
+        """
+        detections = detections.to( self.device ).float()
+        targets = targets.to( self.device ).float()
+        valid = self._valid_images( batch_size )
+        detections = detections[ valid[ detections[ :, 0 ].long() ] ]
+        targets = targets[ valid[ targets[ :, 0 ].long() ] ]
+
+        d_image, d_cls, scores = detections[ :, 0 ].long(), detections[ :, 1 ].long(), detections[ :, 2 ]
+        t_image, t_cls = targets[ :, 0 ].long(), targets[ :, 1 ].long()
+        t_boxes = torch.cat( [ targets[ :, 2:4 ] - targets[ :, 4:6 ] / 2,
+                               targets[ :, 2:4 ] + targets[ :, 4:6 ] / 2 ], dim=1 ) * image_size
+        crowd = targets[ :, 6 ] > 0 if targets.size( 1 ) > 6 else torch.zeros_like( t_cls, dtype=torch.bool )
+        self.targets += torch.bincount( t_cls[ ~crowd ], minlength=self.num_classes )
+
+        T, M = len( self.iou_thresholds ), len( detections )
+        true_positive = torch.zeros( T, M, dtype=torch.bool, device=self.device )
+        ignored = torch.zeros( T, M, dtype=torch.bool, device=self.device )
+        if M and len( targets ):
+            iou = box_iou( detections[ :, 3: ], t_boxes )
+            if crowd.any():
+                iou[ :, crowd ] = box_ioa( detections[ :, 3: ], t_boxes[ crowd ] )
+            iou[ ( d_image[ :, None ] != t_image[ None ] ) | ( d_cls[ :, None ] != t_cls[ None ] ) ] = 0
+
+            # Rank of every detection within its image and class. All the
+            # detections of the same rank are matched at once, they never
+            # compete for the same target
+            group = d_image * self.num_classes + d_cls
+            order = scores.argsort( descending=True )
+            order = order[ group[ order ].argsort( stable=True ) ]
+            counts = torch.unique_consecutive( group[ order ], return_counts=True )[ 1 ]
+            starts = ( counts.cumsum( 0 ) - counts ).repeat_interleave( counts )
+            rank = torch.empty_like( order )
+            rank[ order ] = torch.arange( M, device=self.device ) - starts
+
+            matched = torch.zeros( T, len( targets ), dtype=torch.bool, device=self.device )
+            thresholds = self.iou_thresholds[ :, None, None ]
+            for r in range( int( rank.max() ) + 1 ):
+                index = ( rank == r ).nonzero( as_tuple=True )[ 0 ]
+                overlap = iou[ index ][ None ].expand( T, -1, -1 )
+                above = overlap >= thresholds
+                # Crowd targets are never used up, and only taken without another match
+                candidate = above & ~matched[ :, None, : ] & ~crowd
+                best = torch.where( candidate, overlap, overlap.new_full( (), -1.0 ) ).argmax( dim=2 )
+                hit = candidate.any( dim=2 )
+                true_positive[ :, index ] = hit
+                ignored[ :, index ] = ~hit & ( above & crowd ).any( dim=2 )
+                t, s = hit.nonzero( as_tuple=True )
+                matched[ t, best[ t, s ] ] = True
+
+        bin = ( scores * self.bins ).long().clamp( 0, self.bins - 1 )
+        size = self.num_classes * T * self.bins
+        t, m = ( ~ignored ).nonzero( as_tuple=True )
+        flat = ( d_cls[ m ] * T + t ) * self.bins + bin[ m ]
+        self.detections += torch.bincount( flat, minlength=size ).view( self.num_classes, T, self.bins )
+        t, m = true_positive.nonzero( as_tuple=True )
+        flat = ( d_cls[ m ] * T + t ) * self.bins + bin[ m ]
+        self.true_positives += torch.bincount( flat, minlength=size ).view( self.num_classes, T, self.bins )
+
+    def synchronize( self ):
+        """Sums the counts of all DDP ranks, every rank ends up with the totals
+        """
+        if dist.is_available() and dist.is_initialized():
+            for counts in ( self.detections, self.true_positives, self.targets ):
+                dist.all_reduce( counts )
+
+    def compute( self ):
+        """Returns the COCO AP averaged over IoU 0.5:0.95, AP50, AP75 and the per
+        class AP over IoU 0.5:0.95. Classes without targets are left out of the
+        means and get -1.
+        """
+        # Cumulative counts from the highest score bin down
+        tp = self.true_positives.flip( -1 ).cumsum( -1 ).double()
+        dets = self.detections.flip( -1 ).cumsum( -1 ).double()
+        recall = tp / self.targets.clamp( min=1 ).double()[ :, None, None ]
+        precision = torch.where( dets > 0, tp / dets.clamp( min=1 ), torch.zeros_like( tp ) )
+        # Interpolated precision, the best one at any higher recall
+        precision = precision.flip( -1 ).cummax( -1 )[ 0 ].flip( -1 )
+
+        # Precision at the 101 recall points, 0 beyond the highest recall reached
+        points = torch.linspace( 0, 1, 101, dtype=torch.float64, device=tp.device )
+        index = torch.searchsorted( recall.contiguous(), points.expand( *recall.shape[ :2 ], -1 ).contiguous() )
+        precision = torch.cat( [ precision, torch.zeros_like( precision[ ..., :1 ] ) ], dim=-1 )
+        ap = precision.gather( -1, index ).mean( dim=-1 )
+
+        present = self.targets > 0
+        per_class = torch.where( present, ap.mean( dim=1 ), torch.full_like( ap[ :, 0 ], -1.0 ) )
+        ap = ap[ present ]
+        return { "AP"       : ap.mean().item() if len( ap ) else 0.0,
+                 "AP50"     : ap[ :, 0 ].mean().item() if len( ap ) else 0.0,
+                 "AP75"     : ap[ :, 5 ].mean().item() if len( ap ) else 0.0,
+                 "per_class": per_class.tolist() }
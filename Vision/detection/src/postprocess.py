@@ -0,0 +1,165 @@
+import torch
+from torchvision.ops import nms
+
+
+def decode_outputs( outputs, anchors, strides ):
+    """Decodes the raw YOLO predictions of all strides at once. Outputs are the
+    ( B x A*(5+C) x h x w ) maps of YoloDetector, anchors the ( S x A x 2 )
+    anchor buffer in pixels. Returns boxes ( B x N x 4 ) as x1, y1, x2, y2 in
+    pixels of the network input, objectness logits ( B x N ) and class logits
+    ( B x N x C ), with N the number of predictions over all strides.
+    """
+    B = outputs[ 0 ].size( 0 )
+    A = anchors.size( 1 )
+    boxes, preds = [], []
+    for out, anchor, stride in zip( outputs, anchors, strides ):
+        _, _, H, W = out.size()
+        pred = out.view( B, A, -1, H, W ).permute( 0, 1, 3, 4, 2 ).float()
+
+        gy, gx = torch.meshgrid( torch.arange( H, device=out.device ), torch.arange( W, device=out.device ), indexing="ij" )
+        grid = torch.stack( [ gx, gy ], dim=-1 ).float()
+        xy = ( pred[ ..., :2 ].sigmoid() + grid ) * stride
+        wh = pred[ ..., 2:4 ].clamp( max=10 ).exp() * anchor.to( out.device ).view( 1, A, 1, 1, 2 )
+        boxes.append( torch.cat( [ xy - wh / 2, xy + wh / 2 ], dim=-1 ).view( B, -1, 4 ) )
+        preds.append( pred[ ..., 4: ].reshape( B, A * H * W, -1 ) )
+
+    boxes = torch.cat( boxes, dim=1 )
+    preds = torch.cat( preds, dim=1 )
+    return boxes, preds[ ..., 0 ], preds[ ..., 1: ]
+
+
+def _nms_offset( boxes, scores, groups, iou_threshold ):
+    # Each group is moved by its own offset so that boxes of different groups
+    # never overlap, then it is a single NMS call
+    offsets = groups.to( boxes ) * ( boxes.max() - boxes.min() + 1 )
+    return nms( boxes + offsets[ :, None ], scores, iou_threshold )
+
+
+def _nms_pairs( boxes, scores, groups, iou_threshold ):
+    # A single NMS call still compares every box with every later one, which is
+    # quadratic in all boxes of the batch on the CPU. Only pairs of the same
+    # group are compared here, then the greedy keep / suppress decisions are
+    # resolved for all boxes at once, repeating until none is left undecided
+    order = scores.argsort( descending=True )
+    order = order[ groups[ order ].argsort( stable=True ) ]
+    boxes, groups = boxes[ order ], groups[ order ]
+    n = len( order )
+    counts = torch.unique_consecutive( groups, return_counts=True )[ 1 ]
+    ends = ( counts.cumsum( 0 ) ).repeat_interleave( counts )
+    later = ends - torch.arange( n ) - 1
+
+    # All ( i, j ) with j after i in the same group
+    i = torch.arange( n ).repeat_interleave( later )
+    first = later.cumsum( 0 ) - later
+    j = i + 1 + torch.arange( len( i ) ) - first[ i ]
+    a, b = boxes[ i ], boxes[ j ]
+    inter = ( torch.min( a[ :, 2: ], b[ :, 2: ] ) - torch.max( a[ :, :2 ], b[ :, :2 ] ) ).clamp( min=0 ).prod( dim=1 )
+    area = ( boxes[ :, 2: ] - boxes[ :, :2 ] ).prod( dim=1 )
+    over = inter > iou_threshold * ( area[ i ] + area[ j ] - inter )
+    i, j = i[ over ], j[ over ]
+
+    # 1 kept, -1 suppressed, 0 not decided yet
+    state = torch.zeros( n, dtype=torch.long )
+    while True:
+        pending = torch.zeros( n, dtype=torch.long ).index_add_( 0, j, ( state[ i ] == 0 ).long() )
+        killed = torch.zeros( n, dtype=torch.long ).index_add_( 0, j, ( state[ i ] == 1 ).long() )
+        undecided = state == 0
+        state[ undecided & ( killed > 0 ) ] = -1
+        state[ undecided & ( killed == 0 ) & ( pending == 0 ) ] = 1
+        if not ( state == 0 ).any():
+            break
+
+    keep = order[ state == 1 ]
+    return keep[ scores[ keep ].argsort( descending=True ) ]
+
+
+def batched_nms( boxes, scores, groups, iou_threshold ):
+    """NMS of boxes of many groups, e.g. image and class, in a single call.
+    On the GPU the groups are given distinct offsets and go through one NMS
+    kernel, on the CPU only boxes of the same group are compared. Returns the
+    kept indices sorted by decreasing score.
+    """
+    if boxes.numel() == 0:
+        return torch.empty( ( 0, ), dtype=torch.long, device=boxes.device )
+    if boxes.is_cuda:
+        return _nms_offset( boxes, scores, groups, iou_threshold )
+    return _nms_pairs( boxes, scores, groups, iou_threshold )
+
+
+def topk_per_image( image, scores, k ):
+    """Indices of the k highest scores of every image, for candidates given
+    as flat image and score tensors. Sorted by image, then by decreasing score.
+    Scores are scattered into one padded row per image, so that a single topk
+    call does it instead of sorting all candidates.
+    """
+    if len( image ) == 0:
+        return image.new_zeros( 0 )
+    order = image.argsort( stable=True )
+    image = image[ order ]
+    counts = torch.bincount( image )
+    starts = counts.cumsum( 0 ) - counts
+    column = torch.arange( len( order ), device=order.device ) - starts[ image ]
+
+    padded = scores.new_full( ( len( counts ), int( counts.max() ) ), -1.0 )
+    padded[ image, column ] = scores[ order ]
+    top, index = padded.topk( min( k, padded.size( 1 ) ), dim=1 )
+    keep = top >= 0
+    return order[ ( starts[ :, None ] + index )[ keep ] ]
+
+
+def _candidates_dense( obj, cls, conf_threshold, pre_nms_topk ):
+    # Fixed shape until the end, no host syncs inside, better on the GPU
+    B, N, C = cls.size()
+    scores = ( obj.sigmoid()[ ..., None ] * cls.sigmoid() ).view( B, -1 )
+    k = min( pre_nms_topk, scores.size( 1 ) )
+    scores, index = scores.topk( k, dim=1 )
+    image = torch.arange( B, device=scores.device )[ :, None ].expand( B, k )
+    keep = scores > conf_threshold
+    return image[ keep ], index[ keep ] // C, index[ keep ] % C, scores[ keep ]
+
+
+def _candidates_sparse( obj, cls, conf_threshold, pre_nms_topk ):
+    # Scores can't exceed the objectness, so the class sigmoids are only needed
+    # for predictions with enough of it. Far less work, better on the CPU,
+    # unless the threshold is so low that most predictions pass anyway
+    image, n = ( obj.sigmoid() > conf_threshold ).nonzero( as_tuple=True )
+    if len( n ) * 8 > obj.numel():
+        return _candidates_dense( obj, cls, conf_threshold, pre_nms_topk )
+    obj = obj.sigmoid()
+    scores = obj[ image, n ][ :, None ] * cls[ image, n ].sigmoid()
+    i, c = ( scores > conf_threshold ).nonzero( as_tuple=True )
+    image, n, scores = image[ i ], n[ i ], scores[ i, c ]
+    keep = topk_per_image( image, scores, pre_nms_topk )
+    return image[ keep ], n[ keep ], c[ keep ], scores[ keep ]
+
+
+def postprocess( outputs, anchors, strides, conf_threshold=0.01, iou_threshold=0.5,
+                 pre_nms_topk=1000, max_detections=100, dense=None ):
+    """Detections of a whole batch from raw YOLO outputs. Every class of every
+    prediction scoring objectness * class probability above conf_threshold is
+    a candidate, at most pre_nms_topk per image go into one per image and class
+    NMS for the whole batch. Returns an ( M x 7 ) tensor of batch index, class,
+    score, x1, y1, x2, y2, at most max_detections per image, ordered by image
+    and decreasing score. Dense candidate selection is used on the GPU unless
+    told otherwise, sparse selection on the CPU.
+    """
+    boxes, obj, cls = decode_outputs( outputs, anchors, strides )
+    if dense is None:
+        dense = boxes.is_cuda
+    select = _candidates_dense if dense else _candidates_sparse
+    image, n, c, scores = select( obj, cls, conf_threshold, pre_nms_topk )
+
+    boxes = boxes[ image, n ]
+    keep = batched_nms( boxes, scores, image * cls.size( 2 ) + c, iou_threshold )
+    image, c, scores, boxes = image[ keep ], c[ keep ], scores[ keep ], boxes[ keep ]
+    keep = topk_per_image( image, scores, max_detections )
+
+    return torch.cat( [ image[ keep, None ].float(), c[ keep, None ].float(),
+                        scores[ keep, None ], boxes[ keep ] ], dim=1 )
+
+
+def split_detections( detections, batch_size ):
+    """Per image list of ( n x 6 ) class, score, x1, y1, x2, y2 tensors
+    """
+    image = detections[ :, 0 ].long()
+    return [ detections[ image == i, 1: ] for i in range( batch_size ) ]
@@ -0,0 +1,187 @@
+from Affine.Vision.classification.src.resnet_blocks import conv_unit
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+# YOLOv3 COCO anchors in pixels at 416 x 416, three per stride 8, 16 and 32
+yolo_anchors = [ [ ( 10, 13 ), ( 16, 30 ), ( 33, 23 ) ],
+                 [ ( 30, 61 ), ( 62, 45 ), ( 59, 119 ) ],
+                 [ ( 116, 90 ), ( 156, 198 ), ( 373, 326 ) ] ]
+
+
+def detection_block( in_channels, channels ):
+    """Five alternating 1x1 and 3x3 conv_units, as in the YOLOv3 head
+    """
+    return nn.Sequential( conv_unit( in_channels, channels, 1, padding="valid", activation_type="leaky_relu" ),
+                          conv_unit( channels, channels * 2, 3, activation_type="leaky_relu" ),
+                          conv_unit( channels * 2, channels, 1, padding="valid", activation_type="leaky_relu" ),
+                          conv_unit( channels, channels * 2, 3, activation_type="leaky_relu" ),
+                          conv_unit( channels * 2, channels, 1, padding="valid", activation_type="leaky_relu" ) )
+
+
+class YoloHead( nn.Module ):
+    """Top-down YOLOv3 head over backbone feature maps ordered from the finest
+    to the coarsest stride. Each coarser map is reduced, upsampled and
+    concatenated to the next finer one. Returns one ( B x A*(5+C) x h x w )
+    prediction per stride, finest first.
+    """
+    def __init__( self, channels, num_classes=80, num_anchors=3 ):
+        super().__init__()
+        self.num_classes = num_classes
+        self.num_anchors = num_anchors
+        outputs = num_anchors * ( 5 + num_classes )
+
+        self.blocks = nn.ModuleList()
+        self.lateral = nn.ModuleList()
+        self.outputs = nn.ModuleList()
+        coarser = 0
+        # Built from the coarsest map down, width is half of the backbone's at each stride
+        for i, c in enumerate( reversed( channels ) ):
+            width = c // 2
+            self.blocks.append( detection_block( c + coarser, width ) )
+            self.outputs.append( nn.Sequential( conv_unit( width, width * 2, 3, activation_type="leaky_relu" ),
+                                                nn.Conv2d( width * 2, outputs, 1 ) ) )
+            if i < len( channels ) - 1:
+                self.lateral.append( conv_unit( width, width // 2, 1, padding="valid", activation_type="leaky_relu" ) )
+            coarser = width // 2
+
+        # Start with a low objectness everywhere, most cells are background
+        for out in self.outputs:
+            bias = out[ -1 ].bias.data.view( num_anchors, 5 + num_classes )
+            bias[ :, 4 ] = -4.6
+
+    def forward( self, features ):
+        outputs = []
+        x = None
+        for i, f in enumerate( reversed( features ) ):
+            if x is not None:
+                x = F.interpolate( self.lateral[ i - 1 ]( x ), size=f.size()[ 2: ], mode="nearest" )
+                f = torch.cat( [ x, f ], dim=1 )
+            x = self.blocks[ i ]( f )
+            outputs.append( self.outputs[ i ]( x ) )
+        return outputs[ ::-1 ]
+
+
+class YoloDetector( nn.Module ):
+    """Backbone plus YoloHead. Returns the raw predictions, finest stride first
+    """
+    def __init__( self, backbone, num_classes=80, anchors=yolo_anchors ):
+        super().__init__()
+        self.backbone = backbone
+        self.strides = backbone.strides
+        self.register_buffer( "anchors", torch.tensor( anchors, dtype=torch.float32 ) )
+        self.head = YoloHead( backbone.channels, num_classes, len( anchors[ 0 ] ) )
+
+    def forward( self, images ):
+        return self.head( self.backbone( images ) )
+
+
+def box_iou_cxcywh( a, b ):
+    """Pairwise IoU of ( ... x N x 4 ) and ( ... x M x 4 ) boxes given as cx, cy,
+    w, h. Returns ( ... x N x M )
+    """
+    a, b = a[ ..., :, None, : ], b[ ..., None, :, : ]
+    a1, a2 = a[ ..., :2 ] - a[ ..., 2: ] / 2, a[ ..., :2 ] + a[ ..., 2: ] / 2
+    b1, b2 = b[ ..., :2 ] - b[ ..., 2: ] / 2, b[ ..., :2 ] + b[ ..., 2: ] / 2
+    inter = ( torch.min( a2, b2 ) - torch.max( a1, b1 ) ).clamp( min=0 ).prod( dim=-1 )
+    union = a[ ..., 2: ].prod( dim=-1 ) + b[ ..., 2: ].prod( dim=-1 ) - inter
+    return inter / union.clamp( min=1e-9 )
+
+
+def pad_targets( b, boxes, batch_size ):
+    """Boxes of packed targets as ( B x Nmax x 4 ), one row per image, padded
+    with empty boxes that have an IoU of 0 with anything
+    """
+    counts = torch.bincount( b, minlength=batch_size )
+    order = torch.argsort( b, stable=True )
+    start = torch.cumsum( counts, dim=0 ) - counts
+    slot = torch.arange( len( b ), device=b.device ) - start[ b[ order ] ]
+    padded = boxes.new_zeros( ( batch_size, int( counts.max() ) if len( b ) else 0, 4 ) )
+    padded[ b[ order ], slot ] = boxes[ order ]
+    return padded
+
+
+class YoloLoss( nn.Module ):
+    """YOLOv3 loss over the predictions of all strides for packed targets.
+    Targets are an ( N x 6 ) tensor of batch index, class, cx, cy, w, h with
+    coordinates relative to the image, as made by collate_boxes. Every target
+    is assigned to the anchor, over all strides, that best matches its shape,
+    and to the grid cell of its center. Predictions that are not assigned but
+    overlap a target of their image by more than ignore_iou do not count as
+    background, each prediction is compared with the targets of its own image
+    only. All of it is computed for the whole batch at once.
+    """
+    def __init__( self, anchors=yolo_anchors, strides=( 8, 16, 32 ), num_classes=80, ignore_iou=0.5,
+                  box_weight=1.0, obj_weight=1.0, cls_weight=1.0 ):
+        super().__init__()
+        self.register_buffer( "anchors", torch.tensor( anchors, dtype=torch.float32 ) )
+        self.strides = strides
+        self.num_classes = num_classes
+        self.ignore_iou = ignore_iou
+        self.box_weight = box_weight
+        self.obj_weight = obj_weight
+        self.cls_weight = cls_weight
+
+    def forward( self, outputs, targets ):
+        device = outputs[ 0 ].device
+        B = outputs[ 0 ].size( 0 )
+        A = self.anchors.size( 1 )
+        image_size = outputs[ 0 ].size( 2 ) * self.strides[ 0 ]
+        anchors = self.anchors.to( device ) / image_size
+        targets = targets.to( device ).float()
+        b, cls, boxes = targets[ :, 0 ].long(), targets[ :, 1 ].long(), targets[ :, 2: ]
+
+        # Best anchor by shape IoU, as if both were centered at the same point
+        flat = anchors.view( -1, 2 )
+        inter = torch.min( boxes[ :, None, 2: ], flat[ None ] ).prod( dim=2 )
+        shape_iou = inter / ( boxes[ :, None, 2: ].prod( dim=2 ) + flat.prod( dim=1 )[ None ] - inter )
+        best = shape_iou.argmax( dim=1 )
+        padded = pad_targets( b, boxes, B )
+
+        loss_box = loss_obj = loss_cls = outputs[ 0 ].new_zeros( () )
+        for s, out in enumerate( outputs ):
+            _, _, H, W = out.size()
+            pred = out.view( B, A, 5 + self.num_classes, H, W ).permute( 0, 1, 3, 4, 2 ).float()
+            anchor = anchors[ s ]
+
+            # Decoded boxes of every prediction, for the ignore mask
+            gy, gx = torch.meshgrid( torch.arange( H, device=device ), torch.arange( W, device=device ), indexing="ij" )
+            cx = ( pred[ ..., 0 ].sigmoid() + gx ) / W
+            cy = ( pred[ ..., 1 ].sigmoid() + gy ) / H
+            wh = pred[ ..., 2:4 ].clamp( max=10 ).exp() * anchor.view( 1, A, 1, 1, 2 )
+            decoded = torch.cat( [ cx.unsqueeze( -1 ), cy.unsqueeze( -1 ), wh ], dim=-1 ).detach()
+
+            ignore = torch.zeros( B, A, H, W, dtype=torch.bool, device=device )
+            if len( targets ):
+                iou = box_iou_cxcywh( decoded.view( B, -1, 4 ), padded )
+                ignore = ( iou.max( dim=2 )[ 0 ] > self.ignore_iou ).view( B, A, H, W )
+
+            obj_target = torch.zeros( B, A, H, W, device=device )
+            mask = ( best // A ) == s
+            if mask.any():
+                tb, ta, tcls, tbox = b[ mask ], best[ mask ] % A, cls[ mask ], boxes[ mask ]
+                gi = ( tbox[ :, 0 ] * W ).long().clamp( 0, W - 1 )
+                gj = ( tbox[ :, 1 ] * H ).long().clamp( 0, H - 1 )
+                p = pred[ tb, ta, gj, gi ]
+
+                txy = torch.stack( [ tbox[ :, 0 ] * W - gi, tbox[ :, 1 ] * H - gj ], dim=1 )
+                twh = ( tbox[ :, 2: ] / anchor[ ta ] ).clamp( min=1e-9 ).log()
+                # Small boxes weigh more
+                scale = ( 2 - tbox[ :, 2 ] * tbox[ :, 3 ] ).unsqueeze( 1 )
+                loss_box = loss_box + ( scale * ( ( p[ :, :2 ].sigmoid() - txy ) ** 2 +
+                                                  ( p[ :, 2:4 ] - twh ) ** 2 ) ).sum() / B
+
+                cls_target = torch.zeros_like( p[ :, 5: ] )
+                cls_target[ torch.arange( len( tcls ), device=device ), tcls ] = 1
+                loss_cls = loss_cls + F.binary_cross_entropy_with_logits( p[ :, 5: ], cls_target, reduction="sum" ) / B
+
+                obj_target[ tb, ta, gj, gi ] = 1
+                ignore[ tb, ta, gj, gi ] = False
+
+            weight = ( ~ignore ).float()
+            loss_obj = loss_obj + ( F.binary_cross_entropy_with_logits( pred[ ..., 4 ], obj_target, reduction="none" )
+                                    * weight ).sum() / B
+
+        loss = self.box_weight * loss_box + self.obj_weight * loss_obj + self.cls_weight * loss_cls
+        return loss, { "box": loss_box.item(), "obj": loss_obj.item(), "cls": loss_cls.item() }
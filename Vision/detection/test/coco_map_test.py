@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+from Affine.Vision.detection.src.coco_map import CocoMAP
+from pycocotools.coco import COCO
+from pycocotools.cocoeval import COCOeval
+import contextlib
+import io
+import torch
+
+def fake_set( num_images=50, num_classes=5, image_size=416 ):
+    """Random targets, detections near them with some wrong classes, random
+    false positives, and crowd regions with detections inside. Returns the
+    COCO ground truth dict, the packed detections and the packed targets with
+    an iscrowd column
+    """
+    images, annotations, detections, targets = [], [], [], []
+    for i in range( num_images ):
+        images.append( { "id": i, "width": image_size, "height": image_size } )
+        k = torch.randint( 1, 8, ( 1, ) ).item()
+        xy, wh = torch.rand( ( k, 2 ) ) * 300, torch.rand( ( k, 2 ) ) * 100 + 10
+        cls = torch.randint( 0, num_classes, ( k, ) )
+        for j in range( k ):
+            annotations.append( { "id": len( annotations ) + 1, "image_id": i, "category_id": int( cls[ j ] ) + 1,
+                                  "bbox": xy[ j ].tolist() + wh[ j ].tolist(), "area": wh[ j ].prod().item(), "iscrowd": 0 } )
+            targets.append( [ i, cls[ j ].item() ] + ( ( xy[ j ] + wh[ j ] / 2 ) / image_size ).tolist() + ( wh[ j ] / image_size ).tolist() + [ 0 ] )
+            for _ in range( 2 ):
+                box = torch.cat( [ xy[ j ], xy[ j ] + wh[ j ] ] ) + torch.randn( 4 ) * 8
+                box[ 2: ] = torch.max( box[ 2: ], box[ :2 ] + 1 )
+                c = cls[ j ].item() if torch.rand( 1 ).item() < 0.8 else torch.randint( 0, num_classes, ( 1, ) ).item()
+                detections.append( [ i, c, torch.rand( 1 ).item() ] + box.tolist() )
+        if torch.rand( 1 ).item() < 0.3:
+            xy, wh = torch.rand( 2 ) * 200, torch.rand( 2 ) * 150 + 50
+            c = torch.randint( 0, num_classes, ( 1, ) ).item()
+            annotations.append( { "id": len( annotations ) + 1, "image_id": i, "category_id": c + 1,
+                                  "bbox": xy.tolist() + wh.tolist(), "area": wh.prod().item(), "iscrowd": 1 } )
+            targets.append( [ i, c ] + ( ( xy + wh / 2 ) / image_size ).tolist() + ( wh / image_size ).tolist() + [ 1 ] )
+            for _ in range( 3 ):
+                corner = xy + torch.rand( 2 ) * wh * 0.6
+                box = torch.cat( [ corner, corner + torch.rand( 2 ) * wh * 0.5 + 4 ] )
+                detections.append( [ i, c, torch.rand( 1 ).item() ] + box.tolist() )
+        for _ in range( 5 ):
+            box = torch.rand( 4 ) * 200
+            box[ 2: ] += box[ :2 ] + 5
+            detections.append( [ i, torch.randint( 0, num_classes, ( 1, ) ).item(), torch.rand( 1 ).item() * 0.5 ] + box.tolist() )
+
+    gt = { "images": images, "annotations": annotations, "categories": [ { "id": c + 1 } for c in range( num_classes ) ] }
+    return gt, torch.tensor( detections ), torch.tensor( targets )
+
+def pycocotools_test():
+    torch.manual_seed( 0 )
+    num_images, batch_size, image_size = 50, 8, 416
+    gt, detections, targets = fake_set( num_images, image_size=image_size )
+
+    coco = COCO()
+    coco.dataset = gt
+    with contextlib.redirect_stdout( io.StringIO() ):
+        coco.createIndex()
+        results = coco.loadRes( [ { "image_id": int( d[ 0 ] ), "category_id": int( d[ 1 ] ) + 1, "score": d[ 2 ].item(),
+                                    "bbox": [ d[ 3 ].item(), d[ 4 ].item(), ( d[ 5 ] - d[ 3 ] ).item(), ( d[ 6 ] - d[ 4 ] ).item() ] }
+                                  for d in detections ] )
+        evaluator = COCOeval( coco, results, "bbox" )
+        evaluator.evaluate()
+        evaluator.accumulate()
+        evaluator.summarize()
+    print( "pycocotools AP {:.4f} AP50 {:.4f} AP75 {:.4f}".format( *evaluator.stats[ :3 ] ) )
+
+    # Fed batch by batch, the batch index restarts at 0 in every batch
+    meter = CocoMAP( num_classes=5 )
+    for start in range( 0, num_images, batch_size ):
+        d = detections[ ( detections[ :, 0 ] >= start ) & ( detections[ :, 0 ] < start + batch_size ) ].clone()
+        t = targets[ ( targets[ :, 0 ] >= start ) & ( targets[ :, 0 ] < start + batch_size ) ].clone()
+        d[ :, 0 ] -= start
+        t[ :, 0 ] -= start
+        meter.update( d, t, min( batch_size, num_images - start ), image_size )
+    meter.synchronize()
+    result = meter.compute()
+    print( "CocoMAP     AP {:.4f} AP50 {:.4f} AP75 {:.4f}".format( result[ "AP" ], result[ "AP50" ], result[ "AP75" ] ) )
+    print( "kept counts: {:,} bytes".format( sum( c.numel() * c.element_size() for c in
+                                                  ( meter.detections, meter.true_positives, meter.targets ) ) ) )
+
+if __name__ == "__main__":
+    pycocotools_test()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+from Affine.Vision.detection.src.postprocess import decode_outputs, postprocess
+from Affine.Vision.detection.src.yolo import yolo_anchors
+from torchvision.ops import nms
+import time
+import torch
+
+strides = ( 8, 16, 32 )
+anchors = torch.tensor( yolo_anchors, dtype=torch.float32 )
+
+def fake_outputs( batch_size, image_size, num_classes=80, device="cpu" ):
+    """Raw outputs with roughly the score density of a trained COCO model,
+    most cells are background and only a few classes score per cell
+    """
+    outputs = []
+    for stride in strides:
+        size = image_size // stride
+        out = torch.randn( ( batch_size, 3, 5 + num_classes, size, size ), device=device )
+        out[ :, :, 4 ] = out[ :, :, 4 ] * 2.5 - 5
+        out[ :, :, 5: ] = out[ :, :, 5: ] * 2 - 4
+        outputs.append( out.view( batch_size, -1, size, size ) )
+    return outputs
+
+def loop_postprocess( outputs, conf_threshold, iou_threshold, pre_nms_topk, max_detections ):
+    # The straightforward version, one NMS per image and class
+    boxes, obj, cls = decode_outputs( outputs, anchors, strides )
+    scores = obj.sigmoid()[ ..., None ] * cls.sigmoid()
+    detections = []
+    for i in range( boxes.size( 0 ) ):
+        n, c = ( scores[ i ] > conf_threshold ).nonzero( as_tuple=True )
+        s = scores[ i, n, c ]
+        top = s.argsort( descending=True )[ :pre_nms_topk ]
+        n, c, s = n[ top ], c[ top ], s[ top ]
+        kept = []
+        for k in c.unique():
+            m = ( c == k ).nonzero( as_tuple=True )[ 0 ]
+            keep = m[ nms( boxes[ i, n[ m ] ], s[ m ], iou_threshold ) ]
+            kept.append( keep )
+        keep = torch.cat( kept ) if kept else n.new_zeros( 0 )
+        keep = keep[ s[ keep ].argsort( descending=True ) ][ :max_detections ]
+        detections.append( torch.cat( [ torch.full( ( len( keep ), 1 ), float( i ) ), c[ keep, None ].float(),
+                                        s[ keep, None ], boxes[ i, n[ keep ] ] ], dim=1 ) )
+    return torch.cat( detections )
+
+def timed( fn, repeat=5 ):
+    fn()
+    time0 = time.perf_counter()
+    for _ in range( repeat ):
+        fn()
+    return ( time.perf_counter() - time0 ) / repeat * 1000
+
+def same_test():
+    torch.manual_seed( 1 )
+    outputs = fake_outputs( 4, 416 )
+    expected = loop_postprocess( outputs, 0.01, 0.5, 1000, 100 )
+    for dense in ( False, True ):
+        result = postprocess( outputs, anchors, strides, 0.01, 0.5, 1000, 100, dense=dense )
+        print( "dense" if dense else "sparse", result.size(), "matches loop:",
+               result.size() == expected.size() and torch.allclose( result, expected ) )
+
+def benchmark():
+    torch.set_grad_enabled( False )
+    print( "{:>6} {:>5} {:>6} {:>10} {:>10} {:>10}".format( "size", "batch", "conf", "loop ms", "sparse ms", "dense ms" ) )
+    for image_size, batch_size in ( ( 416, 1 ), ( 416, 16 ), ( 608, 1 ), ( 608, 16 ) ):
+        torch.manual_seed( 1 )
+        outputs = fake_outputs( batch_size, image_size )
+        # 0.001 as for mAP evaluation, 0.25 as for deployment
+        for conf in ( 0.001, 0.25 ):
+            times = [ timed( lambda: loop_postprocess( outputs, conf, 0.5, 1000, 100 ) ) ]
+            for dense in ( False, True ):
+                times.append( timed( lambda: postprocess( outputs, anchors, strides, conf, dense=dense ) ) )
+            print( "{:>6} {:>5} {:>6} {:>10.1f} {:>10.1f} {:>10.1f}".format( image_size, batch_size, conf, *times ) )
+
+if __name__ == "__main__":
+    same_test()
+    benchmark()
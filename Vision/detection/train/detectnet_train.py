@@ -1,4 +1,10 @@
 from Affine.Common.utils.src.train_utils import parse_args, AverageMeter, ProgressMeter, Config, setup_and_launch
+from Affine.Common.utils.src.train_utils import adjust_learning_rate, set_determinism
+from Affine.Common.utils.src.dataset_utils import load_coco_data, load_coco_val, seed_loader
+from Affine.Vision.classification.src.darknet53 import darknet, Darknet53, Backbone
+from Affine.Vision.detection.src.yolo import YoloDetector, YoloLoss
+from Affine.Vision.detection.src.postprocess import postprocess
+from Affine.Vision.detection.src.coco_map import CocoMAP
 
 import time
 import os
@@ -11,178 +17,173 @@ import torch.optim as optim
 import torch.multiprocessing as mp
 from torch.multiprocessing import Process
 import torch.distributed as dist
-import torchvision
-from torchvision import transforms, datasets
 from torch.utils.tensorboard import SummaryWriter
 
 
-def main_worker( gpu, args, config ):
-    best_acc1 = 0
-    args.writer = SummaryWriter( filename_suffix="{}".format( gpu ) )
+backbones = { "darknet"     : darknet,
+              "darknet53"   : Darknet53 }
 
-    if args.gpu is None:
-        dist.init_process_group( backend=args.dist_backend, 
-                                 init_method="tcp://10.0.1.164:12345", 
-                                 world_size=args.world_size, rank=gpu )
-        print( "Process: {}, rank: {}, world_size: {}".format( gpu, dist.get_rank(), dist.get_world_size() ) )
 
+def build_detector( config, args ):
+    """YOLO detector on a darknet or Darknet53 backbone. The backbone starts from
+    the classifier checkpoint given with --weights, if any.
+    """
+    backbone = Backbone( backbones[ config.backbone ]() )
+    if args.weights:
+        checkpoint = torch.load( args.weights, map_location="cpu" )
+        state_dict = checkpoint[ "model" ] if "model" in checkpoint else checkpoint
+        print( "Loading backbone weights from {}".format( args.weights ) )
+        backbone.load_classifier_state( state_dict )
+    return YoloDetector( backbone, num_classes=int( config.num_classes ) )
 
-    # Training set preprocessing and loader    
-    transform = transforms.Compose( [ transforms.ToTensor() ] )
-    ann_file = os.path.join( config.ann_path, config.ann_file )
-    dataset = datasets.CocoDetection( config.train_path, annFile=ann_file, transform=transform )
 
-    if args.gpu is None:
-        train_sampler = torch.utils.data.distributed.DistributedSampler( dataset, rank=gpu )
-    else:
-        train_sampler = None
+def main_worker( gpu, args, config, hyper ):
+    set_determinism( args.seed, args.deterministic )
+    best_ap = 0.0
+    args.writer = SummaryWriter( filename_suffix="{}".format( gpu ) )
+    distributed = args.gpu is None
 
-    train_loader = torch.utils.data.DataLoader( dataset, 
-                                                batch_size=args.batch_size, 
-                                                shuffle=( train_sampler is None ),
-                                                num_workers=args.workers,
-                                                pin_memory=True,
-                                                sampler=train_sampler )
+    if distributed:
+        dist.init_process_group( backend=args.dist_backend,
+                                 init_method="tcp://10.0.1.164:12345",
+                                 world_size=args.world_size, rank=gpu )
+        print( "Process: {}, rank: {}, world_size: {}".format( gpu, dist.get_rank(), dist.get_world_size() ) )
 
-    # Validation set preprocessing and loader
-    val_transform = transforms.Compose( [ transforms.ToTensor() ] )
-    
-    valset = datasets.CocoDetection( config.val_path, annFile=ann_file, transform=val_transform )
-    val_loader = torch.utils.data.DataLoader( valset, 
-                                              batch_size=args.batch_size, 
-                                              shuffle=False, 
-                                              num_workers=args.workers, 
-                                              pin_memory=True )
+    torch.cuda.set_device( gpu )
 
+    image_size = int( config.image_size )
+    train_loader = load_coco_data( config, args, hyper, distributed, image_size=image_size )
+    val_loader = load_coco_val( config, args, hyper, distributed, image_size=image_size )
 
-    model = torchvision.models.resnet101( pretrained=args.pretrained )
-    criterion = nn.CrossEntropyLoss().cuda( gpu )
-    optimizer = optim.Adam( model.parameters(), lr=args.learning_rate )
+    model = build_detector( config, args )
+    criterion = YoloLoss( strides=model.strides, num_classes=int( config.num_classes ) ).cuda( gpu )
+    optimizer = optim.SGD( model.parameters(),
+                           lr=hyper.base_lr,
+                           momentum=hyper.momentum,
+                           weight_decay=hyper.weight_decay )
 
-    torch.cuda.set_device( gpu )
     model.cuda( gpu )
-    if args.gpu is None:
+    if distributed:
         model = torch.nn.parallel.DistributedDataParallel( model, device_ids=[ gpu ], output_device=gpu )
 
+    start_epoch = 0
     if args.resume:
         print( "Loading checkpoint {}".format( config.checkpoint_file ) )
         checkpoint = torch.load( config.checkpoint_file, map_location='cpu' )
-        best_acc1 = checkpoint[ 'best_acc1' ]
-        model.load_state_dict( checkpoint[ "model_state_dict" ] )
-        optimizer.load_state_dict( checkpoint[ "optimizer_state_dict" ] )
+        # Checkpoints from before the mAP validation have best_loss instead
+        best_ap = checkpoint.get( "best_ap", 0.0 )
+        model.load_state_dict( checkpoint[ "model" ] )
+        optimizer.load_state_dict( checkpoint[ "optimizer" ] )
+        start_epoch = checkpoint[ "epoch" ]
 
     if args.evaluate:
-        validate( val_loader, model, criterion, gpu, args )
+        validate( val_loader, model, criterion, gpu, args, config )
         return
 
     # Main training loop starts here
     time0 = time.time()
-    for epoch in range( args.start_epoch, args.epochs ):
-        if args.gpu is None:
-            train_sampler.set_epoch( epoch )
-        
-        train( train_loader, model, criterion, optimizer, epoch, gpu, args )
+    for epoch in range( start_epoch, start_epoch + args.epochs ):
+        if distributed:
+            train_loader.sampler.set_epoch( epoch )
+        seed_loader( train_loader, args.seed, epoch, dist.get_rank() if distributed else 0 )
+
+        train( train_loader, model, criterion, optimizer, epoch, gpu, args, hyper )
 
         print( "Training time: {}".format( datetime.timedelta( seconds=time.time() - time0 ) ) )
 
-        acc1 = validate( val_loader, model, criterion, gpu, args )
-        is_best = acc1 > best_acc1
-        best_acc1 = max( acc1, best_acc1 )
+        val_ap = validate( val_loader, model, criterion, gpu, args, config )
+        is_best = val_ap > best_ap
+        best_ap = max( val_ap, best_ap )
 
-        if args.gpu or ( gpu % args.world_size == 0 ):
+        if not distributed or gpu == 0:
             print( "Saving checkpoint")
             save_checkpoint( {
-                "epoch": epoch + 1,
-                "model_state_dict": model.state_dict(),
-                "best_acc1": best_acc1,
-                "optimizer_state_dict": optimizer.state_dict(),
+                "epoch"         : epoch + 1,
+                "backbone"      : config.backbone,
+                "model"         : model.state_dict(),
+                "best_ap"       : best_ap,
+                "optimizer"     : optimizer.state_dict(),
             }, is_best, filename=config.checkpoint_write )
 
         time0 = time.time()
-    
+
     args.writer.close()
 
-def train( loader, model, criterion, optimizer, epoch, gpu, args ):
+def train( loader, model, criterion, optimizer, epoch, gpu, args, hyper ):
     losses = AverageMeter( "Loss", ":.4e" )
-    top1 = AverageMeter( "Accuracy1", ":6.2f" )
-    top5 = AverageMeter( "Accuracy5", ":6.2f" )
+    box = AverageMeter( "Box", ":.3f" )
+    obj = AverageMeter( "Obj", ":.3f" )
+    cls = AverageMeter( "Cls", ":.3f" )
     n_inputs = len( loader )
 
     progress = ProgressMeter( n_inputs, \
-                              [ losses, top1, top5 ], \
+                              [ losses, box, obj, cls ], \
                               prefix="Epoch:[{}]".format( epoch + 1 ) )
     #Switch to training mode
     model.train()
 
-    for i, ( images, target ) in enumerate( loader ):
+    for i, ( images, targets, _ ) in enumerate( loader ):
+        niter = epoch * n_inputs + i
+        lr = adjust_learning_rate( optimizer, niter, hyper, n_inputs )
 
         images = images.cuda( gpu, non_blocking=True )
-        target = target.cuda( gpu, non_blocking=True )
-        output = model( images )
-        loss = criterion( output, target )
+        targets = targets.cuda( gpu, non_blocking=True )
+        outputs = model( images )
+        loss, parts = criterion( outputs, targets )
 
         batch_size = images.size( 0 )
-        acc1, acc5 = accuracy( output, target, topk=( 1, 5 ) )
         losses.update( loss.item(), batch_size )
-        top1.update( acc1[ 0 ], batch_size )
-        top5.update( acc5[ 0 ], batch_size )
+        box.update( parts[ "box" ], batch_size )
+        obj.update( parts[ "obj" ], batch_size )
+        cls.update( parts[ "cls" ], batch_size )
 
         optimizer.zero_grad()
         loss.backward()
         optimizer.step()
 
         if i % 50 == 0:
-            args.writer.add_scalar( "Loss/train/gpu{}".format( gpu ), loss.item(), n_inputs * epoch + i )
+            args.writer.add_scalar( "Loss/train/gpu{}".format( gpu ), loss.item(), niter )
+            args.writer.add_scalar( "LR/gpu{}".format( gpu ), lr, niter )
             progress.display( i )
 
-def validate( loader, model, criterion, gpu, args ):
+def validate( loader, model, criterion, gpu, args, config ):
+    """Validation loss and COCO mAP, returns the AP over IoU 0.5:0.95
+    """
     losses = AverageMeter( "Loss", ":.4e" )
-    top1 = AverageMeter( "Accuracy1", ":6.2f" )
-    top5 = AverageMeter( "Accuracy5", ":6.2f" )
 
     progress = ProgressMeter( len( loader ), \
-                              [ losses, top1, top5 ], \
+                              [ losses ], \
                               prefix="Test: " )
 
+    detector = model.module if hasattr( model, "module" ) else model
+    meter = CocoMAP( num_classes=int( config.num_classes ), num_samples=len( loader.dataset ), device=gpu )
+    image_size = int( config.image_size )
+
     #Switch to eval mode
     model.eval()
 
     with torch.no_grad():
-        for i, ( images, target ) in enumerate( loader ):
+        for i, ( images, targets, _, eval_targets ) in enumerate( loader ):
             images = images.cuda( gpu, non_blocking=True )
-            target = target.cuda( gpu, non_blocking=True )
-            output = model( images )
-            loss = criterion( output, target )
-
-            acc1, acc5 = accuracy( output, target, topk=( 1, 5 ) )
+            targets = targets.cuda( gpu, non_blocking=True )
+            outputs = model( images )
+            loss, _ = criterion( outputs, targets )
             losses.update( loss.item(), images.size( 0 ) )
-            top1.update( acc1[ 0 ], images.size( 0 ) )
-            top5.update( acc5[ 0 ], images.size( 0 ) )
+
+            # Low threshold, as usual for mAP
+            detections = postprocess( outputs, detector.anchors, detector.strides, conf_threshold=0.001 )
+            # All annotations, with the crowd ones as ignore regions
+            meter.update( detections, eval_targets, images.size( 0 ), image_size )
 
             if i % 50 == 0:
                 progress.display( i )
 
-    return top1.avg
-
+    meter.synchronize()
+    result = meter.compute()
+    print( " * Loss {:.4e} AP {:.4f} AP50 {:.4f} AP75 {:.4f}".format( losses.avg, result[ "AP" ],
+                                                                      result[ "AP50" ], result[ "AP75" ] ) )
+    return result[ "AP" ]
 
-def accuracy( outputs, targets, topk=(1, ) ):
-    with torch.no_grad():
-        maxk = max( topk )
-        batch_size = targets.size( 0 )
-        _, topk_classes = outputs.topk( maxk, dim=1, largest=True, sorted=True )
-        topk_classes = topk_classes.t()
-        correct = topk_classes.eq( targets.expand_as( topk_classes ) )
-
-        res = []
-        for k in topk:
-            correct_k = correct[ :k ].view( -1 ).float().sum( 0, keepdim=True )
-            res.append( correct_k.mul_( 100.0 / batch_size ) )
-        return res
-
-def adjust_learning_rate( optimizer, epoch, args ):
-    lr = args.learning_rate * ( 0.1 ** ( epoch // 30 ) )
-    for param_group in optimizer.param_groups:
-        param_group[ 'lr' ] = lr
 
 def save_checkpoint( state, is_best=True, filename=None ):
     torch.save( state, filename )
@@ -193,7 +194,11 @@ if __name__ == "__main__":
     config.train_path = "/home/vipul/Datasets/COCO2017/train"
     config.val_path = "/home/vipul/Datasets/COCO2017/val"
     config.ann_path = "/home/vipul/Datasets/COCO2017/annotations"
-    config.ann_file = "instances_train2017.json"
+    config.train_ann = "instances_train2017.json"
+    config.val_ann = "instances_val2017.json"
+    config.backbone = "darknet"
+    config.num_classes = 80
+    config.image_size = 416
     config.checkpoint_path = "checkpoint"
     config.checkpoint_name = "checkpoint.pth.tar"
-    setup_and_launch( worker_fn=main_worker, config=config )
\ No newline at end of file
+    setup_and_launch( worker_fn=main_worker, config=config )